@@ -20,6 +20,7 @@ import configparser
 import argparse
 import os
 import datetime as dt
+from osgeo import gdal
 
 
 if __name__ == "__main__":
@@ -42,6 +43,8 @@ if __name__ == "__main__":
                              "config file.")
     parser.add_argument("--chunks", dest="num_chunks", type=int, default=10, help="Sets the number of chunks to split "
                                                                                   "images to in ml processing")
+    parser.add_argument("--processes", dest="processes", type=int, default=1, help="Sets the number of scenes to "
+                                                                                   "preprocess concurrently")
     parser.add_argument('-d', '--download', dest='do_download', action='store_true', default=False)
     parser.add_argument('-p', '--preprocess', dest='do_preprocess', action='store_true',  default=False)
     parser.add_argument('-m', '--merge', dest='do_merge', action='store_true', default=False)
@@ -52,6 +55,28 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--remove', dest='do_delete', action='store_true', default=False)
 
     parser.add_argument('--skip_prob_image', dest="skip_prob_image", action="store_true", default=False)
+    parser.add_argument('--prob_datatype', dest="prob_datatype", choices=["Float32", "UInt16", "Byte"],
+                        default="Float32",
+                        help="Stores probability images as quantised UInt16 or Byte instead of Float32")
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true', default=False,
+                        help="If present, downloads, preprocesses and detects change in each new image as soon as "
+                             "it is ready instead of one step at a time. Only used when running all steps.")
+    parser.add_argument("--download_threads", dest="download_threads", type=int, default=2,
+                        help="Sets the number of concurrent downloads when using --pipeline")
+    parser.add_argument("--sen2cor_processes", dest="sen2cor_processes", type=int, default=2,
+                        help="Sets the number of concurrent sen2cor runs when using --pipeline")
+
+    parser.add_argument("--min_aoi_overlap", dest="min_aoi_overlap", type=float, default=0,
+                        help="Skips downloading products whose footprint covers less than this fraction of the aoi")
+    parser.add_argument("--max_aoi_cloud", dest="max_aoi_cloud", type=float, default=None,
+                        help="Skips downloading products estimated from their quicklook to be more than this percent "
+                             "cloudy over the aoi")
+    parser.add_argument("--aoi_window", dest="aoi_window", action="store_true", default=False,
+                        help="If present, only the window of each tile covering the aoi is merged, stacked, "
+                             "composited and classified")
+    parser.add_argument("--overview_workers", dest="overview_workers", type=int, default=0,
+                        help="If more than 0, builds overviews and statistics for the class, probability and "
+                             "composite images in this many background threads")
 
     args = parser.parse_args()
 
@@ -90,10 +115,15 @@ if __name__ == "__main__":
     composite_l1_image_dir = os.path.join(project_root, r"composite/L1")
     composite_l2_image_dir = os.path.join(project_root, r"composite/L2")
     composite_merged_dir = os.path.join(project_root, r"composite/merged")
+    cache_path = os.path.join(project_root, r"processing_cache.db")
+    catalog_path = pyeo.get_scene_catalog_path(project_root)
 
     if args.skip_prob_image:
         probability_image_dir = None
 
+    window_aoi_path = aoi_path if args.aoi_window else None
+    overview_stage = pyeo.OverviewStage(args.overview_workers) if args.overview_workers else None
+
     if args.start_date == "LATEST":
         # This isn't nice, but returns the yyyymmdd string of the latest stacked image
         start_date = pyeo.get_image_acquisition_time(pyeo.sort_by_timestamp(
@@ -114,78 +144,151 @@ if __name__ == "__main__":
                 composite_start_date, composite_end_date, cloud_cover))
             composite_products = pyeo.check_for_s2_data_by_date(aoi_path, composite_start_date, composite_end_date,
                                                              conf, cloud_cover=cloud_cover)
+            composite_products = pyeo.filter_by_aoi_coverage(composite_products, aoi_path, args.min_aoi_overlap,
+                                                             args.max_aoi_cloud, sen_user, sen_pass)
             pyeo.download_s2_data(composite_products, composite_l1_image_dir, composite_l2_image_dir, source='scihub',
                                   user=sen_user, passwd=sen_pass)
         if args.do_preprocess or do_all:
             log.info("Preprocessing composite products")
             pyeo.atmospheric_correction(composite_l1_image_dir, composite_l2_image_dir, sen2cor_path,
-                                        delete_unprocessed_image=False)
+                                        delete_unprocessed_image=False, cache_path=cache_path)
         if args.do_merge or do_all:
             log.info("Aggregating composite layers")
             pyeo.preprocess_sen2_images(composite_l2_image_dir, composite_merged_dir, composite_l1_image_dir,
-                                        cloud_certainty_threshold, epsg=epsg, buffer_size=5)
+                                        cloud_certainty_threshold, epsg=epsg, buffer_size=5,
+                                        processes=args.processes, cache_path=cache_path, aoi_path=window_aoi_path)
         log.info("Building initial cloud-free composite")
         pyeo.composite_directory(composite_merged_dir, composite_dir, generate_date_images=True)
 
+    def detect_change(new_image_path):
+        """Stacks a merged image with the preceding composite, classifies the stack and updates the composite.
+        Must be called on images in timestamp order."""
+        global latest_composite_path, new_stack_path
+        image = os.path.basename(new_image_path)
+        log.info("Detecting change for {}".format(image))
+
+        # Stack with preceding composite
+        if args.do_stack or do_all:
+            latest_composite_path = pyeo.get_preceding_image_path(new_image_path, composite_dir,
+                                                                  catalog_path=catalog_path)
+            log.info("Stacking {} with composite {}".format(new_image_path, latest_composite_path))
+            new_stack_path = pyeo.stack_image_with_composite(new_image_path, latest_composite_path, stacked_image_dir,
+                                                             cache_path=cache_path)
+            pyeo.set_scene_state(catalog_path, new_stack_path, "stacked")
+
+        # Classify with composite
+        if args.do_classify or do_all:
+            log.info("Classifying with composite")
+            new_class_image = os.path.join(catagorised_image_dir, "class_{}".format(os.path.basename(new_stack_path)))
+            new_prob_image = os.path.join(probability_image_dir, "prob_{}".format(os.path.basename(new_stack_path)))
+            pyeo.classify_image(new_stack_path, model_path, new_class_image, new_prob_image, num_chunks=10,
+                                skip_existing=True, apply_mask=True, cache_path=cache_path,
+                                prob_datatype=gdal.GetDataTypeByName(args.prob_datatype))
+            pyeo.set_scene_state(catalog_path, new_stack_path, "classified")
+            if overview_stage:
+                overview_stage.submit(new_class_image, "class")
+                if probability_image_dir:
+                    overview_stage.submit(new_prob_image, "probability")
+
+        # Build new composite
+        if args.do_update or do_all:
+            log.info("Updating composite")
+            new_composite_path = os.path.join(
+                composite_dir, "composite_{}.tif".format(pyeo.get_sen_2_image_timestamp(os.path.basename(image))))
+            pyeo.composite_images_with_mask(
+                (latest_composite_path, new_image_path), new_composite_path, generate_date_image=True,
+                cache_path=cache_path)
+            pyeo.set_scene_state(catalog_path, new_composite_path, "composite")
+            if overview_stage:
+                overview_stage.submit(new_composite_path, "reflectance")
+            latest_composite_path = new_composite_path
+        return new_image_path
+
+    def correct_image(l1_path):
+        """Pipeline stage; applies sen2cor to a downloaded image unless only its L2 product is present"""
+        l2_path = os.path.join(l2_image_dir, os.path.basename(l1_path).replace("MSIL1C", "MSIL2A"))
+        if not os.path.exists(l1_path) and os.path.exists(l2_path):
+            return l2_path
+        return pyeo.atmospheric_correction_of_image(l1_path, l2_image_dir, sen2cor_path, cache_path=cache_path)
+
+    def merge_image(l2_path):
+        """Pipeline stage; merges the bands and builds the cloud mask of an L2 image. Returns None, dropping the image
+        from the pipeline, if it does not cover the aoi window."""
+        merged_path = pyeo.preprocess_sen2_image(l2_path, merged_image_dir, l1_image_dir, cloud_certainty_threshold,
+                                                 buffer_size=5, epsg=epsg, cache_path=cache_path,
+                                                 aoi_path=window_aoi_path)
+        if merged_path is None:
+            # preprocess_sen2_image also returns None when the merged image is already up to date; it only exists
+            # on disk in that case, since scenes outside the aoi window are never written.
+            merged_path = os.path.join(merged_image_dir, pyeo.get_sen_2_granule_id(l2_path) + ".tif")
+            if not os.path.exists(merged_path):
+                log.warning("{} does not cover the aoi window; dropping it".format(l2_path))
+                return None
+        return merged_path
+
+    if args.pipeline and do_all:
+        # Each scene moves from download to sen2cor to merging as soon as it can; change detection then runs on
+        # each merged scene in timestamp order as soon as it and every earlier scene are ready.
+        products = pyeo.check_for_s2_data_by_date(aoi_path, start_date, end_date, conf, cloud_cover=cloud_cover)
+        products = pyeo.filter_by_aoi_coverage(products, aoi_path, args.min_aoi_overlap, args.max_aoi_cloud,
+                                               sen_user, sen_pass)
+        log.info("Running pipeline on {} products".format(len(products)))
+        stages = [
+            ("download", lambda product: pyeo.download_s2_product(product[0], product[1], l1_image_dir, l2_image_dir,
+                                                                  "scihub", user=sen_user, passwd=sen_pass),
+             args.download_threads),
+            ("sen2cor", correct_image, args.sen2cor_processes),
+            ("merge", merge_image, args.processes)
+        ]
+        pyeo.update_scene_catalog(catalog_path, composite_dir, state="composite")
+        pyeo.run_pipeline(list(products.items()), stages, ordered_func=detect_change,
+                          order_key=lambda product: pyeo.get_sen_2_image_timestamp(product[1]['identifier']))
+        if overview_stage:
+            overview_stage.close()
+        log.info("***PROCESSING END***")
+        sys.exit(0)
+
     # Query and download all images since last composite
     if args.do_download or do_all:
         products = pyeo.check_for_s2_data_by_date(aoi_path, start_date, end_date, conf, cloud_cover=cloud_cover)
+        products = pyeo.filter_by_aoi_coverage(products, aoi_path, args.min_aoi_overlap, args.max_aoi_cloud,
+                                               sen_user, sen_pass)
         log.info("Downloading")
         pyeo.download_s2_data(products, l1_image_dir, l2_image_dir, "scihub", user=sen_user, passwd=sen_pass)
 
     # Atmospheric correction
     if args.do_preprocess or do_all:
         log.info("Applying sen2cor")
-        pyeo.atmospheric_correction(l1_image_dir, l2_image_dir, sen2cor_path, delete_unprocessed_image=False)
+        pyeo.atmospheric_correction(l1_image_dir, l2_image_dir, sen2cor_path, delete_unprocessed_image=False,
+                                    cache_path=cache_path)
 
     # Aggregating layers into single image
     if args.do_merge or do_all:
         log.info("Aggregating layers")
         pyeo.preprocess_sen2_images(l2_image_dir, merged_image_dir, l1_image_dir, cloud_certainty_threshold, epsg=epsg,
-                                    buffer_size=5)
+                                    buffer_size=5, processes=args.processes, cache_path=cache_path,
+                                    aoi_path=window_aoi_path)
+
+    pyeo.update_scene_catalog(catalog_path, l1_image_dir, state="L1")
+    pyeo.update_scene_catalog(catalog_path, l2_image_dir, state="L2")
+    pyeo.update_scene_catalog(catalog_path, merged_image_dir, state="merged")
+    pyeo.update_scene_catalog(catalog_path, composite_dir, state="composite")
 
     log.info("Finding most recent composite")
-    latest_composite_name = \
-        pyeo.sort_by_timestamp(
-            [image_name for image_name in os.listdir(composite_dir) if image_name.endswith(".tif")],
-            recent_first=True
-        )[0]
+    latest_composite_name = os.path.basename(
+        pyeo.query_scene_catalog(catalog_path, directory=composite_dir, extension=".tif", recent_first=True)[0])
     latest_composite_path = os.path.join(composite_dir, latest_composite_name)
     log.info("Most recent composite at {}".format(latest_composite_path))
 
     log.info("Sorting image list")
-    images = \
-        pyeo.sort_by_timestamp(
-            [image_name for image_name in os.listdir(merged_image_dir) if image_name.endswith(".tif")],
-            recent_first=False
-        )
+    images = [os.path.basename(image_path) for image_path in
+              pyeo.query_scene_catalog(catalog_path, directory=merged_image_dir, extension=".tif", recent_first=False)]
     log.info("Images to process: {}".format(images))
 
     for image in images:
-        log.info("Detecting change for {}".format(image))
-        new_image_path = os.path.join(merged_image_dir, image)
-
-        # Stack with preceding composite
-        if args.do_stack or do_all:
-            latest_composite_path = pyeo.get_preceding_image_path(new_image_path, composite_dir)
-            log.info("Stacking {} with composite {}".format(new_image_path, latest_composite_path))
-            new_stack_path = pyeo.stack_image_with_composite(new_image_path, latest_composite_path, stacked_image_dir)
-
-        # Classify with composite
-        if args.do_classify or do_all:
-            log.info("Classifying with composite")
-            new_class_image = os.path.join(catagorised_image_dir, "class_{}".format(os.path.basename(new_stack_path)))
-            new_prob_image = os.path.join(probability_image_dir, "prob_{}".format(os.path.basename(new_stack_path)))
-            pyeo.classify_image(new_stack_path, model_path, new_class_image, new_prob_image, num_chunks=10,
-                                skip_existing=True, apply_mask=True)
-
-        # Build new composite
-        if args.do_update or do_all:
-            log.info("Updating composite")
-            new_composite_path = os.path.join(
-                composite_dir, "composite_{}.tif".format(pyeo.get_sen_2_image_timestamp(os.path.basename(image))))
-            pyeo.composite_images_with_mask(
-                (latest_composite_path, new_image_path), new_composite_path, generate_date_image=True)
-            latest_composite_path = new_composite_path
+        detect_change(os.path.join(merged_image_dir, image))
 
+    if overview_stage:
+        log.info("Waiting for overviews")
+        overview_stage.close()
     log.info("***PROCESSING END***")
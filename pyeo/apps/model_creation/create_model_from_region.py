@@ -14,6 +14,15 @@ if __name__ == "__main__":
                         help="Attribute field holding the class to train on")
     parser.add_argument("out_path", type=str, action="store",
                         help="Path for the output .pkl file")
+    parser.add_argument("--n_jobs", dest="n_jobs", type=int, default=4,
+                        help="Sets the number of cores each model fits with; -1 uses all of them")
+    parser.add_argument("--cv_jobs", dest="cv_jobs", type=int, default=1,
+                        help="Sets the number of cross validation folds fitted at once")
+    parser.add_argument("--reuse_fold_models", dest="reuse_fold_models", action="store_true", default=False,
+                        help="If present, combines the cross validation models into the output model instead of "
+                             "fitting it again on all of the data")
+    parser.add_argument("--threads", dest="threads", type=int, default=1,
+                        help="Sets the number of training images whose pixels are read at once")
     args = parser.parse_args()
 
     conf = configparser.ConfigParser()
@@ -24,6 +33,7 @@ if __name__ == "__main__":
 
     pyeo.create_model_for_region(args.region_path, args.out_path,
                                  args.training_class.rsplit('.')[0]+"_scores.txt",
-                                 args.training_class)
+                                 args.training_class, n_jobs=args.n_jobs, cv_jobs=args.cv_jobs,
+                                 reuse_fold_models=args.reuse_fold_models, threads=args.threads)
 
     log.info("***MODEL CREATION END***")
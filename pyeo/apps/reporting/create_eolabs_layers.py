@@ -3,7 +3,6 @@ sys.path.insert(0, os.path.abspath(os.path.join(__file__, '..', '..', '..', '..'
 import pyeo.core as pyeo
 import csv
 import gdal
-import numpy as np
 import boto3
 import argparse
 
@@ -22,28 +21,21 @@ DEFAULT_KEY = [
 ]
 
 
-def create_report(class_path, certainty_path, out_dir, class_color_key=DEFAULT_KEY):
+def create_report(class_path, certainty_path, out_dir, class_color_key=DEFAULT_KEY, use_color_table=False):
     if class_color_key != DEFAULT_KEY:
         class_color_key = load_color_pallet(class_color_key)
     pyeo.flatten_probability_image(certainty_path, os.path.join(out_dir, "prob.tif"))
-    create_display_layer(class_path, os.path.join(out_dir, "display.tif"), class_color_key)
+    create_display_layer(class_path, os.path.join(out_dir, "display.tif"), class_color_key, use_color_table)
 
 
-def create_display_layer(class_path, out_path, class_color_key):
+def create_display_layer(class_path, out_path, class_color_key, use_color_table=False):
+    """Colours the class map at class_path with class_color_key; an RGB image, or a paletted image if
+    use_color_table is True. See pyeo.color_class_map."""
     srs = """PROJCS["WGS 84 / Pseudo-Mercator",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]],PROJECTION["Mercator_1SP"],PARAMETER["central_meridian",0],PARAMETER["scale_factor",1],PARAMETER["false_easting",0],PARAMETER["false_northing",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]],AXIS["X",EAST],AXIS["Y",NORTH],EXTENSION["PROJ4","+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs"],AUTHORITY["EPSG","3857"]]"""
-    class_raster = gdal.Open(class_path)
-    display_raster = pyeo.create_matching_dataset(class_raster, out_path, bands=3, datatype=gdal.GDT_Byte)
-    display_array = display_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-
-    class_array = class_raster.GetVirtualMemArray()
-    for index, class_pixel in np.ndenumerate(class_array):
-        display_array[:, index[0], index[1]] =\
-            [class_row[1:4] for class_row in class_color_key if class_row[0] == str(class_pixel)][0]
-    display_array = None
-    class_array = None
+    pyeo.color_class_map(class_path, out_path, class_color_key, use_color_table)
+    display_raster = gdal.Open(out_path, gdal.GA_Update)
     gdal.ReprojectImage(display_raster, dst_wkt=srs)
     display_raster = None
-    class_raster = None
 
 
 def load_color_pallet(pallet_path):
@@ -64,8 +56,10 @@ if __name__ == "__main__":
     parser.add_argument("certainty_path")
     parser.add_argument("output_folder")
     parser.add_argument("-p" "--pallet", dest="pallet")
+    parser.add_argument("--color_table", dest="use_color_table", action="store_true", default=False,
+                        help="If present, writes the display layer as a paletted image instead of RGB")
     args = parser.parse_args()
 
-    create_report(args.class_path, args.certainty_path, args.output_folder)
+    create_report(args.class_path, args.certainty_path, args.output_folder, use_color_table=args.use_color_table)
 
 
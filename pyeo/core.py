@@ -5,25 +5,40 @@ import sys
 import logging
 import datetime as dt
 import glob
+import fnmatch
 import re
+import functools
+import collections
+import copy
 import configparser
+import hashlib
+import sqlite3
+import time
+import threading
 from sentinelhub import download_safe_format
-from sentinelsat import SentinelAPI, geojson_to_wkt, read_geojson
+from sentinelsat import SentinelAPI, SentinelAPIError, geojson_to_wkt, read_geojson
 import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import concurrent.futures
 import gdal
+from osgeo import gdal_array
 from osgeo import ogr, osr
 import numpy as np
 import numpy.ma as ma
 import tempfile
 from tempfile import TemporaryDirectory
 import sklearn.ensemble as ens
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import StratifiedKFold
+from sklearn.base import clone
+from sklearn.utils.class_weight import compute_class_weight
 from skimage import morphology as morph
-import scipy.sparse as sp
 from sklearn.externals import joblib as sklearn_joblib
 import joblib
 import shutil
 import zipfile
+import zlib
+import struct
 
 import json
 import csv
@@ -36,6 +51,12 @@ try:
 except ModuleNotFoundError:
     print("google-cloud-storage required for Google downloads. Try pip install google-cloud-storage")
 
+try:
+    import asyncio
+    import aiohttp
+except ModuleNotFoundError:
+    print("aiohttp is required for asynchronous Planet downloads. Try pip install aiohttp")
+
 try:
     import tenacity
     from planet import api as planet_api
@@ -76,7 +97,7 @@ class FMaskException(ForestSentinelException):
     pass
 
 
-def sent2_query(user, passwd, geojsonfile, start_date, end_date, cloud=50):
+def sent2_query(user, passwd, geojsonfile, start_date, end_date, cloud=50, api=None):
     """
 
 
@@ -109,11 +130,15 @@ def sent2_query(user, passwd, geojsonfile, start_date, end_date, cloud=50):
     cloud : string (optional)
             include a cloud filter in the search
 
+    api : SentinelAPI (optional)
+          an existing session to query with, eg from get_sentinel_api. If not given, a new one is created.
+
 
     """
     ##set up your copernicus username and password details, and copernicus download site... BE CAREFUL if you share this script with others though!
     log = logging.getLogger(__name__)
-    api = SentinelAPI(user, passwd)
+    if api is None:
+        api = SentinelAPI(user, passwd)
     footprint = geojson_to_wkt(read_geojson(geojsonfile))
     log.info("Sending query:\nfootprint: {}\nstart_date: {}\nend_date: {}\n cloud_cover: {} ".format(
         footprint, start_date, end_date, cloud))
@@ -123,6 +148,153 @@ def sent2_query(user, passwd, geojsonfile, start_date, end_date, cloud=50):
     return products
 
 
+SCIHUB_URL = "https://scihub.copernicus.eu/apihub/"
+sentinel_apis = threading.local()
+
+
+def get_sentinel_api(user, passwd, api_url=SCIHUB_URL):
+    """Returns an authenticated SentinelAPI session for user at api_url, reusing one if it has already been made in
+    this thread. Each thread gets its own, as the requests session inside a SentinelAPI is not thread safe."""
+    if not hasattr(sentinel_apis, "apis"):
+        sentinel_apis.apis = {}
+    if (user, passwd, api_url) not in sentinel_apis.apis:
+        sentinel_apis.apis[(user, passwd, api_url)] = SentinelAPI(user, passwd, api_url)
+    return sentinel_apis.apis[(user, passwd, api_url)]
+
+
+def split_date_range(start_date, end_date, window_days=30):
+    """Splits the range between two datetimes into a list of (start, end) tuples at most window_days long"""
+    windows = []
+    window_start = start_date
+    while window_start < end_date:
+        window_end = min(window_start + dt.timedelta(days=window_days), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+
+def plan_s2_queries(aoi_paths, start_date, end_date, cloud=50, window_days=30):
+    """Returns a list of query dicts covering every aoi in aoi_paths between start_date and end_date (datetimes),
+    one per aoi per window of window_days. Each dict has an 'id' that identifies it in a query store."""
+    queries = []
+    for aoi_path in aoi_paths:
+        footprint = geojson_to_wkt(read_geojson(aoi_path))
+        for window_start, window_end in split_date_range(start_date, end_date, window_days):
+            query_id = hashlib.sha1("{} {} {} {}".format(
+                footprint, cloud, window_start.isoformat(), window_end.isoformat()).encode("utf-8")).hexdigest()
+            queries.append({"id": query_id, "aoi_path": aoi_path, "footprint": footprint, "cloud": cloud,
+                            "start": window_start, "end": window_end})
+    return queries
+
+
+def open_query_store(store_path):
+    """Opens (creating if needed) the sqlite store of finished scihub queries and their products at store_path"""
+    connection = sqlite3.connect(store_path, timeout=60)
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS queries (query_id TEXT PRIMARY KEY, queried_at TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS query_products (query_id TEXT, uuid TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS query_products_by_id ON query_products (query_id)")
+        connection.execute("CREATE TABLE IF NOT EXISTS products (uuid TEXT PRIMARY KEY, properties TEXT)")
+    return connection
+
+
+def load_stored_query(store_path, query, settle_days=3):
+    """Returns the products dict stored for query, or None if it has not been run or was run before its window had
+    closed for settle_days (products can be published a few days after acquisition)."""
+    connection = open_query_store(store_path)
+    try:
+        row = connection.execute("SELECT queried_at FROM queries WHERE query_id = ?", (query["id"],)).fetchone()
+        if row is None or dt.datetime.strptime(row[0], "%Y%m%dT%H%M%S") < query["end"] + dt.timedelta(days=settle_days):
+            return None
+        rows = connection.execute("SELECT products.uuid, products.properties FROM query_products JOIN products "
+                                  "ON query_products.uuid = products.uuid WHERE query_products.query_id = ?",
+                                  (query["id"],))
+        return collections.OrderedDict((uuid, json.loads(properties)) for uuid, properties in rows)
+    finally:
+        connection.close()
+
+
+def store_query(store_path, query, products):
+    """Saves the products returned by query in the query store at store_path"""
+    connection = open_query_store(store_path)
+    try:
+        with connection:
+            connection.execute("DELETE FROM query_products WHERE query_id = ?", (query["id"],))
+            connection.executemany("INSERT OR REPLACE INTO products VALUES (?, ?)",
+                                   [(uuid, json.dumps(properties, default=str)) for uuid, properties in products.items()])
+            connection.executemany("INSERT INTO query_products VALUES (?, ?)",
+                                   [(query["id"], uuid) for uuid in products])
+            connection.execute("INSERT OR REPLACE INTO queries VALUES (?, ?)",
+                               (query["id"], dt.datetime.utcnow().strftime("%Y%m%dT%H%M%S")))
+    finally:
+        connection.close()
+
+
+@tenacity.retry(
+    wait=tenacity.wait_exponential(),
+    stop=tenacity.stop_after_attempt(5),
+    retry=tenacity.retry_if_exception_type(SentinelAPIError)
+)
+def run_s2_query(api, query):
+    """Runs a single planned query with api, backing off and retrying if scihub refuses it"""
+    log = logging.getLogger(__name__)
+    log.info("Querying {} between {} and {}".format(query["aoi_path"], query["start"], query["end"]))
+    return api.query(query["footprint"],
+                     date=(query["start"], query["end"]), platformname="Sentinel-2",
+                     cloudcoverpercentage="[0 TO {}]".format(query["cloud"]))
+
+
+def batch_s2_query(user, passwd, aoi_paths, start_date, end_date, cloud=50, window_days=30, threads=4,
+                   store_path=None, api_url=SCIHUB_URL):
+    """
+    Queries scihub for Sentinel-2 products over several AOIs at once, with one authenticated session per thread.
+
+    Parameters
+    ----------
+    aoi_paths : list of str
+        Paths to geojson files of each AOI in EPSG 4326
+
+    start_date, end_date : datetime
+        The range to search; split into windows of window_days, which are queried threads at a time
+
+    store_path : str (optional)
+        Path to an sqlite query store. Windows already stored (and closed for a few days) are read from here
+        instead of being sent again, so repeated searches only query the new dates.
+
+    api_url : str
+        The OpenSearch endpoint to query
+
+    Returns
+    -------
+    An OrderedDict of product uuid to product properties, like sent2_query, with each product appearing once.
+    The 'aois' property of each product lists the aoi_paths it was found in. Properties read from the store have
+    their dates as strings.
+    """
+    log = logging.getLogger(__name__)
+    queries = plan_s2_queries(aoi_paths, start_date, end_date, cloud, window_days)
+    results = [None]*len(queries)
+    if store_path:
+        results = [load_stored_query(store_path, query) for query in queries]
+    to_run = [index for index, result in enumerate(results) if result is None]
+    log.info("{} queries planned, {} to send".format(len(queries), len(to_run)))
+    with ThreadPool(threads) as pool:
+        new_results = pool.map(lambda index: run_s2_query(get_sentinel_api(user, passwd, api_url), queries[index]),
+                               to_run)
+    for index, products in zip(to_run, new_results):
+        results[index] = products
+        if store_path:
+            store_query(store_path, queries[index], products)
+    all_products = collections.OrderedDict()
+    for query, products in zip(queries, results):
+        for uuid, properties in products.items():
+            if uuid not in all_products:
+                all_products[uuid] = dict(properties, aois=[])
+            if query["aoi_path"] not in all_products[uuid]["aois"]:
+                all_products[uuid]["aois"].append(query["aoi_path"])
+    log.info("Batch search returned {} unique products".format(len(all_products)))
+    return all_products
+
+
 def init_log(log_path):
     """Sets up the log format and log handlers; one for stdout and to write to a file, 'log_path'.
      Returns the log for the calling script"""
@@ -139,7 +311,7 @@ def init_log(log_path):
 
 
 def create_file_structure(root):
-    """Creates the file structure if it doesn't exist already"""
+    """Creates the file structure and scene catalog if they don't exist already"""
     os.chdir(root)
     dirs = [
         "images/",
@@ -164,6 +336,265 @@ def create_file_structure(root):
             os.mkdir(dir)
         except FileExistsError:
             pass
+    open_scene_catalog(get_scene_catalog_path(root)).close()
+
+
+def get_file_identity(path, use_hash=False):
+    """Returns a tuple identifying the contents of the file or directory at path; (path, size, mtime) by default, or
+    (path, sha1 of contents) if use_hash is True. Directories (eg .SAFE files) are identified by every file inside them.
+    Returns (path, None) if path does not exist."""
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        file_paths = sorted(os.path.join(dir_path, file_name)
+                            for dir_path, _, file_names in os.walk(path) for file_name in file_names)
+        return (path, [get_file_identity(file_path, use_hash)[1:] for file_path in file_paths])
+    if not os.path.exists(path):
+        return (path, None)
+    if use_hash:
+        file_hash = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                file_hash.update(block)
+        return (path, file_hash.hexdigest())
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+
+def get_step_key(step_name, input_paths, params=None, use_hash=False):
+    """Returns a hex digest identifying a processing step from its name, the identities of its inputs and a dict of
+    any parameters that affect its output (model path, buffer size, epsg, ect). If any of these change, so does the key.
+    None entries in input_paths are ignored."""
+    identities = [get_file_identity(path, use_hash) for path in input_paths if path is not None]
+    if params is None:
+        params = {}
+    key_source = json.dumps([step_name, identities, sorted((str(k), str(v)) for k, v in params.items())])
+    return hashlib.sha1(key_source.encode("utf-8")).hexdigest()
+
+
+def open_processing_cache(cache_path):
+    """Opens (creating if needed) the sqlite processing cache at cache_path and returns the connection"""
+    connection = sqlite3.connect(cache_path, timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS steps "
+                       "(out_path TEXT PRIMARY KEY, step_name TEXT, step_key TEXT, created TEXT)")
+    return connection
+
+
+def is_step_cached(cache_path, out_paths, step_name, step_key, adopt_existing=True):
+    """Returns True if every path in out_paths exists and was recorded in the processing cache at cache_path by a step
+    with step_key. If adopt_existing is True, outputs that exist but have never been recorded (eg made before the cache
+    was in use) are recorded with step_key and treated as up to date. Always returns False if cache_path is None."""
+    log = logging.getLogger(__name__)
+    if cache_path is None:
+        return False
+    if not all(os.path.exists(out_path) for out_path in out_paths):
+        return False
+    connection = open_processing_cache(cache_path)
+    try:
+        unrecorded = []
+        for out_path in out_paths:
+            row = connection.execute("SELECT step_key FROM steps WHERE out_path = ?",
+                                     (os.path.abspath(out_path),)).fetchone()
+            if row is None:
+                unrecorded.append(out_path)
+            elif row[0] != step_key:
+                log.info("Inputs or parameters of {} for {} have changed".format(step_name, out_path))
+                return False
+    finally:
+        connection.close()
+    if unrecorded:
+        if not adopt_existing:
+            return False
+        log.info("Adding existing outputs {} to processing cache".format(unrecorded))
+        record_step(cache_path, unrecorded, step_name, step_key)
+    return True
+
+
+def record_step(cache_path, out_paths, step_name, step_key):
+    """Records in the processing cache at cache_path that out_paths were produced by step_name with step_key.
+    Does nothing if cache_path is None."""
+    if cache_path is None:
+        return
+    connection = open_processing_cache(cache_path)
+    try:
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?)",
+                                   [(os.path.abspath(out_path), step_name, step_key, dt.datetime.now().isoformat())
+                                    for out_path in out_paths])
+    finally:
+        connection.close()
+
+
+def get_scene_catalog_path(root):
+    """Returns the path to the scene catalog of the AOI at root"""
+    return os.path.join(root, "scene_catalog.db")
+
+
+def open_scene_catalog(catalog_path):
+    """Opens (creating if needed) the sqlite scene catalog at catalog_path and returns the connection.
+    The catalog holds one row per Sentinel 2 product or derived file, indexed by directory, tile and timestamp."""
+    connection = sqlite3.connect(catalog_path, timeout=60)
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS scenes "
+                           "(path TEXT PRIMARY KEY, directory TEXT, name TEXT, tile TEXT, orbit TEXT, "
+                           "timestamp TEXT, level TEXT, state TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS scenes_by_directory ON scenes (directory, timestamp)")
+        connection.execute("CREATE INDEX IF NOT EXISTS scenes_by_tile ON scenes (tile, timestamp)")
+        connection.execute("CREATE TABLE IF NOT EXISTS directories (directory TEXT PRIMARY KEY, mtime INTEGER)")
+    return connection
+
+
+def get_scene_catalog_row(image_path, state=None):
+    """Returns the catalog row for the product or derived file at image_path, or None if its name has no timestamp"""
+    name = os.path.basename(image_path.rstrip("/"))
+    product_name = parse_sen_2_name(name)
+    if product_name.timestamp is None:
+        return None
+    return (os.path.abspath(image_path), os.path.abspath(os.path.dirname(image_path)), name,
+            product_name.tile, product_name.orbit, product_name.timestamp, product_name.level, state)
+
+
+def update_scene_catalog(catalog_path, directory, state=None):
+    """Brings the catalog entries for directory up to date, tagging new entries with state. The directory is only
+    listed if its modification time has changed since the last update."""
+    log = logging.getLogger(__name__)
+    directory = os.path.abspath(directory)
+    mtime = os.stat(directory).st_mtime_ns
+    connection = open_scene_catalog(catalog_path)
+    try:
+        row = connection.execute("SELECT mtime FROM directories WHERE directory = ?", (directory,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return
+        log.info("Updating scene catalog for {}".format(directory))
+        rows = [get_scene_catalog_row(os.path.join(directory, name), state) for name in os.listdir(directory)]
+        rows = [row for row in rows if row is not None]
+        # Coarse mtimes on shared filesystems can hide changes made in the same second as this scan, so don't trust
+        # a directory modified in the last couple of seconds to be unchanged next time.
+        if time.time() - mtime / 1e9 < 2:
+            mtime = None
+        with connection:
+            connection.execute("CREATE TEMP TABLE present (path TEXT PRIMARY KEY)")
+            connection.executemany("INSERT INTO present VALUES (?)", [(row[0],) for row in rows])
+            connection.execute("DELETE FROM scenes WHERE directory = ? AND path NOT IN (SELECT path FROM present)",
+                               (directory,))
+            connection.executemany("INSERT OR IGNORE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (directory, mtime))
+            connection.execute("DROP TABLE present")
+    finally:
+        connection.close()
+
+
+def set_scene_state(catalog_path, image_path, state):
+    """Records the processing state of a product or derived file in the catalog"""
+    connection = open_scene_catalog(catalog_path)
+    try:
+        with connection:
+            row = get_scene_catalog_row(image_path, state)
+            if row is None:
+                raise ValueError("{} has no Sentinel 2 timestamp".format(image_path))
+            connection.execute("INSERT OR IGNORE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+            connection.execute("UPDATE scenes SET state = ? WHERE path = ?", (state, row[0]))
+    finally:
+        connection.close()
+
+
+def query_scene_catalog(catalog_path, directory=None, tile=None, timestamp=None, before=None, level=None,
+                        extension=None, recent_first=True, limit=None):
+    """Returns a list of paths from the scene catalog, sorted by timestamp. Any of directory, tile, timestamp, level
+    (L1C or L2A) or extension (eg '.tif') narrow the search; before returns only entries older than that S2 timestamp.
+    If directory is given, it is brought up to date first."""
+    if directory:
+        directory = os.path.abspath(directory)
+        update_scene_catalog(catalog_path, directory)
+    conditions = []
+    values = []
+    for column, value in (("directory", directory), ("tile", tile), ("timestamp", timestamp), ("level", level)):
+        if value is not None:
+            conditions.append("{} = ?".format(column))
+            values.append(value)
+    if before is not None:
+        conditions.append("timestamp < ?")
+        values.append(before)
+    if extension is not None:
+        conditions.append("name LIKE ?")
+        values.append("%" + extension)
+    query = "SELECT path FROM scenes"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY timestamp {}".format("DESC" if recent_first else "ASC")
+    if limit is not None:
+        query += " LIMIT {}".format(int(limit))
+    connection = open_scene_catalog(catalog_path)
+    try:
+        return [row[0] for row in connection.execute(query, values)]
+    finally:
+        connection.close()
+
+
+def run_pipeline(items, stages, ordered_func=None, order_key=None):
+    """
+    Runs each of items through a chain of stages, each stage with its own bounded pool of worker threads, so that an
+    item moves on to its next stage as soon as it is ready rather than waiting for the rest of the batch.
+
+    Parameters
+    ----------
+    items : list
+        The inputs to the first stage, eg products from a Sentinel_2 query
+
+    stages : list of (str, function, int) tuples
+        The name, function and number of workers of each stage. Each function is given the output of the previous
+        stage for an item; if it returns None or raises, that item is dropped from the rest of the pipeline.
+
+    ordered_func : function (optional)
+        A final stage run in the calling thread for each item that made it through every stage, in the order given
+        by order_key. An item is passed to ordered_func as soon as it and every item before it are done, so this can
+        carry state (eg a composite) from one item to the next.
+
+    order_key : function (optional)
+        Called on each of items to give the order for ordered_func; defaults to the order of items.
+
+    Returns
+    -------
+    A list with the result of the last stage (or ordered_func) for each item in order, with None for failed items
+    """
+    log = logging.getLogger(__name__)
+    pools = [concurrent.futures.ThreadPoolExecutor(max_workers=workers) for _, _, workers in stages]
+    finished = [concurrent.futures.Future() for _ in items]
+
+    def run_stage(stage_index, item_index, value):
+        stage_name, stage_func, _ = stages[stage_index]
+        try:
+            result = stage_func(value)
+        except Exception:
+            log.exception("Pipeline stage {} failed for {}".format(stage_name, items[item_index]))
+            result = None
+        if result is None:
+            log.warning("Dropping {} from pipeline after stage {}".format(items[item_index], stage_name))
+            finished[item_index].set_result(None)
+        elif stage_index + 1 == len(stages):
+            finished[item_index].set_result(result)
+        else:
+            pools[stage_index + 1].submit(run_stage, stage_index + 1, item_index, result)
+
+    try:
+        for item_index, item in enumerate(items):
+            pools[0].submit(run_stage, 0, item_index, item)
+        order = list(range(len(items)))
+        if order_key:
+            order.sort(key=lambda item_index: order_key(items[item_index]))
+        results = [None]*len(items)
+        for item_index in order:
+            result = finished[item_index].result()
+            if result is not None and ordered_func:
+                try:
+                    result = ordered_func(result)
+                except Exception:
+                    log.exception("Ordered pipeline stage failed for {}".format(items[item_index]))
+                    result = None
+            results[item_index] = result
+    finally:
+        for pool in pools:
+            pool.shutdown(wait=True)
+    return results
 
 
 def read_aoi(aoi_path):
@@ -175,14 +606,18 @@ def read_aoi(aoi_path):
         return aoi_dict
 
 
-def check_for_new_s2_data(aoi_path, aoi_image_dir, conf):
-    """Checks the S2 API for new data; if it's there, return the result"""
+def check_for_new_s2_data(aoi_path, aoi_image_dir, conf, catalog_path=None):
+    """Checks the S2 API for new data; if it's there, return the result. If catalog_path is given, the date of the
+    last downloaded image is looked up in that scene catalog."""
     # set up API for query
     log = logging.getLogger(__name__)
     user = conf['sent_2']['user']
     password = conf['sent_2']['pass']
     # Get last downloaded map date
-    file_list = os.listdir(aoi_image_dir)
+    if catalog_path:
+        file_list = query_scene_catalog(catalog_path, directory=aoi_image_dir, limit=1)
+    else:
+        file_list = os.listdir(aoi_image_dir)
     datetime_regex = r"\d{8}T\d{6}"     # Regex that matches an S2 timestamp
     date_matches = re.finditer(datetime_regex, file_list.__str__())
     try:
@@ -191,7 +626,8 @@ def check_for_new_s2_data(aoi_path, aoi_image_dir, conf):
         # Do the query
         result = sent2_query(user, password, aoi_path,
                              last_date.isoformat(timespec='seconds')+'Z',
-                             dt.datetime.today().isoformat(timespec='seconds')+'Z')
+                             dt.datetime.today().isoformat(timespec='seconds')+'Z',
+                             api=get_sentinel_api(user, password))
         return result
     except ValueError:
         log.error("aoi_image_dir empty, please add a starting image")
@@ -205,53 +641,360 @@ def check_for_s2_data_by_date(aoi_path, start_date, end_date, conf, cloud_cover=
     password = conf['sent_2']['pass']
     start_timestamp = dt.datetime.strptime(start_date, '%Y%m%d').isoformat(timespec='seconds')+'Z'
     end_timestamp = dt.datetime.strptime(end_date, '%Y%m%d').isoformat(timespec='seconds')+'Z'
-    result = sent2_query(user, password, aoi_path, start_timestamp, end_timestamp, cloud=cloud_cover)
+    result = sent2_query(user, password, aoi_path, start_timestamp, end_timestamp, cloud=cloud_cover,
+                         api=get_sentinel_api(user, password))
     log.info("Search returned {} images".format(len(result)))
     return result
 
 
-def download_s2_data(new_data, out_folder, l2_dir=None, source='scihub', user=None, passwd=None):
-    """Downloads S2 imagery from AWS, google_cloud or scihub. new_data is a dict from Sentinel_2. If l2_dir is given,
-    will check that directory for existing imagery and skip if exists."""
+def get_aoi_geometry(aoi_path):
+    """Returns the geometry of the aoi geojson at aoi_path as an ogr geometry"""
+    aoi = read_aoi(aoi_path)
+    return ogr.CreateGeometryFromJson(json.dumps(aoi.get("geometry", aoi)))
+
+
+def get_aoi_overlap_fraction(product, aoi_geometry):
+    """Returns the fraction (0 to 1) of aoi_geometry covered by the footprint of a product from sent2_query"""
+    footprint = ogr.CreateGeometryFromWkt(product['footprint'])
+    aoi_area = aoi_geometry.GetArea()
+    if aoi_area == 0:
+        return 0
+    return footprint.Intersection(aoi_geometry).GetArea()/aoi_area
+
+
+def get_quicklook_from_scihub(api, product_uuid, out_folder):
+    """Downloads the quicklook jpeg of product_uuid with the SentinelAPI api. Returns its path."""
+    quicklook_url = api.api_url + "odata/v1/Products('{}')/Products('Quicklook')/$value".format(product_uuid)
+    out_path = os.path.join(out_folder, product_uuid + "_quicklook.jpg")
+    with api.session.get(quicklook_url, auth=api.session.auth) as response:
+        response.raise_for_status()
+        with open(out_path, 'wb') as out_file:
+            out_file.write(response.content)
+    return out_path
+
+
+def estimate_aoi_cloud_cover(quicklook_path, footprint_wkt, aoi_geometry, brightness_threshold=200):
+    """Estimates the percentage of the aoi that is cloudy in a product from its quicklook. Pixels where every band
+    is at least brightness_threshold count as cloud; black (no data) pixels are ignored. The quicklook is assumed
+    to span the bounding box of the footprint, so this is an estimate, not a cloud mask.
+    Returns None if the footprint does not overlap the aoi, or the aoi does not fall on any valid quicklook pixels."""
+    footprint = ogr.CreateGeometryFromWkt(footprint_wkt)
+    fp_x_min, fp_x_max, fp_y_min, fp_y_max = footprint.GetEnvelope()
+    aoi_overlap = footprint.Intersection(aoi_geometry)
+    if aoi_overlap is None or aoi_overlap.IsEmpty():
+        return None
+    aoi_x_min, aoi_x_max, aoi_y_min, aoi_y_max = aoi_overlap.GetEnvelope()
+    quicklook = gdal.Open(quicklook_path)
+    if quicklook is None:
+        raise OSError("Could not open quicklook {}".format(quicklook_path))
+    x_scale = quicklook.RasterXSize/(fp_x_max - fp_x_min)
+    y_scale = quicklook.RasterYSize/(fp_y_max - fp_y_min)
+    # Keep the window on the quicklook
+    x_off = min(max(0, int(np.floor((aoi_x_min - fp_x_min)*x_scale))), quicklook.RasterXSize - 1)
+    y_off = min(max(0, int(np.floor((fp_y_max - aoi_y_max)*y_scale))), quicklook.RasterYSize - 1)
+    x_size = max(1, min(quicklook.RasterXSize - x_off, int(np.ceil((aoi_x_max - aoi_x_min)*x_scale))))
+    y_size = max(1, min(quicklook.RasterYSize - y_off, int(np.ceil((aoi_y_max - aoi_y_min)*y_scale))))
+    window = quicklook.ReadAsArray(x_off, y_off, x_size, y_size)
+    quicklook = None
+    if window.ndim == 2:
+        window = window[np.newaxis, ...]
+    valid = np.any(window > 0, axis=0)
+    if not valid.any():
+        return None
+    cloudy = np.all(window >= brightness_threshold, axis=0)
+    return 100*np.count_nonzero(cloudy)/np.count_nonzero(valid)
+
+
+def filter_by_aoi_coverage(products, aoi_path, min_overlap=0, max_aoi_cloud=None, user=None, passwd=None,
+                           quicklook_dir=None, brightness_threshold=200):
+    """
+    Removes products from the results of sent2_query that cover too little of the aoi, or that are too cloudy over
+    it, before they are downloaded.
+
+    Parameters
+    ----------
+    products : dict
+        Products from sent2_query, keyed by uuid.
+    aoi_path : str
+        Path to the aoi geojson.
+    min_overlap : float, optional
+        The minimum fraction (0 to 1) of the aoi that a product's footprint must cover.
+    max_aoi_cloud : float, optional
+        If given, the quicklook of each product is downloaded from scihub with user and passwd and the cloud cover
+        over the aoi estimated with estimate_aoi_cloud_cover. Products more cloudy than this percentage are removed.
+        If a quicklook can't be downloaded, the whole-tile cloudcoverpercentage is used instead.
+    user, passwd : str, optional
+        Scihub credentials; needed if max_aoi_cloud is given.
+    quicklook_dir : str, optional
+        Where to keep downloaded quicklooks. If not given, they are deleted after use.
+    brightness_threshold : int, optional
+        See estimate_aoi_cloud_cover.
+
+    Returns
+    -------
+    An OrderedDict of the remaining products. Each has 'aoi_overlap' set, and 'aoi_cloud' if max_aoi_cloud is given.
+    """
     log = logging.getLogger(__name__)
-    for image_uuid in new_data:
-        l1_path = os.path.join(out_folder, new_data[image_uuid]['identifier'])
-        if check_for_invalid_l1_data(l1_path) == 1:
-            log.info("L1 imagery exists, skipping download")
-            continue
-        if l2_dir:
-            l2_path = os.path.join(l2_dir, new_data[image_uuid]['identifier'].replace("MSIL1C", "MSIL2A")+".SAFE")
-            log.info("Checking {} for existing L2 imagery".format(l2_path))
-            if os.path.isdir(l2_path):
-                log.info("L2 imagery exists, skipping download.")
-                continue
-        log.info("Downloading {} from {}".format(new_data[image_uuid]['identifier'], source))
-        if source=='aws':
-            download_safe_format(product_id=new_data[image_uuid]['identifier'], folder=out_folder)
-        elif source=='google':
-            download_from_google_cloud([new_data[image_uuid]['identifier']], out_folder=out_folder)
-        elif source=="scihub":
-            download_from_scihub(image_uuid, out_folder, user, passwd)
+    aoi_geometry = get_aoi_geometry(aoi_path)
+    out = collections.OrderedDict()
+    with TemporaryDirectory() as td:
+        if quicklook_dir:
+            os.makedirs(quicklook_dir, exist_ok=True)
         else:
-            log.error("Invalid data source; valid values are 'aws', 'google' and 'scihub'")
-            raise BadDataSourceExpection
+            quicklook_dir = td
+        for product_uuid, product in products.items():
+            product['aoi_overlap'] = get_aoi_overlap_fraction(product, aoi_geometry)
+            if product['aoi_overlap'] < min_overlap:
+                log.info("Skipping {}; covers {:.1%} of the aoi".format(product['identifier'], product['aoi_overlap']))
+                continue
+            if max_aoi_cloud is not None:
+                product['aoi_cloud'] = None
+                if product['aoi_overlap'] == 0:
+                    log.info("{} does not overlap the aoi; not fetching its quicklook".format(product['identifier']))
+                else:
+                    try:
+                        quicklook_path = get_quicklook_from_scihub(get_sentinel_api(user, passwd), product_uuid,
+                                                                   quicklook_dir)
+                        product['aoi_cloud'] = estimate_aoi_cloud_cover(quicklook_path, product['footprint'],
+                                                                        aoi_geometry, brightness_threshold)
+                    except (requests.RequestException, OSError, RuntimeError) as e:
+                        log.warning("Could not get quicklook for {}: {}".format(product['identifier'], e))
+                if product['aoi_cloud'] is None:
+                    product['aoi_cloud'] = float(product['cloudcoverpercentage'])
+                if product['aoi_cloud'] > max_aoi_cloud:
+                    log.info("Skipping {}; {:.1f}% cloud over the aoi".format(product['identifier'],
+                                                                              product['aoi_cloud']))
+                    continue
+            out[product_uuid] = product
+    log.info("{} of {} products kept after aoi coverage filter".format(len(out), len(products)))
+    return out
 
 
-def download_from_scihub(product_uuid, out_folder, user, passwd):
-    """Downloads and unzips product_uuid from scihub"""
+def download_s2_data(new_data, out_folder, l2_dir=None, source='scihub', user=None, passwd=None,
+                     extract_mode="extract"):
+    """Downloads S2 imagery from AWS, google_cloud or scihub. new_data is a dict from Sentinel_2. If l2_dir is given,
+    will check that directory for existing imagery and skip if exists. See download_from_scihub for extract_mode."""
+    for image_uuid in new_data:
+        download_s2_product(image_uuid, new_data[image_uuid], out_folder, l2_dir, source, user, passwd, extract_mode)
+
+
+def download_s2_product(image_uuid, product, out_folder, l2_dir=None, source='scihub', user=None, passwd=None,
+                        extract_mode="extract"):
+    """Downloads a single S2 product (an entry from a Sentinel_2 query) from AWS, google_cloud or scihub, skipping
+    it if the L1 imagery, or L2 imagery in l2_dir, already exists. Returns the path to the L1 .SAFE directory
+    (out_folder/<identifier>.SAFE, which may not exist if the download was skipped for existing L2 imagery), or to
+    the zip if downloading from scihub with extract_mode='zip'."""
     log = logging.getLogger(__name__)
-    api = SentinelAPI(user, passwd)
+    # The .SAFE suffix is part of the directory name; check_for_invalid_l1_data rejects paths without it
+    l1_path = os.path.join(out_folder, product['identifier'] + ".SAFE")
+    if check_for_invalid_l1_data(l1_path) == 1:
+        log.info("L1 imagery exists, skipping download")
+        return l1_path
+    if l2_dir:
+        l2_path = os.path.join(l2_dir, product['identifier'].replace("MSIL1C", "MSIL2A")+".SAFE")
+        log.info("Checking {} for existing L2 imagery".format(l2_path))
+        if os.path.isdir(l2_path):
+            log.info("L2 imagery exists, skipping download.")
+            return l1_path
+    log.info("Downloading {} from {}".format(product['identifier'], source))
+    if source=='aws':
+        download_safe_format(product_id=product['identifier'], folder=out_folder)
+    elif source=='google':
+        download_from_google_cloud([product['identifier']], out_folder=out_folder)
+    elif source=="scihub":
+        return download_from_scihub(image_uuid, out_folder, user, passwd, extract_mode)
+    else:
+        log.error("Invalid data source; valid values are 'aws', 'google' and 'scihub'")
+        raise BadDataSourceExpection
+    return l1_path
+
+
+def download_from_scihub(product_uuid, out_folder, user, passwd, extract_mode="extract"):
+    """Downloads product_uuid from scihub. extract_mode can be:
+    'extract': download the zip, then unzip it into out_folder and delete it
+    'stream': unzip each file into out_folder as it arrives, never writing the zip to disk
+    'zip': keep the zip without unzipping; bands can be read from it with gdal's /vsizip/
+    Returns the path to the .SAFE directory, or to the zip if extract_mode is 'zip'"""
+    log = logging.getLogger(__name__)
+    api = get_sentinel_api(user, passwd)
+    if extract_mode == "stream":
+        return stream_from_scihub(api, product_uuid, out_folder)
     log.info("Downloading {} from scihub".format(product_uuid))
     prod = api.download(product_uuid, out_folder)
     if not prod:
         log.error("{} failed to download".format(product_uuid))
     zip_path = os.path.join(out_folder, prod['title']+".zip")
+    if extract_mode == "zip":
+        return zip_path
     log.info("Unzipping {} to {}".format(zip_path, out_folder))
     zip_ref = zipfile.ZipFile(zip_path, 'r')
     zip_ref.extractall(out_folder)
     zip_ref.close()
     log.info("Removing {}".format(zip_path))
     os.remove(zip_path)
+    return os.path.join(out_folder, prod['title']+".SAFE")
+
+
+def stream_from_scihub(api, product_uuid, out_folder, chunk_size=2**20):
+    """Downloads product_uuid with the SentinelAPI api, unzipping into out_folder as the download arrives.
+    Checks the md5 of the download against scihub's. Returns the path to the .SAFE directory."""
+    log = logging.getLogger(__name__)
+    product_info = api.get_product_odata(product_uuid)
+    log.info("Streaming {} from scihub into {}".format(product_info['title'], out_folder))
+    md5 = hashlib.md5()
+
+    def checked_chunks(response):
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            md5.update(chunk)
+            yield chunk
+
+    # Extract into a scratch directory next to the product, so nothing half-written is left in out_folder if the
+    # download or the checksum fails
+    with TemporaryDirectory(prefix=".partial_", dir=out_folder) as partial_dir:
+        with api.session.get(product_info['url'], stream=True, auth=api.session.auth) as response:
+            response.raise_for_status()
+            stream_extract_zip(checked_chunks(response), partial_dir)
+        if md5.hexdigest().lower() != product_info['md5'].lower():
+            log.error("md5 of {} does not match scihub's".format(product_uuid))
+            raise BadS2Exception("Checksum failed for {}".format(product_uuid))
+        for name in os.listdir(partial_dir):
+            out_path = os.path.join(out_folder, name)
+            if os.path.isdir(out_path):
+                shutil.rmtree(out_path)
+            os.replace(os.path.join(partial_dir, name), out_path)
+    return os.path.join(out_folder, product_info['title']+".SAFE")
+
+
+class ZipStreamReader:
+    """Reads exact numbers of bytes from an iterable of byte chunks, allowing unused bytes to be pushed back"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read(self, size=None):
+        """Returns size bytes, or all the bytes in the next chunk if size is None. Returns fewer at the end."""
+        if size is None:
+            if not self.buffer:
+                self.buffer = next(self.chunks, b"")
+            out, self.buffer = self.buffer, b""
+            return out
+        pieces = [self.buffer]
+        have = len(self.buffer)
+        while have < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            pieces.append(chunk)
+            have += len(chunk)
+        data = b"".join(pieces)
+        out, self.buffer = data[:size], data[size:]
+        return out
+
+    def read_exactly(self, size):
+        out = self.read(size)
+        if len(out) != size:
+            raise zipfile.BadZipFile("Zip stream ended early")
+        return out
+
+    def push_back(self, data):
+        self.buffer = data + self.buffer
+
+    def drain(self):
+        for _ in self.chunks:
+            pass
+
+
+def copy_zip_member(reader, method, compressed_size, has_descriptor, out_file, name):
+    """Copies the data of one zip member from a ZipStreamReader into out_file (or discards it if out_file is None),
+    decompressing if needed. Returns the crc32 of the uncompressed data."""
+    running_crc = 0
+    if method == zipfile.ZIP_STORED:
+        if has_descriptor and compressed_size == 0 and not name.endswith("/"):
+            raise zipfile.BadZipFile("Cannot stream stored member {} with unknown size".format(name))
+        remaining = compressed_size
+        while remaining:
+            data = reader.read(min(remaining, 2**20))
+            if not data:
+                raise zipfile.BadZipFile("Zip stream ended early")
+            remaining -= len(data)
+            running_crc = zlib.crc32(data, running_crc)
+            if out_file:
+                out_file.write(data)
+    elif method == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+        remaining = None if has_descriptor else compressed_size
+        while not decompressor.eof:
+            data = reader.read(None if remaining is None else min(remaining, 2**20))
+            if not data:
+                raise zipfile.BadZipFile("Zip stream ended early")
+            if remaining is not None:
+                remaining -= len(data)
+            out_data = decompressor.decompress(data)
+            running_crc = zlib.crc32(out_data, running_crc)
+            if out_file:
+                out_file.write(out_data)
+        reader.push_back(decompressor.unused_data)
+    else:
+        raise zipfile.BadZipFile("Unsupported compression method {} for {}".format(method, name))
+    return running_crc
+
+
+def stream_extract_zip(chunks, out_folder):
+    """Extracts a zip archive into out_folder from an iterable of byte chunks (eg a streamed download) as they
+    arrive, using the local file headers instead of the central directory at the end of the archive.
+    Handles stored and deflated members, zip64 sizes and data descriptors. Returns a list of extracted paths."""
+    log = logging.getLogger(__name__)
+    reader = ZipStreamReader(chunks)
+    out_folder = os.path.abspath(out_folder)
+    extracted = []
+    while True:
+        signature = reader.read(4)
+        if signature != b"PK\x03\x04":
+            break   # Central directory (or end of stream); all files are out
+        (_, flags, method, _, _, crc, compressed_size, size, name_length, extra_length) = \
+            struct.unpack("<HHHHHIIIHH", reader.read_exactly(26))
+        name = reader.read_exactly(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = reader.read_exactly(extra_length)
+        zip64 = False
+        while len(extra) >= 4:
+            header_id, data_size = struct.unpack("<HH", extra[:4])
+            if header_id == 0x0001:
+                # The zip64 field holds 8 byte sizes in the order below, each only present if the matching header
+                # field is 0xFFFFFFFF
+                zip64 = True
+                zip64_fields = extra[4:4 + data_size]
+                field_offset = 0
+                if size == 0xFFFFFFFF:
+                    size = struct.unpack_from("<Q", zip64_fields, field_offset)[0]
+                    field_offset += 8
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = struct.unpack_from("<Q", zip64_fields, field_offset)[0]
+                    field_offset += 8
+            extra = extra[4 + data_size:]
+        has_descriptor = flags & 0x08
+        out_path = os.path.abspath(os.path.join(out_folder, name))
+        if not out_path.startswith(out_folder + os.sep):
+            raise zipfile.BadZipFile("{} would extract outside {}".format(name, out_folder))
+        if name.endswith("/"):
+            os.makedirs(out_path, exist_ok=True)
+            running_crc = copy_zip_member(reader, method, compressed_size, has_descriptor, None, name)
+        else:
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            with open(out_path, 'wb') as out_file:
+                running_crc = copy_zip_member(reader, method, compressed_size, has_descriptor, out_file, name)
+        if has_descriptor:
+            descriptor = reader.read_exactly(4)
+            if descriptor == b"PK\x07\x08":
+                descriptor = reader.read_exactly(4)
+            crc = struct.unpack("<I", descriptor)[0]
+            reader.read_exactly(16 if zip64 else 8)
+        if running_crc & 0xFFFFFFFF != crc:
+            raise zipfile.BadZipFile("CRC check failed for {}".format(name))
+        extracted.append(out_path)
+    reader.drain()
+    log.info("Extracted {} files to {}".format(len(extracted), out_folder))
+    return extracted
 
 
 # @tenacity.retry(
@@ -415,7 +1158,7 @@ def do_saved_search(session, search_request):
     search_response = session.post(search_url, json=search_request)
     search_id = search_response.json()['id']
     if search_response.json()['_links'].get('_next_url'):
-        return get_paginated_items(session)
+        return get_paginated_items(session, search_id)
     else:
         search_url = "https://api-planet.com/data/v1/searches/{}/results".format(search_id)
         response = session.get(search_url)
@@ -424,14 +1167,24 @@ def do_saved_search(session, search_request):
 
 
 def get_paginated_items(session, search_id):
-    """Let's leave this out for now."""
-    raise Exception("pagination not handled yet")
+    """Returns every item from a saved search, following the pages of results"""
+    search_url = "https://api.planet.com/data/v1/searches/{}/results".format(search_id)
+    items = []
+    while search_url:
+        page = session.get(search_url).json()
+        items.extend(page["features"])
+        search_url = page["_links"].get("_next") if page["features"] else None
+    return items
 
 
 class TooManyRequests(requests.RequestException):
     """Too many requests; do exponential backoff"""
 
 
+class PlanetActivationException(ForestSentinelException):
+    """A Planet asset did not become active in time"""
+
+
 @tenacity.retry(
     wait=tenacity.wait_exponential(),
     stop=tenacity.stop_after_delay(10000),
@@ -467,6 +1220,154 @@ def activate_and_dl_planet_item(session, item, asset_type, file_path):
         log.info("Item {} download complete".format(item_id))
 
 
+PLANET_URL = "https://api.planet.com/data/v1/"
+
+
+class BandwidthLimiter:
+    """A token bucket shared between asyncio downloads to keep their total rate under max_bytes_per_second.
+    If max_bytes_per_second is None, does not limit."""
+
+    def __init__(self, max_bytes_per_second=None):
+        self.rate = max_bytes_per_second
+        self.allowance = max_bytes_per_second
+        self.last_check = time.monotonic()
+
+    async def consume(self, n_bytes):
+        """Waits until n_bytes can be transferred without going over the rate"""
+        if not self.rate:
+            return
+        while True:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last_check)*self.rate)
+            self.last_check = now
+            if self.allowance >= min(n_bytes, self.rate):
+                self.allowance -= n_bytes
+                return
+            await asyncio.sleep((min(n_bytes, self.rate) - self.allowance)/self.rate)
+
+
+async def planet_request_with_backoff(session, method, url, max_wait=60, max_attempts=10, json_response=True,
+                                      **kwargs):
+    """Makes a request, backing off exponentially (up to max_wait seconds) while Planet returns 429, for at most
+    max_attempts requests. Returns the decoded json response, or None if json_response is False.
+    Raises TooManyRequests if Planet is still returning 429 after max_attempts."""
+    log = logging.getLogger(__name__)
+    wait = 1
+    for attempt in range(max_attempts):
+        async with session.request(method, url, **kwargs) as response:
+            if response.status != 429:
+                response.raise_for_status()
+                if json_response:
+                    return await response.json()
+                return None
+        if attempt < max_attempts - 1:
+            log.warning("Too many requests to {}; backing off for {}s".format(url, wait))
+            await asyncio.sleep(wait)
+            wait = min(wait*2, max_wait)
+    raise TooManyRequests("Still too many requests to {} after {} attempts".format(url, max_attempts))
+
+
+async def planet_search_async(session, search_request, planet_url=PLANET_URL):
+    """Runs a quick search and returns every item found, following pagination"""
+    search_request = dict(search_request)
+    search_request.pop("name", None)
+    page = await planet_request_with_backoff(session, "POST", planet_url + "quick-search", json=search_request)
+    items = list(page["features"])
+    while page["features"] and page["_links"].get("_next"):
+        page = await planet_request_with_backoff(session, "GET", page["_links"]["_next"])
+        items.extend(page["features"])
+    return items
+
+
+async def activate_and_dl_planet_item_async(session, item, asset_type, file_path, download_slots, bandwidth_limiter,
+                                            planet_url=PLANET_URL, max_wait=60, max_polls=100):
+    """Activates a single planet item, polls until it is active with its own exponential backoff, then streams it to
+    file_path once one of download_slots is free. Returns the path to the downloaded image.
+    Raises PlanetActivationException if the item is not active after max_polls polls."""
+    log = logging.getLogger(__name__)
+    item_id = item["id"]
+    item_type = item["properties"]["item_type"]
+    item_url = planet_url + "item-types/{}/items/{}/assets/".format(item_type, item_id)
+    assets = await planet_request_with_backoff(session, "GET", item_url, max_wait)
+    log.info("Activating " + item_id)
+    await planet_request_with_backoff(session, "POST", assets[asset_type]["_links"]["activate"], max_wait,
+                                      json_response=False)
+    wait = 1
+    polls = 0
+    while assets[asset_type]["status"] != "active":
+        if polls == max_polls:
+            raise PlanetActivationException("{} was not active after {} polls".format(item_id, max_polls))
+        await asyncio.sleep(wait)
+        wait = min(wait*2, max_wait)
+        assets = await planet_request_with_backoff(session, "GET", item_url, max_wait)
+        polls += 1
+    dl_link = assets[asset_type]["location"]
+    item_fp = os.path.join(file_path, item_id + ".tif")
+    async with download_slots:
+        log.info("Downloading item {} from {} to {}".format(item_id, dl_link, item_fp))
+        async with session.get(dl_link) as image_response:
+            image_response.raise_for_status()
+            with open(item_fp + ".part", 'wb') as fp:
+                async for chunk in image_response.content.iter_chunked(2**16):
+                    await bandwidth_limiter.consume(len(chunk))
+                    fp.write(chunk)
+    os.rename(item_fp + ".part", item_fp)
+    log.info("Item {} download complete".format(item_id))
+    return item_fp
+
+
+async def planet_download_async(api_key, search_request, asset_type, out_path, max_downloads=5, max_bandwidth=None,
+                                planet_url=PLANET_URL, max_polls=100):
+    """Searches Planet and activates and downloads every item found in a single event loop.
+    Returns a list of the downloaded paths, with None for any item that failed."""
+    log = logging.getLogger(__name__)
+    download_slots = asyncio.Semaphore(max_downloads)
+    bandwidth_limiter = BandwidthLimiter(max_bandwidth)
+    async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(api_key, '')) as session:
+        items = await planet_search_async(session, search_request, planet_url)
+        log.info("Search returned {} items".format(len(items)))
+        results = await asyncio.gather(
+            *[activate_and_dl_planet_item_async(session, item, asset_type, out_path, download_slots,
+                                                bandwidth_limiter, planet_url, max_polls=max_polls)
+              for item in items],
+            return_exceptions=True)
+    out_paths = []
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            log.error("Download of {} failed: {}".format(item["id"], result))
+            result = None
+        out_paths.append(result)
+    return out_paths
+
+
+def planet_query_async(aoi_path, start_date, end_date, out_path, api_key, item_type="PSScene4Band", search_name="auto",
+                       asset_type="analytic", max_downloads=5, max_bandwidth=None, planet_url=PLANET_URL):
+    """
+    Downloads data from Planetlabs for a given time period in the given AOI, like planet_query, but with
+    every item activated and polled concurrently in one asyncio event loop. Follows pagination, so is not
+    limited to 250 items.
+
+    Parameters
+    ----------
+    max_downloads : int
+        The number of downloads to stream at once
+
+    max_bandwidth : int
+        The total download rate to stay under, in bytes per second. Unlimited if None.
+
+    See planet_query for the other parameters.
+    """
+    feature = read_aoi(aoi_path)
+    aoi = feature['geometry']
+    search_request = build_search_request(aoi, start_date, end_date, item_type, search_name)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(planet_download_async(api_key, search_request, asset_type, out_path,
+                                                             max_downloads, max_bandwidth, planet_url))
+    finally:
+        loop.close()
+
+
 def apply_sen2cor(image_path, sen2cor_path, delete_unprocessed_image=False):
     """Applies sen2cor to the SAFE file at image_path. Returns the path to the new product."""
     # Here be OS magic. Since sen2cor runs in its own process, Python has to spin around and wait
@@ -524,29 +1425,49 @@ def apply_fmask(in_safe_dir, out_file, fmask_command="fmask_sentinel2Stacked.py"
             break
 
 
-def atmospheric_correction(in_directory, out_directory, sen2cor_path, delete_unprocessed_image=False):
-    """Applies Sen2cor cloud correction to level 1C images"""
-    log = logging.getLogger(__name__)
+def atmospheric_correction(in_directory, out_directory, sen2cor_path, delete_unprocessed_image=False,
+                           cache_path=None):
+    """Applies Sen2cor cloud correction to level 1C images. If cache_path is given, an image is only reprocessed
+    if it or sen2cor_path have changed since its L2 product was recorded in that processing cache."""
     images = [image for image in os.listdir(in_directory)
               if image.startswith('MSIL1C', 4)]
-    # Opportunity for multithreading here
     for image in images:
-        log.info("Atmospheric correction of {}".format(image))
-        image_path = os.path.join(in_directory, image)
-        #image_timestamp = get_sen_2_image_timestamp(image)
-        if glob.glob(os.path.join(out_directory, image.replace("MSIL1C", "MSIL2A"))):
-            log.warning("{} exists. Skipping.".format(image.replace("MSIL1C", "MSIL2A")))
-            continue
-        try:
-            l2_path = apply_sen2cor(image_path, sen2cor_path, delete_unprocessed_image=delete_unprocessed_image)
-        except (subprocess.CalledProcessError, BadS2Exception):
-            log.error("Atmospheric correction failed for {}. Moving on to next image.".format(image))
-            pass
-        else:
-            l2_name = os.path.basename(l2_path)
-            log.info("L2  path: {}".format(l2_path))
-            log.info("New path: {}".format(os.path.join(out_directory, l2_name)))
-            os.rename(l2_path, os.path.join(out_directory, l2_name))
+        atmospheric_correction_of_image(os.path.join(in_directory, image), out_directory, sen2cor_path,
+                                        delete_unprocessed_image, cache_path)
+
+
+def atmospheric_correction_of_image(image_path, out_directory, sen2cor_path, delete_unprocessed_image=False,
+                                    cache_path=None):
+    """Applies Sen2cor cloud correction to a single level 1C image, moving the result into out_directory.
+    Returns the path to the L2 image, or None if correction failed."""
+    log = logging.getLogger(__name__)
+    image = os.path.basename(image_path)
+    log.info("Atmospheric correction of {}".format(image))
+    out_l2_path = os.path.join(out_directory, image.replace("MSIL1C", "MSIL2A"))
+    step_key = None
+    if cache_path:
+        step_key = get_step_key("atmospheric_correction", [image_path], {"sen2cor_path": sen2cor_path})
+        if is_step_cached(cache_path, [out_l2_path], "atmospheric_correction", step_key):
+            log.warning("{} is up to date. Skipping.".format(out_l2_path))
+            return out_l2_path
+        if os.path.exists(out_l2_path):
+            log.info("Removing out of date {}".format(out_l2_path))
+            shutil.rmtree(out_l2_path)
+    elif glob.glob(out_l2_path):
+        log.warning("{} exists. Skipping.".format(image.replace("MSIL1C", "MSIL2A")))
+        return out_l2_path
+    try:
+        l2_path = apply_sen2cor(image_path, sen2cor_path, delete_unprocessed_image=delete_unprocessed_image)
+    except (subprocess.CalledProcessError, BadS2Exception):
+        log.error("Atmospheric correction failed for {}. Moving on to next image.".format(image))
+        return None
+    # The product is always moved to the name derived from the L1 image, so that it is found (and cached) under the
+    # same name on later runs even if sen2cor names it differently
+    log.info("L2  path: {}".format(l2_path))
+    log.info("New path: {}".format(out_l2_path))
+    os.rename(l2_path, out_l2_path)
+    record_step(cache_path, [out_l2_path], "atmospheric_correction", step_key)
+    return out_l2_path
 
 
 def check_for_invalid_l2_data(l2_SAFE_file, resolution="10m"):
@@ -691,11 +1612,14 @@ def create_new_stacks(image_dir, stack_dir):
     return new_images
 
 
-def get_sen_2_tiles(image_dir):
+def get_sen_2_tiles(image_dir, catalog_path=None):
     """
-    gets the list of tiles present in the directory
+    gets the list of tiles present in the directory, looking them up in the scene catalog if catalog_path is given
     """
-    image_files = glob.glob(os.path.join(image_dir, "*.tif"))
+    if catalog_path:
+        image_files = query_scene_catalog(catalog_path, directory=image_dir, extension=".tif")
+    else:
+        image_files = glob.glob(os.path.join(image_dir, "*.tif"))
     if len(image_files) == 0:
         raise CreateNewStacksException("Image_dir is empty")
     else:
@@ -709,26 +1633,31 @@ def get_sen_2_tiles(image_dir):
 def sort_by_timestamp(strings, recent_first=True):
     """Takes a list of strings that contain sen2 timestamps and returns them sorted, most recent first. Does not
     guarantee ordering of strings with the same timestamp. Removes any string that does not contain a timestamp"""
-    strings = list(filter(get_image_acquisition_time, strings))
-    strings.sort(key=lambda x: get_image_acquisition_time(x), reverse=recent_first)
-    return strings
+    timed_strings = [(get_image_acquisition_time(string), string) for string in strings]
+    timed_strings = [timed_string for timed_string in timed_strings if timed_string[0] is not None]
+    timed_strings.sort(key=lambda timed_string: timed_string[0], reverse=recent_first)
+    return [string for _, string in timed_strings]
 
 
 def get_image_acquisition_time(image_name):
     """Gets the datetime object from a .safe filename of a planet image. No test. Returns None if no timestamp present"""
-    try:
-        return dt.datetime.strptime(get_sen_2_image_timestamp(image_name), '%Y%m%dT%H%M%S')
-    except AttributeError:
-        return None
-
-
-def get_preceding_image_path(target_image_name, search_dir):
-    """Gets the path to the image in search_dir preceding the image called image_name"""
+    return parse_sen_2_name(image_name).datetime
+
+
+def get_preceding_image_path(target_image_name, search_dir, catalog_path=None):
+    """Gets the path to the image in search_dir preceding the image called image_name. If catalog_path is given,
+    this is an indexed lookup in the scene catalog instead of a directory listing."""
+    if catalog_path:
+        image_paths = query_scene_catalog(catalog_path, directory=search_dir, extension=".tif", limit=1,
+                                          before=get_sen_2_image_timestamp(os.path.basename(target_image_name)))
+        if not image_paths:
+            raise FileNotFoundError("No image older than {}".format(target_image_name))
+        return os.path.join(search_dir, os.path.basename(image_paths[0]))
     target_time = get_image_acquisition_time(target_image_name)
-    image_paths = sort_by_timestamp(os.listdir(search_dir), recent_first=True) # Sort image list newest first
-    image_paths = filter(is_tif, image_paths)
+    image_paths = filter(is_tif, os.listdir(search_dir))
+    image_paths = sort_by_timestamp(image_paths, recent_first=True) # Sort image list newest first
     for image_path in image_paths:   # Walk through newest to oldest
-        accq_time = get_image_acquisition_time(image_path)   # Get this image time
+        accq_time = get_image_acquisition_time(image_path)   # Get this image time (cached from the sort)
         if accq_time < target_time:   # If this image is older than the target image, return it.
             return os.path.join(search_dir, image_path)
     raise FileNotFoundError("No image older than {}".format(target_image_name))
@@ -742,65 +1671,178 @@ def is_tif(image_string):
         return False
 
 
+def get_safe_root(safe_path):
+    """Returns a path that gdal can open files in the product at safe_path through. safe_path can be an extracted .SAFE
+    directory, a zipped product (read through /vsizip/) or the http(s) URL of either (read through /vsicurl/)."""
+    if safe_path.startswith("http://") or safe_path.startswith("https://"):
+        safe_path = "/vsicurl/" + safe_path
+    elif not safe_path.startswith("/vsi"):
+        safe_path = os.path.abspath(safe_path)
+    if safe_path.endswith(".zip"):
+        zip_root = "/vsizip/" + safe_path
+        safe_dirs = [entry for entry in (gdal.ReadDir(zip_root) or []) if entry.rstrip("/").endswith(".SAFE")]
+        if safe_dirs:
+            return zip_root + "/" + safe_dirs[0].rstrip("/")
+        return zip_root
+    return safe_path.rstrip("/")
+
+
+@functools.lru_cache(maxsize=256)
+def list_virtual_safe_files(safe_root):
+    """Returns a tuple of the paths of every file in a product read through a gdal virtual file system, relative to
+    safe_root. Cached, since listing a remote product can take several requests."""
+    return tuple(entry for entry in (gdal.ReadDirRecursive(safe_root) or []) if not entry.endswith("/"))
+
+
+def glob_safe(safe_path, pattern):
+    """Returns a sorted list of gdal-openable paths to the files in a product matching a glob pattern relative to the
+    top of the .SAFE directory (eg "GRANULE/*/IMG_DATA/R10m/*_B02_10m.jp2"). See get_safe_root for safe_path."""
+    safe_root = get_safe_root(safe_path)
+    if safe_root.startswith("/vsi"):
+        relative_paths = list_virtual_safe_files(safe_root)
+        return sorted(safe_root + "/" + relative_path for relative_path in relative_paths
+                      if fnmatch.fnmatch(relative_path, pattern))
+    return sorted(glob.glob(os.path.join(safe_root, pattern)))
+
+
 def open_dataset_from_safe(safe_file_path, band, resolution = "10m"):
-    """Opens a dataset given a safe file. Give band as a string."""
+    """Opens a dataset given a safe file. Give band as a string. safe_file_path can be a directory, zip or URL;
+    see get_safe_root."""
     image_glob = r"GRANULE/*/IMG_DATA/R{}/*_{}_{}.jp2".format(resolution, band, resolution)
     # edited by hb91
     #image_glob = r"GRANULE/*/IMG_DATA/*_{}.jp2".format(band)
-    fp_glob = os.path.join(safe_file_path, image_glob)
-    image_file_path = glob.glob(fp_glob)
+    image_file_path = glob_safe(safe_file_path, image_glob)
     out = gdal.Open(image_file_path[0])
     return out
 
 
-def preprocess_sen2_images(l2_dir, out_dir, l1_dir, cloud_threshold=60, buffer_size=0, epsg=None):
+def preprocess_sen2_images(l2_dir, out_dir, l1_dir, cloud_threshold=60, buffer_size=0, epsg=None, processes=1,
+                           skip_existing=True, cache_path=None, aoi_path=None):
     """For every .SAFE folder in in_dir, stacks band 2,3,4 and 8  bands into a single geotif, creates a cloudmask from
-    the combined fmask and sen2cor cloudmasks and reprojects to a given EPSG if provided"""
+    the combined fmask and sen2cor cloudmasks and reprojects to a given EPSG if provided.
+    If processes > 1, scenes are processed concurrently in a pool of that many worker processes, each with its own
+    temporary directory. Scenes with an existing merged image and mask in out_dir are skipped if skip_existing is True;
+    if cache_path is also given, they are only skipped if their inputs and parameters match the processing cache.
+    If aoi_path is given, only the window of each scene covering that aoi is processed; see preprocess_sen2_image.
+    Returns a dict of lists of SAFE paths under the keys 'processed', 'skipped' and 'failed'."""
     log = logging.getLogger(__name__)
     safe_file_path_list = [os.path.join(l2_dir, safe_file_path) for safe_file_path in os.listdir(l2_dir)]
-    for l2_safe_file in safe_file_path_list:
-        with TemporaryDirectory() as temp_dir:
-            log.info("----------------------------------------------------")
-            log.info("Merging 10m bands in SAFE dir: {}".format(l2_safe_file))
-            temp_path = os.path.join(temp_dir, get_sen_2_granule_id(l2_safe_file)) + ".tif"
-            log.info("Output file: {}".format(temp_path))
-            stack_sentinel_2_bands(l2_safe_file, temp_path, band='10m')
-
-            #pdb.set_trace()
-
-            log.info("Creating cloudmask for {}".format(temp_path))
-            l1_safe_file = get_l1_safe_file(l2_safe_file, l1_dir)
-            mask_path = get_mask_path(temp_path)
-            create_mask_from_sen2cor_and_fmask(l1_safe_file, l2_safe_file, mask_path, buffer_size=buffer_size)
-            log.info("Cloudmask created")
-
-            out_path = os.path.join(out_dir, os.path.basename(temp_path))
-            out_mask_path = os.path.join(out_dir, os.path.basename(mask_path))
-
-            if epsg:
-                log.info("Reprojecting images to {}".format(epsg))
-                proj = osr.SpatialReference()
-                proj.ImportFromEPSG(epsg)
-                wkt = proj.ExportToWkt()
-                reproject_image(temp_path, out_path, wkt)
-                reproject_image(mask_path, out_mask_path, wkt)
-            else:
-                log.info("Moving images to {}".format(out_dir))
-                shutil.move(temp_path, out_path)
-                shutil.move(mask_path, out_mask_path)
+    scene_args = [(l2_safe_file, out_dir, l1_dir, cloud_threshold, buffer_size, epsg, skip_existing, cache_path,
+                   aoi_path)
+                  for l2_safe_file in safe_file_path_list]
+    log.info("Preprocessing {} scenes with {} processes".format(len(scene_args), processes))
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(preprocess_sen2_image_safely, scene_args)
+    else:
+        results = [preprocess_sen2_image_safely(*args) for args in scene_args]
+    summary = {"processed": [], "skipped": [], "failed": []}
+    for l2_safe_file, status in results:
+        summary[status].append(l2_safe_file)
+    log.info("----------------------------------------------------")
+    log.info("Preprocessing summary: {} processed, {} skipped, {} failed".format(
+        len(summary["processed"]), len(summary["skipped"]), len(summary["failed"])))
+    for l2_safe_file in summary["failed"]:
+        log.error("   Failed: {}".format(l2_safe_file))
+    return summary
+
+
+def preprocess_sen2_image_safely(l2_safe_file, out_dir, l1_dir, cloud_threshold=60, buffer_size=0, epsg=None,
+                                 skip_existing=True, cache_path=None, aoi_path=None):
+    """Calls preprocess_sen2_image, logging instead of raising any errors so that one bad scene does not stop a
+    batch. Returns a tuple of (l2_safe_file, status), where status is 'processed', 'skipped' or 'failed'"""
+    log = logging.getLogger(__name__)
+    try:
+        out_path = preprocess_sen2_image(l2_safe_file, out_dir, l1_dir, cloud_threshold, buffer_size, epsg,
+                                         skip_existing, cache_path, aoi_path)
+    except Exception:
+        log.exception("Preprocessing failed for {}".format(l2_safe_file))
+        return l2_safe_file, "failed"
+    if out_path is None:
+        return l2_safe_file, "skipped"
+    return l2_safe_file, "processed"
+
+
+def preprocess_sen2_image(l2_safe_file, out_dir, l1_dir, cloud_threshold=60, buffer_size=0, epsg=None,
+                          skip_existing=True, cache_path=None, aoi_path=None):
+    """Stacks band 2,3,4 and 8 of a single L2 .SAFE folder into a geotif in out_dir with a cloudmask from the combined
+    fmask and sen2cor cloudmasks, reprojecting to a given EPSG if provided. Works in its own temporary directory.
+    If aoi_path is given, the window of the scene covering the aoi is worked out once (see get_aoi_window) and only
+    that window is merged and masked, so every later stage (stacking, compositing, classification) works on the
+    window instead of the whole tile.
+    Returns the path to the merged image, or None if skip_existing is True and the image and mask already exist
+    (and, if cache_path is given, are up to date in that processing cache) or if the scene does not cover the aoi."""
+    log = logging.getLogger(__name__)
+    image_name = get_sen_2_granule_id(l2_safe_file) + ".tif"
+    out_path = os.path.join(out_dir, image_name)
+    out_mask_path = get_mask_path(out_path)
+    if skip_existing and not cache_path and os.path.exists(out_path) and os.path.exists(out_mask_path):
+        log.info("{} and mask exist, skipping".format(out_path))
+        return None
+    l1_safe_file = get_l1_safe_file(l2_safe_file, l1_dir)
+    step_key = None
+    if cache_path:
+        # Only worth walking the SAFE directories for their identities if there is a cache to check them against
+        step_key = get_step_key("preprocess_sen2_image", [l2_safe_file, l1_safe_file, aoi_path],
+                                {"cloud_threshold": cloud_threshold, "buffer_size": buffer_size, "epsg": epsg})
+    if skip_existing and is_step_cached(cache_path, [out_path, out_mask_path], "preprocess_sen2_image", step_key):
+        log.info("{} and mask are up to date, skipping".format(out_path))
+        return None
+    for stale_path in (out_path, out_mask_path):
+        if os.path.exists(stale_path):
+            log.info("Removing out of date {}".format(stale_path))
+            os.remove(stale_path)
+    window = None
+    if aoi_path:
+        window = get_aoi_window(open_dataset_from_safe(l2_safe_file, "B02"), aoi_path)
+        if window is None:
+            log.warning("{} does not cover {}, skipping".format(l2_safe_file, aoi_path))
+            return None
+        log.info("Processing window {} of {}".format(window, l2_safe_file))
+    with TemporaryDirectory() as temp_dir:
+        log.info("----------------------------------------------------")
+        log.info("Merging 10m bands in SAFE dir: {}".format(l2_safe_file))
+        temp_path = os.path.join(temp_dir, image_name)
+        log.info("Output file: {}".format(temp_path))
+        stack_sentinel_2_bands(l2_safe_file, temp_path, band='10m', window=window)
+
+        log.info("Creating cloudmask for {}".format(temp_path))
+        mask_path = get_mask_path(temp_path)
+        create_mask_from_sen2cor_and_fmask(l1_safe_file, l2_safe_file, mask_path, buffer_size=buffer_size,
+                                           window=window)
+        log.info("Cloudmask created")
+
+        if epsg:
+            log.info("Reprojecting images to {}".format(epsg))
+            proj = osr.SpatialReference()
+            proj.ImportFromEPSG(epsg)
+            wkt = proj.ExportToWkt()
+            reproject_image(temp_path, out_path, wkt)
+            reproject_image(mask_path, out_mask_path, wkt)
+        else:
+            log.info("Moving images to {}".format(out_dir))
+            shutil.move(temp_path, out_path)
+            shutil.move(mask_path, out_mask_path)
+    record_step(cache_path, [out_path, out_mask_path], "preprocess_sen2_image", step_key)
+    return out_path
 
 
-def stack_sentinel_2_bands(safe_dir, out_image_path, band = "10m"):
-    """Stacks the contents of a .SAFE granule directory into a single geotiff"""
+def stack_sentinel_2_bands(safe_dir, out_image_path, band = "10m", window=None):
+    """Stacks the contents of a .SAFE granule directory into a single geotiff. safe_dir can also be a zipped product
+    or a URL; see get_safe_root. If window (from get_aoi_window) is given, only that part of the bands is stacked."""
     log = logging.getLogger(__name__)
     granule_path = r"GRANULE/*/IMG_DATA/R{}/*_B0[8,4,3,2]_{}.jp2".format(band, band)
-    image_glob = os.path.join(safe_dir, granule_path)
-    file_list = glob.glob(image_glob)
-    file_list.sort()   # Sorting alphabetically gives the right order for bands
+    file_list = glob_safe(safe_dir, granule_path)   # Sorting alphabetically gives the right order for bands
     if not file_list:
         log.error("No 10m imagery present in {}".format(safe_dir))
         raise BadS2Exception
-    stack_images(file_list, out_image_path, geometry_mode="intersect")
+    if window is None:
+        stack_images(file_list, out_image_path, geometry_mode="intersect")
+        return out_image_path
+    with TemporaryDirectory() as td:
+        window_list = [clip_to_window(band_path, os.path.join(td, "{}.tif".format(band_index)), window)
+                       for band_index, band_path in enumerate(file_list)]
+        stack_images(window_list, out_image_path, geometry_mode="intersect")
     return out_image_path
 
 
@@ -835,8 +1877,10 @@ def stack_old_and_new_images(old_image_path, new_image_path, out_dir, create_com
         log.error("Tiles  of the two images do not match. Aborted.")
 
 
-def stack_image_with_composite(image_path, composite_path, out_dir, create_combined_mask=True, skip_if_exists=True):
-    """Stacks an image with a cloud-free composite"""
+def stack_image_with_composite(image_path, composite_path, out_dir, create_combined_mask=True, skip_if_exists=True,
+                               cache_path=None):
+    """Stacks an image with a cloud-free composite. If cache_path is given, an existing stack is only reused if the
+    image, composite and their masks are unchanged since it was recorded in that processing cache."""
     log = logging.getLogger(__name__)
     log.info("Stacking {} with composite {}".format(image_path, composite_path))
     composite_timestamp = get_sen_2_image_timestamp(composite_path)
@@ -845,64 +1889,135 @@ def stack_image_with_composite(image_path, composite_path, out_dir, create_combi
     out_filename = "composite_{}_{}_{}.tif".format(tile, composite_timestamp, image_timestamp)
     out_path = os.path.join(out_dir, out_filename)
     out_mask_path = out_path.rsplit('.')[0] + ".msk"
-    if os.path.exists(out_path) and os.path.exists(out_mask_path) and skip_if_exists:
+    image_mask_path = get_mask_path(image_path)
+    comp_mask_path = get_mask_path(composite_path)
+    step_key = None
+    if cache_path:
+        step_key = get_step_key("stack_image_with_composite",
+                                [image_path, composite_path, image_mask_path, comp_mask_path],
+                                {"create_combined_mask": create_combined_mask})
+        if skip_if_exists and is_step_cached(cache_path, [out_path, out_mask_path], "stack_image_with_composite",
+                                             step_key):
+            log.info("{} and mask are up to date, skipping".format(out_path))
+            return out_path
+    elif os.path.exists(out_path) and os.path.exists(out_mask_path) and skip_if_exists:
         log.info("{} and mask exists, skipping".format(out_path))
         return out_path
     stack_images([composite_path, image_path], out_path, geometry_mode="intersect")
     if create_combined_mask:
-        image_mask_path = get_mask_path(image_path)
-        comp_mask_path = get_mask_path(composite_path)
         combine_masks([comp_mask_path, image_mask_path], out_mask_path, combination_func="and", geometry_func="intersect")
+    record_step(cache_path, [out_path, out_mask_path], "stack_image_with_composite", step_key)
     return out_path
 
 
-def get_l1_safe_file(image_name, l1_dir):
+def get_l1_safe_file(image_name, l1_dir, catalog_path=None):
     """Returns the path to the L1 .SAFE directory of image. Gets from granule and timestamp. image_name can be a path or
-    a filename"""
+    a filename. If catalog_path is given, looks the file up in that scene catalog."""
     timestamp = get_sen_2_image_timestamp(os.path.basename(image_name))
     granule = get_sen_2_image_tile(os.path.basename(image_name))
+    if catalog_path:
+        safe_files = query_scene_catalog(catalog_path, directory=l1_dir, tile=granule, timestamp=timestamp,
+                                         level="L1C", extension=".SAFE")
+        return os.path.join(l1_dir, os.path.basename(safe_files[0]))
     safe_glob = "S2[A|B]_MSIL1C_{}_*_{}_*.SAFE".format(timestamp, granule)
     out = glob.glob(os.path.join(l1_dir, safe_glob))[0]
     return out
 
 
-def get_l2_safe_file(image_name, l2_dir):
+def get_l2_safe_file(image_name, l2_dir, catalog_path=None):
     """Returns the path to the L1 .SAFE directory of image. Gets from granule and timestamp. image_name can be a path or
-    a filename"""
+    a filename. If catalog_path is given, looks the file up in that scene catalog."""
     timestamp = get_sen_2_image_timestamp(os.path.basename(image_name))
     granule = get_sen_2_image_tile(os.path.basename(image_name))
+    if catalog_path:
+        safe_files = query_scene_catalog(catalog_path, directory=l2_dir, tile=granule, timestamp=timestamp,
+                                         level="L2A", extension=".SAFE")
+        return os.path.join(l2_dir, os.path.basename(safe_files[0]))
     safe_glob = "S2[A|B]_MSIL2A_{}_*_{}_*.SAFE".format(timestamp, granule)
     out = glob.glob(os.path.join(l2_dir, safe_glob))[0]
     return out
 
 
+class S2ProductName:
+    """The components of a Sentinel 2 product name or a name derived from one, eg
+    S2A_MSIL2A_20180301T162211_N0206_R040_T15PXT_20180301T194348.SAFE
+    Any component not present in the name is None. datetime is the datatake sensing start time; timestamp is the same
+    as it appears in the name."""
+    __slots__ = ("granule_id", "mission", "level", "timestamp", "datetime", "baseline", "orbit", "tile",
+                 "processing_time")
+
+    def __init__(self, granule_id, mission=None, level=None, timestamp=None, baseline=None, orbit=None, tile=None,
+                 processing_time=None):
+        self.granule_id = granule_id
+        self.mission = mission
+        self.level = level
+        self.timestamp = timestamp
+        self.datetime = s2_timestamp_to_datetime(timestamp)
+        self.baseline = baseline
+        self.orbit = orbit
+        self.tile = tile
+        self.processing_time = s2_timestamp_to_datetime(processing_time)
+
+    def __repr__(self):
+        return "S2ProductName({})".format(self.granule_id)
+
+
+S2_PRODUCT_NAME_RE = re.compile(r"(S2[AB])_MSI(L1C|L2A)_(\d{8}T\d{6})_(N\d{4})_(R\d{3})_(T\d{2}[A-Z]{3})_(\d{8}T\d{6})")
+S2_TIMESTAMP_RE = re.compile(r"\d{8}T\d{6}")
+S2_TILE_RE = re.compile(r"T\d{2}[A-Z]{3}")   # Matches tile ID, but not timestamp
+S2_ORBIT_RE = re.compile(r"_(R\d{3})_")
+
+
+def s2_timestamp_to_datetime(timestamp):
+    """Converts a yyyymmddThhmmss timestamp to a datetime; returns None if timestamp is None"""
+    if timestamp is None:
+        return None
+    return dt.datetime(int(timestamp[0:4]), int(timestamp[4:6]), int(timestamp[6:8]),
+                       int(timestamp[9:11]), int(timestamp[11:13]), int(timestamp[13:15]))
+
+
+@functools.lru_cache(maxsize=2**16)
+def parse_sen_2_name(image_name):
+    """Parses a Sentinel 2 product name, or the name of an image derived from one, into an S2ProductName. image_name
+    can be a path. Results are cached, so repeated calls for the same name are cheap."""
+    granule_id = os.path.basename(image_name.rstrip("/")).split(".")[0]
+    match = S2_PRODUCT_NAME_RE.search(granule_id)
+    if match:
+        return S2ProductName(granule_id, *match.groups())
+    # Not a full product name (eg a composite or stack); pick out what we can
+    timestamp_match = S2_TIMESTAMP_RE.search(granule_id)
+    tile_match = S2_TILE_RE.search(granule_id)
+    orbit_match = S2_ORBIT_RE.search(granule_id)
+    return S2ProductName(granule_id,
+                         timestamp=timestamp_match.group(0) if timestamp_match else None,
+                         orbit=orbit_match.group(1) if orbit_match else None,
+                         tile=tile_match.group(0) if tile_match else None)
+
+
 def get_sen_2_image_timestamp(image_name):
     """Returns the timestamps part of a Sentinel 2 image"""
-    timestamp_re = r"\d{8}T\d{6}"
-    ts_result = re.search(timestamp_re, image_name)
-    return ts_result.group(0)
+    timestamp = parse_sen_2_name(image_name).timestamp
+    if timestamp is None:
+        raise AttributeError("No timestamp in {}".format(image_name))
+    return timestamp
 
 
 def get_sen_2_image_orbit(image_name):
     """Returns the relative orbit number of a Sentinel 2 image"""
-    tmp1 = image_name.split("/")[-1]  # remove path
-    tmp2 = tmp1.split(".")[0] # remove file extension
-    comps = tmp2.split("_") # decompose
-    return comps[4]
+    return parse_sen_2_name(image_name).orbit
 
 
 def get_sen_2_image_tile(image_name):
     """Returns the tile number of a Sentinel 2 image or path"""
-    name = os.path.basename(image_name)
-    tile = re.findall(r"T\d{2}[A-Z]{3}", name)[0]  # Matches tile ID, but not timestamp
+    tile = parse_sen_2_name(image_name).tile
+    if tile is None:
+        raise IndexError("No tile ID in {}".format(image_name))
     return tile
 
 
 def get_sen_2_granule_id(safe_dir):
     """Returns the unique ID of a Sentinel 2 granule from a SAFE directory path"""
-    tmp = os.path.basename(safe_dir) # removes path to SAFE directory
-    id = tmp.split(".")[0] # removes ".SAFE" from the ID name
-    return id
+    return parse_sen_2_name(safe_dir).granule_id
 
 
 def get_pyeo_timestamp(image_name):
@@ -1007,14 +2122,28 @@ def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.G
     out_raster_array = None
 
 
-def composite_images_with_mask(in_raster_path_list, composite_out_path, format="GTiff", generate_date_image=False):
+def composite_images_with_mask(in_raster_path_list, composite_out_path, format="GTiff", generate_date_image=False,
+                               cache_path=None):
     """Works down in_raster_path_list, updating pixels in composite_out_path if not masked. Masks are assumed to
     be a binary .msk file with the same path as their corresponding image. All images must have the same
     number of layers and resolution, but do not have to be perfectly on top of each other. If it does not exist,
     composite_out_path will be created. Takes projection, resolution, ect from first band of first raster in list.
-    Will reproject images and masks if they do not match initial raster."""
+    Will reproject images and masks if they do not match initial raster.
+    If cache_path is given, an existing composite is reused if its inputs are unchanged in that processing cache."""
 
     log = logging.getLogger(__name__)
+    composite_mask_path = composite_out_path.rsplit(".")[0]+".msk"
+    out_paths = [composite_out_path, composite_mask_path]
+    if generate_date_image:
+        out_paths.append(composite_out_path.rsplit('.')[0]+".dates")
+    step_key = None
+    if cache_path:
+        step_key = get_step_key("composite_images_with_mask",
+                                list(in_raster_path_list) + [get_mask_path(path) for path in in_raster_path_list],
+                                {"format": format, "generate_date_image": generate_date_image})
+        if is_step_cached(cache_path, out_paths, "composite_images_with_mask", step_key):
+            log.info("Composite {} is up to date, skipping".format(composite_out_path))
+            return composite_out_path
     driver = gdal.GetDriverByName(format)
     in_raster_list = [gdal.Open(raster) for raster in in_raster_path_list]
     projection = in_raster_list[0].GetProjection()
@@ -1078,8 +2207,9 @@ def composite_images_with_mask(in_raster_path_list, composite_out_path, format="
     composite_image = None
 
     log.info("Composite done")
-    log.info("Creating composite mask at {}".format(composite_out_path.rsplit(".")[0]+".msk"))
-    combine_masks(mask_paths, composite_out_path.rsplit(".")[0]+".msk", combination_func='or', geometry_func="union")
+    log.info("Creating composite mask at {}".format(composite_mask_path))
+    combine_masks(mask_paths, composite_mask_path, combination_func='or', geometry_func="union")
+    record_step(cache_path, out_paths, "composite_images_with_mask", step_key)
     return composite_out_path
 
 
@@ -1161,17 +2291,167 @@ def project_array(array_in, depth, axis):
     return array_in
 
 
-def flatten_probability_image(prob_image, out_path):
-    """Produces a single-band raster containing the highest certainties in a input probablility raster"""
+def flatten_probability_image(prob_image, out_path, quantise=False, block_rows=512):
+    """Produces a single-band raster containing the highest certainties in a input probablility raster.
+    Works a block of rows at a time; see create_certainty_images for quantise."""
+    return create_certainty_images(prob_image, max_path=out_path, quantise=quantise, block_rows=block_rows)
+
+
+def create_certainty_images(prob_image, max_path=None, margin_path=None, entropy_path=None, quantise=False,
+                            block_rows=512):
+    """
+    Produces single band certainty rasters from a probability raster with one band per class, in a single pass
+    a block of rows at a time. Quantised probability rasters (see classify_image) are rescaled to 0-1 as they are read.
+
+    Parameters
+    ----------
+    prob_image : str
+        Path to the probability raster.
+    max_path : str, optional
+        If given, where to write the highest probability of each pixel.
+    margin_path : str, optional
+        If given, where to write the difference between the highest and second highest probabilities of each pixel.
+    entropy_path : str, optional
+        If given, where to write the entropy of the probabilities of each pixel, divided by its largest possible
+        value (the log of the number of classes) so that it runs from 0 (certain) to 1.
+    quantise : bool, optional
+        If True, the outputs are written as bytes from 0 to 255 (0 to 254 for entropy) for 0 to 1 instead of as
+        32 bit floats, with the scale to read them back set on the band.
+    block_rows : int, optional
+        The number of rows to read at once.
+
+    Returns
+    -------
+    max_path, or a tuple of (max_path, margin_path, entropy_path) if margin_path or entropy_path are given.
+
+    Notes
+    -----
+    Pixels where every probability is 0 (the nodata of classify_image) are written as each output's nodata value:
+    0 for max and margin, and -1 (255 if quantised) for entropy, where 0 would mean certain.
+    """
     prob_raster = gdal.Open(prob_image)
-    out_raster = create_matching_dataset(prob_raster, out_path, bands=1)
-    prob_array = prob_raster.GetVirtualMemArray()
-    out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    out_array[:, :] = prob_array.max(axis=0)
-    out_array = None
-    prob_array = None
-    out_raster = None
+    class_count = prob_raster.RasterCount
+    out_datatype = gdal.GDT_Byte if quantise else gdal.GDT_Float32
+    out_rasters = {name: create_matching_dataset(prob_raster, path, bands=1, datatype=out_datatype)
+                   for name, path in (("max", max_path), ("margin", margin_path), ("entropy", entropy_path)) if path}
+    nodata_values = {"max": 0, "margin": 0, "entropy": 255 if quantise else -1}
+    quantised_maxima = {"max": 255, "margin": 255, "entropy": 254}
+    for name, out_raster in out_rasters.items():
+        out_raster.GetRasterBand(1).SetNoDataValue(nodata_values[name])
+        if quantise:
+            out_raster.GetRasterBand(1).SetScale(1/quantised_maxima[name])
+    for y_offset, y_size in iterate_row_blocks(prob_raster, block_rows):
+        prob_block = read_scaled_block(prob_raster, y_offset, y_size)
+        nodata_pixels = ~np.any(prob_block > 0, axis=0)
+        out_blocks = {}
+        if "max" in out_rasters or "margin" in out_rasters:
+            if class_count > 1:
+                top_two = np.partition(prob_block, class_count - 2, axis=0)[-2:]
+                out_blocks["max"] = top_two[1]
+                out_blocks["margin"] = top_two[1] - top_two[0]
+            else:
+                out_blocks["max"] = out_blocks["margin"] = prob_block[0]
+        if "entropy" in out_rasters:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                plogp = np.where(prob_block > 0, prob_block*np.log(prob_block), 0)
+            out_blocks["entropy"] = -plogp.sum(axis=0)/np.log(class_count) if class_count > 1 \
+                else np.zeros(prob_block.shape[1:], dtype=np.float32)
+        for name, out_raster in out_rasters.items():
+            out_block = out_blocks[name]
+            if quantise:
+                out_block = np.round(np.clip(out_block, 0, 1)*quantised_maxima[name]).astype(np.uint8)
+            out_block = np.where(nodata_pixels, nodata_values[name], out_block).astype(out_block.dtype)
+            out_raster.GetRasterBand(1).WriteArray(out_block, 0, y_offset)
+    out_rasters = None
     prob_raster = None
+    if margin_path or entropy_path:
+        return max_path, margin_path, entropy_path
+    return max_path
+
+
+def get_probability_scale(datatype):
+    """Returns the (scale, offset) that a probability stored as a gdal datatype is multiplied by and added to to give
+    a probability from 0 to 1. Byte and UInt16 probabilities run from 0 to 255 and 0 to 65535; floats are unscaled."""
+    if datatype == gdal.GDT_Byte:
+        return 1/255, 0
+    if datatype == gdal.GDT_UInt16:
+        return 1/65535, 0
+    if datatype in (gdal.GDT_Float32, gdal.GDT_Float64):
+        return 1, 0
+    raise ValueError("Probabilities can only be stored as Byte, UInt16, Float32 or Float64")
+
+
+def quantise_probabilities(probs, datatype):
+    """Returns an array of probabilities from 0 to 1 converted to be stored as datatype; see get_probability_scale"""
+    scale, offset = get_probability_scale(datatype)
+    out_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(datatype)
+    if scale == 1 and offset == 0:
+        return probs.astype(out_dtype, copy=False)
+    return np.round((np.clip(probs, 0, 1) - offset)/scale).astype(out_dtype)
+
+
+def read_scaled_block(raster, y_offset, y_size):
+    """Reads y_size rows from y_offset of every band of raster as a float32 [band, y, x] array, applying each band's
+    scale and offset (so quantised probabilities are read back as 0 to 1)"""
+    block = raster.ReadAsArray(0, y_offset, raster.RasterXSize, y_size).astype(np.float32)
+    if block.ndim == 2:
+        block = np.expand_dims(block, 0)
+    for band_index in range(raster.RasterCount):
+        band = raster.GetRasterBand(band_index + 1)
+        scale, offset = band.GetScale() or 1, band.GetOffset() or 0
+        if scale != 1 or offset != 0:
+            block[band_index] *= scale
+            block[band_index] += offset
+    return block
+
+
+def iterate_row_blocks(raster, block_rows=512):
+    """Yields (y_offset, y_size) for strips of block_rows rows covering raster, for working on it a block at a time"""
+    for y_offset in range(0, raster.RasterYSize, block_rows):
+        yield y_offset, min(block_rows, raster.RasterYSize - y_offset)
+
+
+def build_class_color_lut(class_color_key):
+    """Returns a 256x4 uint8 lookup table of the RGBA colour of each class in class_color_key, a list of rows of
+    [class, R, G, B, A, ...] as strings or numbers. Classes not in the key are 0, 0, 0, 0."""
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for class_row in class_color_key:
+        lut[int(class_row[0])] = [int(value) for value in class_row[1:5]]
+    return lut
+
+
+def create_color_table(class_color_key):
+    """Returns a gdal.ColorTable of the colours in class_color_key; see build_class_color_lut"""
+    color_table = gdal.ColorTable()
+    for class_value, color in enumerate(build_class_color_lut(class_color_key)):
+        color_table.SetColorEntry(class_value, tuple(int(value) for value in color))
+    return color_table
+
+
+def color_class_map(class_path, out_path, class_color_key, use_color_table=False, block_rows=512):
+    """Colours the single band class map at class_path with class_color_key (see build_class_color_lut), a block of
+    rows at a time. Writes a three band RGB byte image to out_path or, if use_color_table is True, a single band byte
+    image of the classes with a colour table. Class values outside 0-255 are coloured as class 0."""
+    lut = build_class_color_lut(class_color_key)
+    class_raster = gdal.Open(class_path)
+    class_band = class_raster.GetRasterBand(1)
+    out_raster = create_matching_dataset(class_raster, out_path, bands=1 if use_color_table else 3,
+                                         datatype=gdal.GDT_Byte)
+    if use_color_table:
+        out_raster.GetRasterBand(1).SetColorInterpretation(gdal.GCI_PaletteIndex)
+        out_raster.GetRasterBand(1).SetColorTable(create_color_table(class_color_key))
+    for y_offset, y_size in iterate_row_blocks(class_raster, block_rows):
+        class_block = class_band.ReadAsArray(0, y_offset, class_raster.RasterXSize, y_size)
+        class_block = np.where((class_block >= 0) & (class_block < 256), class_block, 0).astype(np.uint8)
+        if use_color_table:
+            out_raster.GetRasterBand(1).WriteArray(class_block, 0, y_offset)
+            continue
+        color_block = lut[class_block]
+        for band_index in range(3):
+            out_raster.GetRasterBand(band_index + 1).WriteArray(color_block[:, :, band_index], 0, y_offset)
+    out_raster = None
+    class_raster = None
+    return out_path
 
 
 def get_combined_polygon(rasters, geometry_mode ="intersect"):
@@ -1260,10 +2540,13 @@ def stack_and_trim_images(old_image_path, new_image_path, aoi_path, out_image):
                      out_image, geometry_mode="intersect")
 
 
-def clip_raster(raster_path, aoi_path, out_path, srs_id=4326):
+def clip_raster(raster_path, aoi_path, out_path, srs_id=4326, use_window=False):
     """Clips a raster at raster_path to a shapefile given by aoi_path. Assumes a shapefile only has one polygon.
-    Will np.floor() when converting from geo to pixel units and np.absolute() y resolution form geotransform."""
+    Will np.floor() when converting from geo to pixel units and np.absolute() y resolution form geotransform.
+    If use_window is True, uses clip_raster_to_window instead of warping to a cutline."""
     # https://gis.stackexchange.com/questions/257257/how-to-use-gdal-warp-cutline-option
+    if use_window:
+        return clip_raster_to_window(raster_path, aoi_path, out_path)
     with TemporaryDirectory() as td:
         srs = osr.SpatialReference()
         srs.ImportFromEPSG(srs_id)
@@ -1291,6 +2574,88 @@ def clip_raster(raster_path, aoi_path, out_path, srs_id=4326):
         out = None
 
 
+def get_aoi_window(raster, aoi_path, grid_size=60):
+    """Returns the bounds (ulx, uly, lrx, lry) of the part of raster covering the first feature of the aoi at
+    aoi_path, in the projection of raster, for use as a window with clip_to_window. The bounds are snapped outwards
+    to a grid_size grid from the raster's origin, so that the window covers whole pixels at every S2 resolution
+    (10, 20 and 60m). Returns None if the aoi and raster do not overlap."""
+    aoi = ogr.Open(aoi_path)
+    aoi_layer = aoi.GetLayer(0)
+    aoi_layer.ResetReading()
+    aoi_geometry = aoi_layer.GetNextFeature().GetGeometryRef().Clone()
+    aoi_srs = aoi_layer.GetSpatialRef()
+    if aoi_srs is None:
+        aoi_srs = osr.SpatialReference()
+        aoi_srs.ImportFromEPSG(4326)
+    raster_srs = osr.SpatialReference(wkt=raster.GetProjection())
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):   # Keep x, y axis order with gdal 3
+        aoi_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    aoi_geometry.Transform(osr.CoordinateTransformation(aoi_srs, raster_srs))
+    aoi = None
+    gt = raster.GetGeoTransform()
+    raster_x_min, raster_y_max = gt[0], gt[3]
+    raster_x_max = gt[0] + gt[1]*raster.RasterXSize
+    raster_y_min = gt[3] + gt[5]*raster.RasterYSize
+    aoi_x_min, aoi_x_max, aoi_y_min, aoi_y_max = aoi_geometry.GetEnvelope()
+    ulx = raster_x_min + np.floor((max(aoi_x_min, raster_x_min) - raster_x_min)/grid_size)*grid_size
+    lrx = raster_x_min + np.ceil((min(aoi_x_max, raster_x_max) - raster_x_min)/grid_size)*grid_size
+    uly = raster_y_max - np.floor((raster_y_max - min(aoi_y_max, raster_y_max))/grid_size)*grid_size
+    lry = raster_y_max - np.ceil((raster_y_max - max(aoi_y_min, raster_y_min))/grid_size)*grid_size
+    if ulx >= lrx or uly <= lry:
+        return None
+    return float(ulx), float(uly), float(min(lrx, raster_x_max)), float(max(lry, raster_y_min))
+
+
+def clip_to_window(raster_path, out_path, window, format="GTiff"):
+    """Copies the part of the raster at raster_path inside window, a tuple of (ulx, uly, lrx, lry) in its projection
+    (see get_aoi_window), to out_path. Returns out_path."""
+    out = gdal.Translate(out_path, raster_path, format=format, projWin=list(window))
+    out = None
+    return out_path
+
+
+def clip_raster_to_window(raster_path, aoi_path, out_path, mask_polygon=True, fill_value=0, format="GTiff"):
+    """Clips a raster at raster_path to the aoi at aoi_path by copying the window of the raster under the envelope
+    of their intersection. If mask_polygon is True and the intersection isn't a rectangle, pixels outside it are
+    set to fill_value using a mask rasterised in memory. Like clip_raster, assumes the raster and aoi share a
+    projection and the aoi has one polygon. Returns out_path."""
+    raster = gdal.Open(raster_path)
+    aoi = ogr.Open(aoi_path)
+    intersection = get_aoi_intersection(raster, aoi)
+    x_min, x_max, y_min, y_max = pixel_bounds_from_polygon(raster, intersection)
+    out = gdal.Translate(out_path, raster, format=format, srcWin=[x_min, y_min, x_max - x_min, y_max - y_min])
+    if mask_polygon and not np.isclose(intersection.GetArea(), get_poly_bounding_rect(intersection).GetArea()):
+        outside = rasterise_polygon(intersection, out) == 0
+        for band_index in range(1, out.RasterCount + 1):
+            band = out.GetRasterBand(band_index)
+            band_array = band.ReadAsArray()
+            band_array[outside] = fill_value
+            band.WriteArray(band_array)
+    out = None
+    aoi = None
+    raster = None
+    return out_path
+
+
+def rasterise_polygon(polygon, raster):
+    """Returns an array the shape of raster that is 1 where pixel centres are inside polygon and 0 elsewhere.
+    The polygon is rasterised in memory, so it must be in the projection of raster."""
+    mask = gdal.GetDriverByName("MEM").Create("", raster.RasterXSize, raster.RasterYSize, 1, gdal.GDT_Byte)
+    mask.SetGeoTransform(raster.GetGeoTransform())
+    mask.SetProjection(raster.GetProjection())
+    polygon_source = ogr.GetDriverByName("Memory").CreateDataSource("")
+    polygon_layer = polygon_source.CreateLayer("polygon", geom_type=ogr.wkbPolygon)
+    polygon_feature = ogr.Feature(polygon_layer.GetLayerDefn())
+    polygon_feature.SetGeometry(polygon)
+    polygon_layer.CreateFeature(polygon_feature)
+    gdal.RasterizeLayer(mask, [1], polygon_layer, burn_values=[1])
+    out = mask.ReadAsArray()
+    mask = None
+    polygon_source = None
+    return out
+
+
 def write_polygon(polygon, out_path, srs_id=4326):
     """Saves a polygon to a shapefile"""
     driver = ogr.GetDriverByName("ESRI Shapefile")
@@ -1459,36 +2824,45 @@ def create_mask_from_model(image_path, model_path, model_clear=0, num_chunks=10,
         return mask_path
 
 
-def create_mask_from_confidence_layer(l2_safe_path, out_path, cloud_conf_threshold=0, buffer_size=3):
+def create_mask_from_confidence_layer(l2_safe_path, out_path, cloud_conf_threshold=0, buffer_size=3, window=None):
     """Creates a multiplicative binary mask where cloudy pixels are 0 and non-cloudy pixels are 1. If
-    cloud_conf_threshold = 0, use scl mask else use confidence image """
+    cloud_conf_threshold = 0, use scl mask else use confidence image. l2_safe_path can be a directory, zip or URL;
+    see get_safe_root. If window (from get_aoi_window) is given, the mask only covers that window."""
     log = logging.getLogger(__name__)
     log.info("Creating mask for {} with {} confidence threshold".format(l2_safe_path, cloud_conf_threshold))
     if cloud_conf_threshold:
         cloud_glob = "GRANULE/*/QI_DATA/*CLD*_20m.jp2"  # This should match both old and new mask formats
-        cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
-        cloud_image = gdal.Open(cloud_path)
-        cloud_confidence_array = cloud_image.GetVirtualMemArray()
-        mask_array = (cloud_confidence_array < cloud_conf_threshold)
-        cloud_confidence_array = None
     else:
         cloud_glob = "GRANULE/*/IMG_DATA/R20m/*SCL*_20m.jp2"  # This should match both old and new mask formats
-        cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
-        cloud_image = gdal.Open(cloud_path)
-        scl_array = cloud_image.GetVirtualMemArray()
-        mask_array = np.isin(scl_array, (4, 5, 6))
+    cloud_path = glob_safe(l2_safe_path, cloud_glob)[0]
+    if window:
+        with TemporaryDirectory() as td:
+            cloud_path = clip_to_window(cloud_path, os.path.join(td, "cloud.tif"), window)
+            _write_cloud_mask(cloud_path, out_path, cloud_conf_threshold)
+    else:
+        _write_cloud_mask(cloud_path, out_path, cloud_conf_threshold)
+    resample_image_in_place(out_path, 10)
+    if buffer_size:
+        buffer_mask_in_place(out_path, buffer_size)
+    log.info("Mask created at {}".format(out_path))
+    return out_path
 
+
+def _write_cloud_mask(cloud_path, out_path, cloud_conf_threshold):
+    """Writes the binary mask for a cloud confidence or SCL image to out_path"""
+    cloud_image = gdal.Open(cloud_path)
+    cloud_array = cloud_image.GetVirtualMemArray()
+    if cloud_conf_threshold:
+        mask_array = (cloud_array < cloud_conf_threshold)
+    else:
+        mask_array = np.isin(cloud_array, (4, 5, 6))
+    cloud_array = None
     mask_image = create_matching_dataset(cloud_image, out_path)
     mask_image_array = mask_image.GetVirtualMemArray(eAccess=gdal.GF_Write)
     np.copyto(mask_image_array, mask_array)
     mask_image_array = None
     cloud_image = None
     mask_image = None
-    resample_image_in_place(out_path, 10)
-    if buffer_size:
-        buffer_mask_in_place(out_path, buffer_size)
-    log.info("Mask created at {}".format(out_path))
-    return out_path
 
 
 def create_mask_from_class_map(class_map_path, out_path, classes_of_interest, buffer_size=0, out_resolution=None):
@@ -1531,12 +2905,16 @@ def create_mask_from_fmask(in_l1_dir, out_path):
         resample_image_in_place(out_path, 10)
 
 
-def create_mask_from_sen2cor_and_fmask(l1_dir, l2_dir, out_mask_path, buffer_size=0):
+def create_mask_from_sen2cor_and_fmask(l1_dir, l2_dir, out_mask_path, buffer_size=0, window=None):
+    """Combines the sen2cor and fmask cloud masks. If window (from get_aoi_window) is given, the mask only covers that
+    window. fmask itself still runs on the whole L1 tile."""
     with TemporaryDirectory() as td:
         s2c_mask_path = os.path.join(td, "s2_mask.tif")
         fmask_mask_path = os.path.join(td, "fmask.tif")
-        create_mask_from_confidence_layer(l2_dir, s2c_mask_path, buffer_size=buffer_size)
+        create_mask_from_confidence_layer(l2_dir, s2c_mask_path, buffer_size=buffer_size, window=window)
         create_mask_from_fmask(l1_dir, fmask_mask_path)
+        if window:
+            fmask_mask_path = clip_to_window(fmask_mask_path, os.path.join(td, "fmask_window.tif"), window)
         combine_masks([s2c_mask_path, fmask_mask_path], out_mask_path, combination_func="and", geometry_func="union")
 
 
@@ -1653,23 +3031,39 @@ def resample_image_in_place(image_path, new_res):
 
 def apply_array_image_mask(array, mask, fill_value=0):
     """Applies a mask of (y,x) to an image array of (bands, y, x). Replaces any masked pixels with fill_value"""
-    if array.ndim == 2:
-        band_count = 1
-    else:
-        band_count = array.shape[0]
-    stacked_mask = np.stack([mask]*band_count, axis=0)
-    return np.where(stacked_mask == 1, array, fill_value)
+    # A (y, x) mask broadcasts against every band, so there is no need to stack a copy per band
+    return np.where(mask == 1, array, fill_value)
 
 
 def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
-                   apply_mask=False, out_type="GTiff", num_chunks=10, nodata=0, skip_existing = False):
+                   apply_mask=False, out_type="GTiff", num_chunks=10, nodata=0, skip_existing = False,
+                   cache_path=None, prob_datatype=gdal.GDT_Float32,
+                   block_rows=None):
     """
     Classifies change between two stacked images.
-    Images need to be chunked, otherwise they cause a memory error (~16GB of data with a ~15GB machine)
+    Images need to be chunked, otherwise they cause a memory error (~16GB of data with a ~15GB machine), so they are
+    classified in strips of block_rows rows, or num_chunks strips if block_rows is not given. With apply_mask, strips
+    that are entirely masked are skipped and only unmasked pixels are classified.
+    If cache_path is given with skip_existing, existing outputs are only reused if the image, its mask (if applied),
+    the model and the output options are unchanged since they were recorded in that processing cache.
+    The model is loaded through get_model, so is only unpickled once per process.
+    prob_datatype can be gdal.GDT_Byte or gdal.GDT_UInt16 to store probabilities as quantised integers, with the scale
+    to read them back as 0 to 1 set on each band; see get_probability_scale and read_scaled_block.
     TODO: This has gotten very hairy; rewrite when you update this to take generic models
     """
     log = logging.getLogger(__name__)
-    if skip_existing:
+    out_paths = [out_path for out_path in (class_out_path, prob_out_path) if out_path]
+    step_key = None
+    if cache_path:
+        step_key = get_step_key("classify_image",
+                                [image_path, get_mask_path(image_path) if apply_mask else None, model_path],
+                                {"apply_mask": apply_mask, "out_type": out_type, "nodata": nodata,
+                                 "prob_out": bool(prob_out_path), "prob_datatype": prob_datatype})
+    if skip_existing and cache_path:
+        if is_step_cached(cache_path, out_paths, "classify_image", step_key):
+            log.info("Classification {} is up to date, skipping.".format(class_out_path))
+            return class_out_path
+    elif skip_existing:
         log.info("Checking for existing classification {}".format(class_out_path))
         if os.path.isfile(class_out_path):
             log.info("Class image exists, skipping.")
@@ -1681,11 +3075,7 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
         log.info("No chunk size given, attempting autochunk.")
         num_chunks = autochunk(image)
         log.info("Autochunk to {} chunks".format(num_chunks))
-    try:
-        model = sklearn_joblib.load(model_path)
-    except KeyError:
-        log.warning("Sklearn joblib import failed,trying generic joblib")
-        model = joblib.load(model_path)
+    model = get_model(model_path)
     class_out_image = create_matching_dataset(image, class_out_path, format=out_type, datatype=gdal.GDT_Byte)
     log.info("Created classification image file: {}".format(class_out_path))
     if prob_out_path:
@@ -1693,93 +3083,121 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
             log.info("n classes in the model: {}".format(model.n_classes_))
         except AttributeError:
             log.warning("Model has no n_classes_ attribute (known issue with GridSearch)")
-        prob_out_image = create_matching_dataset(image, prob_out_path, bands=model.n_classes_, datatype=gdal.GDT_Float32)
+        prob_out_image = create_matching_dataset(image, prob_out_path, bands=model.n_classes_, datatype=prob_datatype)
+        prob_scale, prob_offset = get_probability_scale(prob_datatype)
+        if prob_scale != 1 or prob_offset != 0:
+            for band_index in range(model.n_classes_):
+                prob_out_image.GetRasterBand(band_index + 1).SetScale(prob_scale)
+                prob_out_image.GetRasterBand(band_index + 1).SetOffset(prob_offset)
         log.info("Created probability image file: {}".format(prob_out_path))
     model.n_cores = -1
-    image_array = image.GetVirtualMemArray()
-
     if apply_mask:
         mask_path = get_mask_path(image_path)
         log.info("Applying mask at {}".format(mask_path))
-        mask = gdal.Open(mask_path)
-        mask_array = mask.GetVirtualMemArray()
-        image_array = apply_array_image_mask(image_array, mask_array)
-        mask_array = None
-        mask = None
-
-    # Mask out missing values from the classification
-    # at this point, image_array has dimensions [band, y, x]
-    log.info("Reshaping image from GDAL to Scikit-Learn dimensions")
-    image_array = reshape_raster_for_ml(image_array)
-    # Now it has dimensions [x * y, band] as needed for Scikit-Learn
-
-    # Determine where in the image array there are no missing values in any of the bands (axis 1)
-    log.info("Finding good pixels without missing values")
-    log.info("image_array.shape = {}".format(image_array.shape))
-    n_samples = image_array.shape[0]  # gives x * y dimension of the whole image
-    if 0 in image_array:  # a quick pre-check
-        good_samples = image_array[np.all(image_array != nodata, axis=1), :]
-        good_indices = [i for (i, j) in enumerate(image_array) if np.all(j != nodata)] # This is slowing things down too much
-        n_good_samples = len(good_samples)
-    else:
-        good_samples = image_array
-        good_indices = range(0, n_samples)
-        n_good_samples = n_samples
+        mask_image = gdal.Open(mask_path)
+        mask_band = mask_image.GetRasterBand(1)
+    if block_rows is None:
+        block_rows = int(np.ceil(image.RasterYSize/num_chunks))
+    if nodata != 0:
+        class_out_image.GetRasterBand(1).Fill(nodata)
+        if prob_out_path:
+            for band_index in range(model.n_classes_):
+                prob_out_image.GetRasterBand(band_index + 1).Fill(nodata)
+
+    # Blocks are read a strip of rows at a time; only pixels that are unmasked and have no missing values in any
+    # band are passed to the model, and blocks without any are skipped without reading the image.
+    n_samples = image.RasterXSize*image.RasterYSize
+    n_good_samples = 0
+    skipped_blocks = 0
+    for y_offset, y_size in iterate_row_blocks(image, block_rows):
+        if apply_mask:
+            good_pixels = mask_band.ReadAsArray(0, y_offset, image.RasterXSize, y_size) == 1
+            if not good_pixels.any():
+                skipped_blocks += 1
+                continue
+        else:
+            good_pixels = np.ones((y_size, image.RasterXSize), dtype=bool)
+        image_block = image.ReadAsArray(0, y_offset, image.RasterXSize, y_size)
+        if image_block.ndim == 2:
+            image_block = np.expand_dims(image_block, 0)
+        good_pixels &= np.all(image_block != nodata, axis=0)
+        block_good_samples = np.count_nonzero(good_pixels)
+        if block_good_samples == 0:
+            skipped_blocks += 1
+            continue
+        log.info("   Classifying {} pixels in rows {} to {}".format(block_good_samples, y_offset, y_offset + y_size))
+        n_good_samples += block_good_samples
+        good_samples = image_block[:, good_pixels].T   # dimensions [pixels, bands], as needed for Scikit-Learn
+        class_block = np.full(good_pixels.shape, nodata, dtype=np.ubyte)
+        if prob_out_path:
+            # One predict_proba call gives both outputs; the class is the most probable one, as in model.predict
+            probs = model.predict_proba(good_samples)
+            class_block[good_pixels] = model.classes_[np.argmax(probs, axis=1)]
+            prob_block = np.full((model.n_classes_,) + good_pixels.shape, nodata,
+                                 dtype=gdal_array.GDALTypeCodeToNumericTypeCode(prob_datatype))
+            prob_block[:, good_pixels] = quantise_probabilities(probs, prob_datatype).T
+            for band_index in range(model.n_classes_):
+                prob_out_image.GetRasterBand(band_index + 1).WriteArray(prob_block[band_index], 0, y_offset)
+        else:
+            class_block[good_pixels] = model.predict(good_samples)
+        class_out_image.GetRasterBand(1).WriteArray(class_block, 0, y_offset)
     log.info("   All  samples: {}".format(n_samples))
     log.info("   Good samples: {}".format(n_good_samples))
-    classes = np.full(n_good_samples, nodata, dtype=np.ubyte)
-    if prob_out_path:
-        probs = np.full((n_good_samples, model.n_classes_), nodata, dtype=np.float32)
-
-    chunk_size = int(n_good_samples / num_chunks)
-    chunk_resid = n_good_samples - (chunk_size * num_chunks)
-    log.info("   Number of chunks {} Chunk size {} Chunk residual {}".format(num_chunks, chunk_size, chunk_resid))
-    # The chunks iterate over all values in the array [x * y, bands] always with 8 bands per chunk
-    for chunk_id in range(num_chunks):
-        offset = chunk_id * chunk_size
-        # process the residual pixels with the last chunk
-        if chunk_id == num_chunks - 1:
-            chunk_size = chunk_size + chunk_resid
-        log.info("   Classifying chunk {} of size {}".format(chunk_id, chunk_size))
-        chunk_view = good_samples[offset : offset + chunk_size]
-        #indices_view = good_indices[offset : offset + chunk_size]
-        out_view = classes[offset : offset + chunk_size]  # dimensions [chunk_size]
-        out_view[:] = model.predict(chunk_view)
-
-        if prob_out_path:
-            log.info("   Calculating probabilities")
-            prob_view = probs[offset : offset + chunk_size, :]
-            prob_view[:, :] = model.predict_proba(chunk_view)
-
-    log.info("   Creating class array of size {}".format(n_samples))
-    class_out_array = np.full((n_samples), nodata)
-    for i, class_val in zip(good_indices, classes):
-        class_out_array[i] = class_val
-
-    log.info("   Creating GDAL class image")
-    class_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write)[:, :] = \
-        reshape_ml_out_to_raster(class_out_array, image.RasterXSize, image.RasterYSize)
-
-    if prob_out_path:
-        log.info("   Creating probability array of size {}".format(n_samples * model.n_classes_))
-        prob_out_array = np.full((n_samples, model.n_classes_), nodata)
-        for i, prob_val in zip(good_indices, probs):
-            prob_out_array[i] = prob_val
-        log.info("   Creating GDAL probability image")
-        log.info("   N Classes = {}".format(prob_out_array.shape[1]))
-        log.info("   Image X size = {}".format(image.RasterXSize))
-        log.info("   Image Y size = {}".format(image.RasterYSize))
-        prob_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write)[:, :, :] = \
-            reshape_prob_out_to_raster(prob_out_array, image.RasterXSize, image.RasterYSize)
+    log.info("   Skipped {} blocks with no good samples".format(skipped_blocks))
+    mask_band = None
+    mask_image = None
 
     class_out_image = None
     prob_out_image = None
+    record_step(cache_path, out_paths, "classify_image", step_key)
     if prob_out_path:
         return class_out_path, prob_out_path
     else:
         return class_out_path
 
 
+def load_model(model_path):
+    """Unpickles the model at model_path with sklearn's joblib, falling back to joblib."""
+    log = logging.getLogger(__name__)
+    try:
+        return sklearn_joblib.load(model_path)
+    except KeyError:
+        log.warning("Sklearn joblib import failed,trying generic joblib")
+        return joblib.load(model_path)
+
+
+def save_model(model, model_path):
+    """Pickles model to model_path with joblib, uncompressed so that it loads quickly. Returns model_path."""
+    joblib.dump(model, model_path)
+    return model_path
+
+
+MODEL_CACHE_SIZE = 4
+model_cache = collections.OrderedDict()
+model_cache_lock = threading.Lock()
+
+
+def get_model(model_path):
+    """Returns the model at model_path from an in-process cache of the MODEL_CACHE_SIZE most recently used models,
+    loading it with load_model if it isn't there. Cached models are keyed by path and modification time, so a model
+    is reloaded if its file changes. The returned model is shared, so don't modify it."""
+    log = logging.getLogger(__name__)
+    model_path = os.path.abspath(model_path)
+    model_key = (model_path, os.stat(model_path).st_mtime_ns)
+    with model_cache_lock:
+        if model_key in model_cache:
+            model_cache.move_to_end(model_key)
+            return model_cache[model_key]
+        log.info("Loading model {}".format(model_path))
+        model = load_model(model_path)
+        for stale_key in [key for key in model_cache if key[0] == model_path and key[1] != model_key[1]]:
+            del model_cache[stale_key]
+        model_cache[model_key] = model
+        while len(model_cache) > MODEL_CACHE_SIZE:
+            model_cache.popitem(last=False)
+    return model
+
+
 def autochunk(dataset, mem_limit=None):
     """Calculates the number of chunks to break a dataset into without a memory error.
     We want to break the dataset into as few chunks as possible without going over mem_limit.
@@ -1805,7 +3223,8 @@ def covert_image_format(image, format):
 
 
 def classify_directory(in_dir, model_path, class_out_dir, prob_out_dir,
-                       apply_mask=False, out_type="GTiff", num_chunks=None):
+                       apply_mask=False, out_type="GTiff", num_chunks=None,
+                       prob_datatype=gdal.GDT_Float32, block_rows=None):
     """
     Classifies every .tif in in_dir using model at model_path. Outputs are saved
     in class_out_dir and prob_out_dir, named [input_name]_class and _prob, respectively.
@@ -1819,7 +3238,7 @@ def classify_directory(in_dir, model_path, class_out_dir, prob_out_dir,
         class_out_path = os.path.join(class_out_dir, image_name+"_class.tif")
         prob_out_path = os.path.join(prob_out_dir, image_name+"_prob.tif")
         classify_image(image_path, model_path, class_out_path, prob_out_path,
-                       apply_mask, out_type, num_chunks)
+                       apply_mask, out_type, num_chunks, prob_datatype=prob_datatype, block_rows=block_rows)
 
 
 def reshape_raster_for_ml(image_array):
@@ -1845,56 +3264,347 @@ def reshape_prob_out_to_raster(probs, width, height):
     return image_array
 
 
-def create_trained_model(training_image_file_paths, cross_val_repeats = 5, attribute="CODE"):
+def create_trained_model(training_image_file_paths, cross_val_repeats = 5, attribute="CODE", n_jobs=4, cv_jobs=1,
+                         reuse_fold_models=False, training_set_path=None, chunk_rows=None, threads=1):
     """Returns a trained random forest model from the training data. This
     assumes that image and model are in the same directory, with a shapefile.
     Give training_image_path a path to a list of .tif files. See spec in the R drive for data structure.
-    At present, the model is an ExtraTreesClassifier arrived at by tpot; see tpot_classifier_kenya -> tpot 1)"""
-    # This could be optimised by pre-allocating the training array. but not now.
-    learning_data = None
-    classes = None
-    for training_image_file_path in training_image_file_paths:
-        training_image_folder, training_image_name = os.path.split(training_image_file_path)
-        training_image_name = training_image_name[:-4]  # Strip the file extension
-        shape_path = os.path.join(training_image_folder, training_image_name, training_image_name + '.shp')
-        this_training_data, this_classes = get_training_data(training_image_file_path, shape_path, attribute)
-        if learning_data is None:
-            learning_data = this_training_data
-            classes = this_classes
-        else:
-            learning_data = np.append(learning_data, this_training_data, 0)
-            classes = np.append(classes, this_classes)
-    model = ens.ExtraTreesClassifier(bootstrap=False, criterion="gini", max_features=0.55, min_samples_leaf=2,
-                                     min_samples_split=16, n_estimators=100, n_jobs=4, class_weight='balanced')
+    At present, the model is an ExtraTreesClassifier arrived at by tpot; see tpot_classifier_kenya -> tpot 1)
+    If training_set_path is given, the training set is built as a memory-mapped .npy there, reading threads images
+    at once (see build_training_set). See train_model for the other arguments."""
+    learning_data, classes = build_training_set(training_image_file_paths, attribute, threads,
+                                                out_path=training_set_path)
+    return train_model(learning_data, classes, cross_val_repeats, n_jobs, cv_jobs, reuse_fold_models, chunk_rows)
+
+
+def get_default_model(n_jobs=4):
+    """Returns an untrained copy of the ExtraTreesClassifier pyeo's models use, fitting with n_jobs cores"""
+    return ens.ExtraTreesClassifier(bootstrap=False, criterion="gini", max_features=0.55, min_samples_leaf=2,
+                                    min_samples_split=16, n_estimators=100, n_jobs=n_jobs, class_weight='balanced')
+
+
+def train_model(learning_data, classes, cv=5, n_jobs=4, cv_jobs=1, reuse_fold_models=False, chunk_rows=None,
+                model=None, random_state=None):
+    """
+    Fits a model and scores it with stratified k-fold cross validation.
+
+    Parameters
+    ----------
+    learning_data : array
+        One row of features per pixel; can be a np.memmap, eg from load_training_set.
+    classes : array
+        The class of each row.
+    cv : int, optional
+        The number of cross validation folds.
+    n_jobs : int, optional
+        The number of cores each model fits with; -1 for all of them.
+    cv_jobs : int, optional
+        The number of folds to fit at once. Each fold also uses n_jobs cores.
+    reuse_fold_models : bool, optional
+        If True, the returned model is an equal share of the trees of each fold model combined (see merge_forests)
+        instead of a separate fit on all of the data, saving one fit.
+    chunk_rows : int, optional
+        If given and there are more rows than this, the model is fitted out-of-core with fit_model_in_chunks
+        instead, and is not cross validated.
+    model : sklearn classifier, optional
+        The model to fit. Defaults to get_default_model(n_jobs).
+    random_state : int, optional
+        Seeds the row sampling of fit_model_in_chunks.
+
+    Returns
+    -------
+    A tuple of (model, scores); scores is an array of the accuracy on each fold, or None if fitted in chunks.
+    """
+    log = logging.getLogger(__name__)
+    if model is None:
+        model = get_default_model(n_jobs)
+    if chunk_rows and len(classes) > chunk_rows:
+        log.info("Fitting model on {} rows in chunks of {}".format(len(classes), chunk_rows))
+        return fit_model_in_chunks(model, learning_data, classes, chunk_rows, random_state), None
+
+    def fit_fold(train_index, test_index):
+        fold_model = clone(model)
+        fold_model.fit(learning_data[train_index], classes[train_index])
+        return fold_model, fold_model.score(learning_data[test_index], classes[test_index])
+
+    log.info("Fitting {} folds, {} at a time".format(cv, cv_jobs))
+    folds = StratifiedKFold(n_splits=cv).split(learning_data, classes)
+    fold_results = joblib.Parallel(n_jobs=cv_jobs, prefer="threads")(
+        joblib.delayed(fit_fold)(train_index, test_index) for train_index, test_index in folds)
+    scores = np.array([score for _, score in fold_results])
+    log.info("Cross validation scores: {}".format(scores))
+    if reuse_fold_models:
+        return merge_forests([fold_model for fold_model, _ in fold_results], model.n_estimators, random_state), \
+               scores
     model.fit(learning_data, classes)
-    scores = cross_val_score(model, learning_data, classes, cv=cross_val_repeats)
     return model, scores
 
 
-def create_model_for_region(path_to_region, model_out, scores_out, attribute="CODE"):
-    """Creates a model based on training data for files in a given region"""
+def merge_forests(models, n_estimators=None, random_state=None):
+    """Returns one forest containing the trees of every fitted forest in models. The forests must have been fitted
+    on the same classes. If n_estimators is given, the merged forest has that many trees, drawn at random in equal
+    shares from each forest, instead of all of them."""
+    merged = copy.deepcopy(models[0])
+    for model in models[1:]:
+        if not np.array_equal(model.classes_, merged.classes_):
+            raise ValueError("Cannot merge forests fitted on different classes")
+    if n_estimators is None:
+        merged.estimators_ = [tree for model in models for tree in model.estimators_]
+    else:
+        random_generator = np.random.RandomState(random_state)
+        tree_counts = [len(share) for share in np.array_split(np.arange(n_estimators), len(models))]
+        merged.estimators_ = [model.estimators_[tree_index] for model, tree_count in zip(models, tree_counts)
+                              for tree_index in np.sort(random_generator.choice(len(model.estimators_), tree_count,
+                                                                                replace=False))]
+    merged.n_estimators = len(merged.estimators_)
+    return merged
+
+
+def fit_model_in_chunks(model, learning_data, classes, chunk_rows, random_state=None):
+    """Fits a forest chunk_rows rows at a time, so that only one chunk of learning_data (eg a memory-mapped training
+    set) is in memory at once. Each chunk is a random sample of the rows and adds an equal share of
+    model.n_estimators trees to the forest using warm_start, so the forest ends up with model.n_estimators trees.
+    Every chunk must contain every class."""
+    log = logging.getLogger(__name__)
+    chunk_count = int(np.ceil(len(classes)/chunk_rows))
+    row_order = np.random.RandomState(random_state).permutation(len(classes))
+    all_classes = np.unique(classes)
+    # Spread the trees as evenly as possible, with any remainder going one each to the first chunks
+    chunk_tree_counts = [len(share) for share in np.array_split(np.arange(model.n_estimators), chunk_count)]
+    if model.get_params().get("class_weight") == "balanced":
+        # Balance on the class frequencies of all of the rows, not each chunk's
+        class_weights = compute_class_weight("balanced", classes=all_classes, y=classes)
+        model.set_params(class_weight=dict(zip(all_classes, class_weights)))
+    model.set_params(warm_start=True, n_estimators=0)
+    for chunk_index in range(chunk_count):
+        chunk_index_rows = np.sort(row_order[chunk_index::chunk_count])
+        chunk_classes = classes[chunk_index_rows]
+        if not np.array_equal(np.unique(chunk_classes), all_classes):
+            raise ValueError("Chunk {} is missing classes; use a larger chunk_rows".format(chunk_index))
+        log.info("Fitting chunk {} of {}".format(chunk_index + 1, chunk_count))
+        if chunk_tree_counts[chunk_index] == 0:
+            log.warning("Skipping chunk {}; there are more chunks than trees".format(chunk_index + 1))
+            continue
+        model.set_params(n_estimators=model.n_estimators + chunk_tree_counts[chunk_index])
+        model.fit(learning_data[chunk_index_rows], chunk_classes)
+    model.set_params(warm_start=False)
+    return model
+
+
+def load_training_set(training_set_path):
+    """Memory-maps a training set saved by build_training_set with out_path. Returns (learning_data, classes)."""
+    learning_data = np.load(training_set_path, mmap_mode="r")
+    classes = np.load(os.path.splitext(training_set_path)[0] + "_classes.npy")
+    return learning_data, classes
+
+
+def get_training_shape_path(training_image_file_path):
+    """Returns the path to the shapefile for a training image; for image.tif, this is image/image.shp"""
+    training_image_folder, training_image_name = os.path.split(training_image_file_path)
+    training_image_name = training_image_name[:-4]  # Strip the file extension
+    return os.path.join(training_image_folder, training_image_name, training_image_name + '.shp')
+
+
+def build_training_set(training_image_file_paths, attribute="CODE", threads=1, out_path=None,
+                       max_samples_per_class=None, random_state=None):
+    """
+    Builds one training set from several training images, each with a shapefile at get_training_shape_path.
+
+    The polygons for every image are rasterised first to count the training pixels, then one array of the right
+    size is allocated and the pixels of each image are read straight into their rows of it.
+
+    Parameters
+    ----------
+    training_image_file_paths : list of str
+        Paths to the training images.
+    attribute : str, optional
+        The shapefile field holding the class.
+    threads : int, optional
+        The number of images to rasterise and read at once.
+    out_path : str, optional
+        If given, the training data is written to a memory-mapped .npy file here instead of held in memory, and the
+        classes are saved alongside it with the suffix _classes.npy.
+    max_samples_per_class, random_state : optional
+        Passed to get_training_pixels for each image.
+
+    Returns
+    -------
+    A tuple of (learning_data, classes), suitable for model.fit. learning_data is a np.memmap if out_path is given.
+    """
+    log = logging.getLogger(__name__)
+
+    def get_image_pixels(training_image_file_path):
+        return get_training_pixels(training_image_file_path, get_training_shape_path(training_image_file_path),
+                                   attribute, max_samples_per_class=max_samples_per_class,
+                                   random_state=random_state)
+
+    with ThreadPool(threads) as pool:
+        image_pixels = pool.map(get_image_pixels, training_image_file_paths)
+    row_counts = [len(features) for _, _, features in image_pixels]
+    band_count = gdal.Open(training_image_file_paths[0]).RasterCount
+    log.info("Building training set of {} pixels from {} images".format(sum(row_counts), len(row_counts)))
+    if out_path:
+        learning_data = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float64,
+                                                  shape=(sum(row_counts), band_count))
+    else:
+        learning_data = np.empty((sum(row_counts), band_count), dtype=np.float64)
+    classes = np.concatenate([features for _, _, features in image_pixels])
+    row_starts = np.cumsum([0] + row_counts)
+
+    def read_image_pixels(image_index):
+        y, x, _ = image_pixels[image_index]
+        read_training_pixels(training_image_file_paths[image_index], y, x,
+                             out=learning_data[row_starts[image_index]: row_starts[image_index + 1]])
+
+    with ThreadPool(threads) as pool:
+        pool.map(read_image_pixels, range(len(training_image_file_paths)))
+    if out_path:
+        learning_data.flush()
+        np.save(os.path.splitext(out_path)[0] + "_classes.npy", classes)
+    return learning_data, classes
+
+
+def create_model_for_region(path_to_region, model_out, scores_out, attribute="CODE", n_jobs=4, cv_jobs=1,
+                            reuse_fold_models=False, threads=1):
+    """Creates a model based on training data for files in a given region. See train_model for n_jobs, cv_jobs and
+    reuse_fold_models, and build_training_set for threads."""
     image_glob = os.path.join(path_to_region, r"*.tif")
     image_list = glob.glob(image_glob)
-    model, scores = create_trained_model(image_list, attribute=attribute)
-    joblib.dump(model, model_out)
+    model, scores = create_trained_model(image_list, attribute=attribute, n_jobs=n_jobs, cv_jobs=cv_jobs,
+                                         reuse_fold_models=reuse_fold_models, threads=threads)
+    save_model(model, model_out)
     with open(scores_out, 'w') as score_file:
         score_file.write(str(scores))
 
 
-def create_model_from_signatures(sig_csv_path, model_out):
-    model = ens.ExtraTreesClassifier(bootstrap=False, criterion="gini", max_features=0.55, min_samples_leaf=2,
-                                     min_samples_split=16, n_estimators=100, n_jobs=4, class_weight='balanced')
-    data = np.loadtxt(sig_csv_path, delimiter=",").T
-    model.fit(data[1:, :].T, data[0, :])
-    joblib.dump(model, model_out)
+def create_model_from_signatures(sig_csv_path, model_out, n_jobs=4, chunk_rows=None):
+    """Fits a model to signatures and saves it to model_out. sig_csv_path can be a signature store (see
+    append_signatures), which is memory-mapped, or a csv of class, band 1, band 2... rows. See train_model for
+    chunk_rows."""
+    model = get_default_model(n_jobs)
+    if os.path.isdir(sig_csv_path):
+        features, classes = load_signatures(sig_csv_path)
+    else:
+        data = np.loadtxt(sig_csv_path, delimiter=",")
+        features, classes = data[:, 1:], data[:, 0]
+    if chunk_rows and len(classes) > chunk_rows:
+        model = fit_model_in_chunks(model, features, classes, chunk_rows)
+    else:
+        model.fit(features, classes)
+    save_model(model, model_out)
+
+
+SIGNATURE_INDEX_NAME = "signatures.json"
+
+
+def read_signature_index(store_path):
+    """Returns the index of the signature store at store_path, or None if there isn't one"""
+    index_path = os.path.join(store_path, SIGNATURE_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as index_file:
+        return json.load(index_file)
+
+
+def append_signatures(store_path, features, classes, source_image=None, band_names=None, dtype=np.float32):
+    """
+    Appends signatures to a signature store, creating it if needed.
 
+    A signature store is a directory holding every signature's band values in features.bin and its class in
+    classes.bin, one row after another in raw binary, and an index, signatures.json. The index records the dtype and
+    band count, the number of rows and, for each append, the source image, the rows it added and the band names.
+    Reading the store back with load_signatures memory-maps the binary files, so no parsing is needed.
 
-def get_training_data(image_path, shape_path, attribute="CODE", shape_projection_id=4326):
+    Parameters
+    ----------
+    store_path : str
+        The directory of the store.
+    features : array
+        One row of band values per signature.
+    classes : array
+        The class of each signature.
+    source_image : str, optional
+        The image the signatures came from.
+    band_names : list of str, optional
+        The name of each band.
+    dtype : numpy dtype, optional
+        The dtype to store band values as when creating the store.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    index = read_signature_index(store_path)
+    if index is None:
+        index = {"dtype": np.dtype(dtype).str, "band_count": features.shape[1], "rows": 0, "sources": []}
+    if features.shape[1] != index["band_count"]:
+        raise ValueError("Signatures have {} bands, but the store at {} has {}".format(
+            features.shape[1], store_path, index["band_count"]))
+    feature_dtype = np.dtype(index["dtype"])
+    for file_name, rows, row_dtype, row_width in (("features.bin", features, feature_dtype, index["band_count"]),
+                                                  ("classes.bin", classes, np.dtype(np.int32), 1)):
+        with open(os.path.join(store_path, file_name), 'ab') as store_file:
+            # Drop anything written by an append that failed before updating the index
+            store_file.truncate(index["rows"]*row_width*row_dtype.itemsize)
+            store_file.write(np.ascontiguousarray(rows, dtype=row_dtype).tobytes())
+    index["sources"].append({"image": source_image, "start": index["rows"], "rows": len(classes),
+                             "bands": band_names})
+    index["rows"] += len(classes)
+    index_path = os.path.join(store_path, SIGNATURE_INDEX_NAME)
+    with open(index_path + ".tmp", 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+    os.replace(index_path + ".tmp", index_path)
+    return store_path
+
+
+def load_signatures(store_path, mmap=True):
+    """Returns (features, classes) from the signature store at store_path; see append_signatures. If mmap is True,
+    features is a read-only np.memmap instead of being read into memory."""
+    index = read_signature_index(store_path)
+    if index is None:
+        raise FileNotFoundError("No signature store at {}".format(store_path))
+    shape = (index["rows"], index["band_count"])
+    features_path = os.path.join(store_path, "features.bin")
+    classes = np.fromfile(os.path.join(store_path, "classes.bin"), dtype=np.int32, count=index["rows"])
+    if index["rows"] == 0:
+        return np.empty(shape, dtype=index["dtype"]), classes
+    if mmap:
+        return np.memmap(features_path, dtype=index["dtype"], mode="r", shape=shape), classes
+    return np.fromfile(features_path, dtype=index["dtype"], count=shape[0]*shape[1]).reshape(shape), classes
+
+
+def extract_signatures(training_image_file_paths, store_path, attribute="CODE"):
+    """Appends the signatures under the training polygons of each image (see get_training_shape_path) to the
+    signature store at store_path, recording the image and its band descriptions. Returns store_path."""
+    log = logging.getLogger(__name__)
+    for training_image_file_path in training_image_file_paths:
+        log.info("Extracting signatures from {}".format(training_image_file_path))
+        features, classes = get_training_data(training_image_file_path,
+                                              get_training_shape_path(training_image_file_path), attribute)
+        image = gdal.Open(training_image_file_path)
+        band_names = [image.GetRasterBand(band_index).GetDescription()
+                      for band_index in range(1, image.RasterCount + 1)]
+        image = None
+        append_signatures(store_path, features, classes, training_image_file_path, band_names)
+    return store_path
+
+
+def get_training_data(image_path, shape_path, attribute="CODE", shape_projection_id=4326, max_samples_per_class=None,
+                      random_state=None):
     """Given an image and a shapefile with categories, return x and y suitable
     for feeding into random_forest.fit.
+    Only the window of the image under the training polygons is read. If max_samples_per_class is given, at most
+    that many pixels of each class are picked at random (seeded with random_state); see get_stratified_sample_indices.
     Note: THIS WILL FAIL IF YOU HAVE ANY CLASSES NUMBERED '0'
     WRITE A TEST FOR THIS TOO; if this goes wrong, it'll go wrong quietly and in a way that'll cause the most issues
      further on down the line."""
+    y, x, features = get_training_pixels(image_path, shape_path, attribute, shape_projection_id,
+                                         max_samples_per_class, random_state)
+    return read_training_pixels(image_path, y, x), features
+
+
+def get_training_pixels(image_path, shape_path, attribute="CODE", shape_projection_id=4326,
+                        max_samples_per_class=None, random_state=None):
+    """Rasterises the polygons in shape_path onto the grid of the image at image_path. Returns a tuple of arrays
+    (y, x, features); the pixel coordinates in the image of every training pixel and its class. See get_training_data
+    for max_samples_per_class and random_state."""
     with TemporaryDirectory() as td:
         shape_projection = osr.SpatialReference()
         shape_projection.ImportFromEPSG(shape_projection_id)
@@ -1914,19 +3624,51 @@ def get_training_data(image_path, shape_path, attribute="CODE", shape_projection
         # This can probably be fixed.
         gdal.Rasterize(ras_path, shape_path, options=ras_params)
         rasterised_shapefile = gdal.Open(ras_path)
-        shape_array = rasterised_shapefile.GetVirtualMemArray()
+        shape_array = rasterised_shapefile.ReadAsArray()
         local_x, local_y = get_local_top_left(image, rasterised_shapefile)
-        shape_sparse = sp.coo_matrix(shape_array)
-        y, x, features = sp.find(shape_sparse)
-        training_data = np.empty((len(features), image.RasterCount))
-        image_array = image.GetVirtualMemArray()
-        image_view = image_array[:,
-                    local_y: local_y + rasterised_shapefile.RasterYSize,
-                    local_x: local_x + rasterised_shapefile.RasterXSize
-                    ]
-        for index in range(len(features)):
-            training_data[index, :] = image_view[:, y[index], x[index]]
-        return training_data, features
+        rasterised_shapefile = None
+    y, x = np.nonzero(shape_array)
+    features = shape_array[y, x]
+    shape_array = None
+    y += local_y
+    x += local_x
+    in_image = (x >= 0) & (x < image.RasterXSize) & (y >= 0) & (y < image.RasterYSize)
+    y, x, features = y[in_image], x[in_image], features[in_image]
+    if max_samples_per_class:
+        sample_indices = get_stratified_sample_indices(features, max_samples_per_class, random_state)
+        y, x, features = y[sample_indices], x[sample_indices], features[sample_indices]
+    return y, x, features
+
+
+def read_training_pixels(image_path, y, x, out=None):
+    """Returns an array of the values of every band of the image at image_path at the pixel coordinates y and x, one
+    row per pixel. Only the window of the image around the pixels is read. If out is given, the values are written
+    into it instead of a new float64 array."""
+    image = gdal.Open(image_path)
+    if out is None:
+        out = np.empty((len(y), image.RasterCount), dtype=np.float64)
+    if len(y) == 0:
+        return out
+    x_min, y_min = x.min(), y.min()
+    image_view = image.ReadAsArray(int(x_min), int(y_min), int(x.max() - x_min + 1), int(y.max() - y_min + 1))
+    if image_view.ndim == 2:
+        image_view = np.expand_dims(image_view, 0)
+    out[:] = image_view[:, y - y_min, x - x_min].T
+    return out
+
+
+def get_stratified_sample_indices(classes, max_per_class, random_state=None):
+    """Returns the sorted indices of at most max_per_class randomly chosen elements of each class in classes"""
+    random_generator = np.random.RandomState(random_state)
+    sample_indices = []
+    for class_value in np.unique(classes):
+        class_indices = np.flatnonzero(classes == class_value)
+        if len(class_indices) > max_per_class:
+            class_indices = random_generator.choice(class_indices, max_per_class, replace=False)
+        sample_indices.append(class_indices)
+    if not sample_indices:
+        return np.empty(0, dtype=int)
+    return np.sort(np.concatenate(sample_indices))
 
 
 def get_local_top_left(raster1, raster2):
@@ -1948,7 +3690,8 @@ def raster_to_array(rst_pth):
     return out_array
 
 
-def raster_reclass_binary(img_path, rcl_value, outFn, outFmt='GTiff', write_out=True):
+def raster_reclass_binary(img_path, rcl_value, outFn, outFmt='GTiff', write_out=True, compute_stats=True,
+                          build_overviews=True, overview_stage=None):
     """Takes a raster and reclassifies the values
 
 
@@ -1957,7 +3700,12 @@ def raster_reclass_binary(img_path, rcl_value, outFn, outFmt='GTiff', write_out=
     :param str outFn: Output file name.
     :param str outFmt: Output format. Set to GTiff by default. Other GDAL options available.
     :param write_out: Boolean. Set to True by default. Will write raster to disk. If False, only an array is returned
+    :param compute_stats: Boolean. Set to True by default. Computes statistics for the output raster.
+    :param build_overviews: Boolean. Set to True by default. Builds nearest neighbour overviews for the output raster.
+    :param overview_stage: An OverviewStage. If given, statistics and nearest neighbour overviews are left to it
+    instead of being made before returning.
     :return: Reclassifies numpy array
+    For reclassifying many rasters, or by more than one value, see reclassify_raster and reclassify_directory.
     """
     log = logging.getLogger(__name__)
     log.info('Starting raster reclassifcation.')
@@ -1967,8 +3715,7 @@ def raster_reclass_binary(img_path, rcl_value, outFn, outFmt='GTiff', write_out=
     in_array = in_band.ReadAsArray()
 
     # reclassify
-    in_array[in_array != rcl_value] = 0
-    in_array[in_array == rcl_value] = 1
+    in_array = (in_array == rcl_value).astype(in_array.dtype)
 
     if write_out:
         driver = gdal.GetDriverByName(outFmt)
@@ -1979,71 +3726,290 @@ def raster_reclass_binary(img_path, rcl_value, outFn, outFmt='GTiff', write_out=
         # Todo: Check for existing files. Skip if exists or make overwrite optional.
         out_ds.GetRasterBand(1).WriteArray(in_array)
 
-        # write the data to disk
-        out_ds.FlushCache()
-
-        # Compute statistics on each output band
-        # setting ComputeStatistics to false calculates stats on all pixels not estimates
-        out_ds.GetRasterBand(1).ComputeStatistics(False)
-
-        out_ds.BuildOverviews("average", [2, 4, 8, 16, 32])
+        # write the data to disk, computing statistics on all pixels rather than estimates
+        if overview_stage:
+            out_ds = None
+            overview_stage.submit(outFn, "class")
+        else:
+            add_statistics_and_overviews(out_ds, compute_stats, build_overviews,
+                                         resampling=OVERVIEW_RESAMPLING["class"])
 
         out_ds = None
 
     return in_array
 
 
-def raster_sum(inRstList, outFn, outFmt='GTiff'):
-    """Creates a raster stack from a list of rasters. Adapted from Chris Gerard's
-    book 'Geoprocessing with Python'. The out put data type is the same as the input data type.
+def build_reclass_lut(mapping, default=0, dtype=np.uint8):
+    """Returns a lookup table array where lut[old_value] is mapping[old_value], or default for values not in the
+    mapping. The keys of mapping must be non-negative integers."""
+    if not mapping:
+        raise ValueError("Cannot reclassify with an empty mapping")
+    if not _has_lut_keys(mapping):
+        raise ValueError("Lookup table keys must be non-negative integers, got {}".format(list(mapping)))
+    lut = np.full(max(mapping) + 1, default, dtype=dtype)
+    for old_value, new_value in mapping.items():
+        lut[old_value] = new_value
+    return lut
+
+
+def _has_lut_keys(mapping):
+    """True if every key of mapping can index a lookup table"""
+    return all(isinstance(old_value, (int, np.integer)) and old_value >= 0 for old_value in mapping)
+
+
+def reclassify_array(array, mapping, default=0, dtype=np.uint8, lut=None):
+    """Returns array reclassified with mapping, a dict of {old value: new value}, as dtype. Values not in the
+    mapping become default. Integer arrays with non-negative integer keys go through a lookup table (lut, built with
+    build_reclass_lut if not given); anything else, such as float data, is matched value by value."""
+    if not mapping:
+        raise ValueError("Cannot reclassify with an empty mapping")
+    if np.issubdtype(array.dtype, np.integer) and _has_lut_keys(mapping):
+        if lut is None:
+            lut = build_reclass_lut(mapping, default, dtype)
+        in_lut = (array >= 0) & (array < len(lut))
+        return np.where(in_lut, lut[np.where(in_lut, array, 0)], default).astype(dtype, copy=False)
+    return np.select([array == old_value for old_value in mapping], list(mapping.values()), default).astype(dtype)
+
+
+def reclassify_raster(in_path, out_path, mapping, default=0, out_datatype=gdal.GDT_Byte, out_format="GTiff",
+                      block_rows=512, compute_stats=False, build_overviews=False):
+    """Reclassifies the first band of the raster at in_path using mapping, a dict of {old value: new value}, a block
+    of rows at a time; see reclassify_array. Values not in the mapping (including negative ones) become default.
+    Statistics and overviews are only made if asked for; see add_statistics_and_overviews. Returns out_path."""
+    if not mapping:
+        raise ValueError("Cannot reclassify {} with an empty mapping".format(in_path))
+    out_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(out_datatype)
+    lut = build_reclass_lut(mapping, default, out_dtype) if _has_lut_keys(mapping) else None
+    in_raster = gdal.Open(in_path)
+    in_band = in_raster.GetRasterBand(1)
+    out_raster = create_matching_dataset(in_raster, out_path, format=out_format, datatype=out_datatype)
+    for y_offset, y_size in iterate_row_blocks(in_raster, block_rows):
+        in_block = in_band.ReadAsArray(0, y_offset, in_raster.RasterXSize, y_size)
+        out_raster.GetRasterBand(1).WriteArray(reclassify_array(in_block, mapping, default, out_dtype, lut),
+                                               0, y_offset)
+    if compute_stats or build_overviews:
+        add_statistics_and_overviews(out_raster, compute_stats, build_overviews,
+                                     resampling=OVERVIEW_RESAMPLING["class"])
+    out_raster = None
+    in_raster = None
+    return out_path
+
+
+def reclassify_directory(in_dir, out_dir, mapping, default=0, suffix="_rcl", processes=1, out_datatype=gdal.GDT_Byte,
+                         compute_stats=False, build_overviews=False, extension=".tif"):
+    """Reclassifies every raster ending with extension in in_dir into out_dir with reclassify_raster, adding suffix
+    to each file name. Rasters are reclassified in a pool of processes if processes > 1. Returns the output paths."""
+    log = logging.getLogger(__name__)
+    os.makedirs(out_dir, exist_ok=True)
+    in_paths = sorted(os.path.join(in_dir, file_name) for file_name in os.listdir(in_dir)
+                      if file_name.endswith(extension) and not file_name.endswith(suffix + extension))
+    raster_args = [(in_path,
+                    os.path.join(out_dir, os.path.basename(in_path)[:-len(extension)] + suffix + extension),
+                    mapping, default, out_datatype, "GTiff", 512, compute_stats, build_overviews)
+                   for in_path in in_paths]
+    log.info("Reclassifying {} rasters in {} with {} processes".format(len(raster_args), in_dir, processes))
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            return pool.starmap(reclassify_raster, raster_args)
+    return [reclassify_raster(*args) for args in raster_args]
+
+
+def raster_sum(inRstList, outFn, outFmt='GTiff', overview_stage=None):
+    """Sums a list of single band rasters. Adapted from Chris Gerard's
+    book 'Geoprocessing with Python'. The output is 32 bit integer for integer inputs and 64 bit float otherwise,
+    so that it cannot overflow; see aggregate_rasters.
 
     :param str inRstList: List of rasters to stack.
     :param str outFmt: String specifying the input data format e.g. 'GTiff' or 'VRT'.
     :param str outFn: Filename output as str including directory else image will be
     written to current working directory.
+    :param overview_stage: An OverviewStage. If given, statistics and overviews are left to it instead of being
+    made before returning.
     """
     log = logging.getLogger(__name__)
     log.info('Starting raster sum function.')
+    if overview_stage:
+        aggregate_rasters(inRstList, outFn, "sum", outFmt)
+        overview_stage.submit(outFn, "sum")
+    else:
+        aggregate_rasters(inRstList, outFn, "sum", outFmt, compute_stats=True, build_overviews=True)
+    log.info('Finished summing up of raster layers.')
 
-    # open 1st band to get info
-    in_ds = gdal.Open(inRstList[0])
-    in_band = in_ds.GetRasterBand(1)
-
-    # Get raster shape
-    rst_dim = (in_band.YSize, in_band.XSize)
-
-    # initiate empty array
-    empty_arr = np.empty(rst_dim, dtype=np.uint8)
-
-    for i, rst in enumerate(inRstList):
-        #Todo: Check that dimensions and shape of both arrays are the same in the first loop.
-        ds = gdal.Open(rst)
-        bnd = ds.GetRasterBand(1)
-        arr = bnd.ReadAsArray()
-        empty_arr = empty_arr + arr
-
-    # Create a 1 band GeoTiff with the same properties as the input raster
-    driver = gdal.GetDriverByName(outFmt)
-    out_ds = driver.Create(outFn, in_band.XSize, in_band.YSize, 1,
-                           in_band.DataType)
-    out_ds.SetProjection(in_ds.GetProjection())
-    out_ds.SetGeoTransform(in_ds.GetGeoTransform())
-
-    out_ds.GetRasterBand(1).WriteArray(empty_arr)
 
-    # write the data to disk
-    out_ds.FlushCache()
+AGGREGATE_STATISTICS = ("sum", "count", "mean", "min", "max")
 
-    # Compute statistics on each output band setting ComputeStatistics to false calculates stats on all pixels
-    # not estimates
-    out_ds.GetRasterBand(1).ComputeStatistics(False)
 
-    out_ds.BuildOverviews("average", [2, 4, 8, 16, 32])
+def aggregate_rasters(raster_paths, out_path, statistic="sum", out_format="GTiff", out_datatype=None,
+                      block_rows=512, read_threads=4, compute_stats=False, build_overviews=False):
+    """
+    Combines the first band of several rasters of the same size pixel by pixel, a block of rows at a time.
 
-    out_ds = None
+    Parameters
+    ----------
+    raster_paths : list of str
+        The rasters to combine.
+    out_path : str
+        Where to write the single band output.
+    statistic : str, optional
+        One of 'sum', 'count' (the number of rasters that are not 0), 'mean', 'min' or 'max'.
+    out_format : str, optional
+        A gdal driver name.
+    out_datatype : int, optional
+        A gdal datatype for the output. Defaults to 32 bit integer for the sum of integers, 16 or 32 bit unsigned
+        integer for counts, 32 bit float for means, 64 bit float for floating point sums, and the input datatype for
+        min and max.
+        Accumulation is always done in 64 bits, so only the output datatype can overflow.
+    block_rows : int, optional
+        The number of rows of every raster to hold in memory at once.
+    read_threads : int, optional
+        The number of rasters to read ahead in parallel.
+    compute_stats, build_overviews : bool, optional
+        Whether to add statistics and overviews to the output; see add_statistics_and_overviews.
+
+    Returns
+    -------
+    out_path
+    """
+    log = logging.getLogger(__name__)
+    if statistic not in AGGREGATE_STATISTICS:
+        raise ValueError("statistic must be one of {}".format(AGGREGATE_STATISTICS))
+    log.info("Taking the {} of {} rasters into {}".format(statistic, len(raster_paths), out_path))
+    rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
+    first_raster = rasters[0]
+    for raster_path, raster in zip(raster_paths, rasters):
+        if (raster.RasterXSize, raster.RasterYSize) != (first_raster.RasterXSize, first_raster.RasterYSize):
+            raise ValueError("{} is not the same size as {}".format(raster_path, raster_paths[0]))
+    in_datatype = first_raster.GetRasterBand(1).DataType
+    is_integer = np.issubdtype(gdal_array.GDALTypeCodeToNumericTypeCode(in_datatype), np.integer)
+    if out_datatype is None:
+        out_datatype = {
+            "sum": gdal.GDT_Int32 if is_integer else gdal.GDT_Float64,
+            "count": gdal.GDT_UInt16 if len(rasters) < 2**16 else gdal.GDT_UInt32,
+            "mean": gdal.GDT_Float32,
+            "min": in_datatype,
+            "max": in_datatype
+        }[statistic]
+    accumulator_dtype = np.int64 if is_integer or statistic == "count" else np.float64
+    out_raster = create_matching_dataset(first_raster, out_path, format=out_format, datatype=out_datatype)
+
+    def read_block(raster_index):
+        return rasters[raster_index].GetRasterBand(1).ReadAsArray(0, y_offset, first_raster.RasterXSize, y_size)
+
+    with ThreadPool(read_threads) as pool:
+        for y_offset, y_size in iterate_row_blocks(first_raster, block_rows):
+            accumulator = np.zeros((y_size, first_raster.RasterXSize), dtype=accumulator_dtype)
+            # imap reads the following rasters' blocks while this one is added in
+            for raster_index, block in enumerate(pool.imap(read_block, range(len(rasters)))):
+                if statistic == "count":
+                    np.add(accumulator, block != 0, out=accumulator)
+                elif statistic in ("sum", "mean"):
+                    np.add(accumulator, block, out=accumulator)
+                elif raster_index == 0:
+                    accumulator[:] = block
+                elif statistic == "min":
+                    np.minimum(accumulator, block, out=accumulator)
+                else:
+                    np.maximum(accumulator, block, out=accumulator)
+            if statistic == "mean":
+                accumulator = accumulator/len(rasters)
+            out_raster.GetRasterBand(1).WriteArray(accumulator, 0, y_offset)
+    if compute_stats or build_overviews:
+        add_statistics_and_overviews(out_raster, compute_stats, build_overviews)
+    out_raster = None
+    rasters = None
+    return out_path
 
-    log.info('Finished summing up of raster layers.')
 
+def add_statistics_and_overviews(raster, compute_stats=True, build_overviews=True, approx_stats=False,
+                                 resampling="average", overview_levels=(2, 4, 8, 16, 32)):
+    """Computes statistics for every band of an open raster and/or builds its overviews with the given resampling"""
+    raster.FlushCache()
+    if compute_stats:
+        for band_index in range(1, raster.RasterCount + 1):
+            raster.GetRasterBand(band_index).ComputeStatistics(approx_stats)
+    if build_overviews:
+        raster.BuildOverviews(resampling, list(overview_levels))
+
+
+# Default overview resampling for each type of output; classes must not be averaged
+OVERVIEW_RESAMPLING = {
+    "class": "nearest",
+    "mask": "nearest",
+    "probability": "average",
+    "certainty": "average",
+    "reflectance": "average",
+    "sum": "average"
+}
+
+
+def get_overview_resampling(output_type, resampling=None):
+    """Returns the overview resampling method for output_type. resampling can be a method (eg "nearest") to use for
+    every type, or a dict of output types to methods overriding OVERVIEW_RESAMPLING; if None, OVERVIEW_RESAMPLING
+    is used."""
+    if isinstance(resampling, str):
+        return resampling
+    methods = dict(OVERVIEW_RESAMPLING, **(resampling or {}))
+    if output_type not in methods:
+        raise ValueError("output_type must be one of {}".format(list(methods)))
+    return methods[output_type]
+
+
+def add_raster_overviews(raster_path, output_type="reflectance", exact_stats=False,
+                         overview_levels=(2, 4, 8, 16, 32), resampling=None):
+    """Adds statistics and overviews to the finished raster at raster_path, resampling overviews as given for
+    output_type by get_overview_resampling. Statistics are approximate unless exact_stats is True. The raster is
+    opened read-only, so overviews go to a .ovr file and statistics to a .aux.xml file, and the raster itself can be
+    read while this runs. Returns raster_path."""
+    raster = gdal.Open(raster_path)
+    add_statistics_and_overviews(raster, approx_stats=not exact_stats,
+                                 resampling=get_overview_resampling(output_type, resampling),
+                                 overview_levels=overview_levels)
+    raster = None
+    return raster_path
+
+
+class OverviewStage:
+    """Adds statistics and overviews to finished rasters in a pool of background threads (see add_raster_overviews),
+    so that the pipeline writing them doesn't wait. Call close() or use as a context manager to wait for them.
+    resampling overrides the overview resampling of every raster in the stage; see get_overview_resampling."""
+
+    def __init__(self, workers=2, exact_stats=False, overview_levels=(2, 4, 8, 16, 32), resampling=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.exact_stats = exact_stats
+        self.overview_levels = overview_levels
+        self.resampling = resampling
+        self.futures = []
+
+    def submit(self, raster_path, output_type="reflectance", resampling=None):
+        """Queues raster_path for statistics and overviews. If given, resampling overrides the stage's resampling
+        for this raster. Returns a future of the path."""
+        resampling = get_overview_resampling(output_type, resampling or self.resampling)
+        future = self.executor.submit(add_raster_overviews, raster_path, output_type, self.exact_stats,
+                                      self.overview_levels, resampling)
+        self.futures.append(future)
+        return future
+
+    def wait(self):
+        """Waits for every queued raster, logging any that fail. Returns the paths that succeeded."""
+        log = logging.getLogger(__name__)
+        done = []
+        for future in concurrent.futures.as_completed(self.futures):
+            try:
+                done.append(future.result())
+            except Exception:
+                log.exception("Building overviews failed")
+        self.futures = []
+        return done
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def filter_by_class_map(image_path, class_map_path, out_map_path, classes_of_interest, out_resolution=10):
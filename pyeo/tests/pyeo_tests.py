@@ -1,7 +1,18 @@
 import os, sys
+import datetime as dt
+import json
+import hashlib
+import threading
+import http.server
+import socketserver
+import io
+import struct
+import zipfile
 from tempfile import TemporaryDirectory
 import numpy as np
-import gdal, ogr
+import pytest
+import gdal, ogr, osr
+import sklearn.ensemble as ens
 sys.path.insert(0, os.path.abspath(os.path.join(__file__, '..', '..','..')))
 import pyeo.core as pyeo
 
@@ -190,4 +201,839 @@ def test_sort_by_timestamp():
 
 
 #def test_combine_masks_or():
-#    with Tempor
\ No newline at end of file
+#    with Tempor
+
+def test_preprocess_sen2_images_skips_existing():
+    with TemporaryDirectory() as td:
+        l2_dir = os.path.join(td, "L2")
+        out_dir = os.path.join(td, "merged")
+        os.mkdir(l2_dir)
+        os.mkdir(out_dir)
+        safe_name = "S2A_MSIL2A_20180703T073611_N0206_R092_T37NBA_20180703T094637"
+        os.mkdir(os.path.join(l2_dir, safe_name + ".SAFE"))
+        for ext in (".tif", ".msk"):
+            open(os.path.join(out_dir, safe_name + ext), 'w').close()
+        summary = pyeo.preprocess_sen2_images(l2_dir, out_dir, td, processes=2)
+        assert summary["skipped"] == [os.path.join(l2_dir, safe_name + ".SAFE")]
+        assert summary["processed"] == [] and summary["failed"] == []
+
+
+def test_atmospheric_correction_cache_with_renamed_product():
+    # sen2cor can name its product differently from the name derived from the L1 image
+    with TemporaryDirectory() as td:
+        l1_path = os.path.join(td, "S2A_MSIL1C_20180703T073611_N0206_R092_T37NBA_20180703T094637.SAFE")
+        os.mkdir(l1_path)
+        out_dir = os.path.join(td, "L2")
+        os.mkdir(out_dir)
+        cache_path = os.path.join(td, "cache.db")
+        sen2cor_calls = []
+
+        def fake_sen2cor(image_path, sen2cor_path, delete_unprocessed_image=False):
+            sen2cor_calls.append(image_path)
+            l2_path = os.path.join(td, "S2A_MSIL2A_20180703T073611_N9999_R092_T37NBA_20180703T120000.SAFE")
+            os.mkdir(l2_path)
+            return l2_path
+
+        apply_sen2cor = pyeo.apply_sen2cor
+        pyeo.apply_sen2cor = fake_sen2cor
+        try:
+            expected_path = os.path.join(out_dir, os.path.basename(l1_path).replace("MSIL1C", "MSIL2A"))
+            for _ in range(2):
+                assert pyeo.atmospheric_correction_of_image(l1_path, out_dir, "sen2cor", cache_path=cache_path) \
+                       == expected_path
+            assert len(sen2cor_calls) == 1
+        finally:
+            pyeo.apply_sen2cor = apply_sen2cor
+
+
+def test_processing_cache():
+    with TemporaryDirectory() as td:
+        cache_path = os.path.join(td, "cache.db")
+        in_path = os.path.join(td, "in.tif")
+        out_path = os.path.join(td, "out.tif")
+        for path in (in_path, out_path):
+            with open(path, 'w') as f:
+                f.write("data")
+        key = pyeo.get_step_key("test_step", [in_path], {"buffer_size": 5})
+        assert key == pyeo.get_step_key("test_step", [in_path], {"buffer_size": 5})
+        assert key != pyeo.get_step_key("test_step", [in_path], {"buffer_size": 3})
+        assert not pyeo.is_step_cached(cache_path, [out_path], "test_step", key, adopt_existing=False)
+        pyeo.record_step(cache_path, [out_path], "test_step", key)
+        assert pyeo.is_step_cached(cache_path, [out_path], "test_step", key)
+        with open(in_path, 'w') as f:
+            f.write("changed data")
+        new_key = pyeo.get_step_key("test_step", [in_path], {"buffer_size": 5})
+        assert not pyeo.is_step_cached(cache_path, [out_path], "test_step", new_key)
+
+
+def test_scene_catalog():
+    with TemporaryDirectory() as td:
+        catalog_path = os.path.join(td, "catalog.db")
+        image_dir = os.path.join(td, "images")
+        os.mkdir(image_dir)
+        names = ["S2A_MSIL2A_20180514T073611_N0206_R092_T37NCA_20180514T095515.tif",
+                 "S2A_MSIL2A_20180524T073731_N0206_R092_T37NBA_20180524T113104.tif",
+                 "S2B_MSIL2A_20180608T073609_N0206_R092_T37NBA_20180608T095659.tif",
+                 "not_an_image.txt"]
+        for name in names:
+            open(os.path.join(image_dir, name), 'w').close()
+        out = pyeo.query_scene_catalog(catalog_path, directory=image_dir, tile="T37NBA")
+        assert [os.path.basename(path) for path in out] == [names[2], names[1]]
+        preceding = pyeo.get_preceding_image_path(names[2], image_dir, catalog_path=catalog_path)
+        assert preceding == os.path.join(image_dir, names[1])
+        assert pyeo.get_sen_2_tiles(image_dir, catalog_path=catalog_path).count("T37NBA") == 2
+
+
+def test_parse_sen_2_name():
+    out = pyeo.parse_sen_2_name("/data/L2/S2A_MSIL2A_20180301T162211_N0206_R040_T15PXT_20180301T194348.SAFE")
+    assert out.mission == "S2A"
+    assert out.level == "L2A"
+    assert out.datetime == dt.datetime(2018, 3, 1, 16, 22, 11)
+    assert out.baseline == "N0206"
+    assert out.orbit == "R040"
+    assert out.tile == "T15PXT"
+    assert out.processing_time == dt.datetime(2018, 3, 1, 19, 43, 48)
+    stack = pyeo.parse_sen_2_name("composite_T15PXT_20180101T162211_20180301T162211.tif")
+    assert stack.tile == "T15PXT"
+    assert stack.timestamp == "20180101T162211"
+    assert stack.mission is None
+    assert pyeo.parse_sen_2_name("not_an_image.txt").datetime is None
+
+
+def test_get_sentinel_api_per_thread():
+    api = pyeo.get_sentinel_api("user", "pass")
+    assert pyeo.get_sentinel_api("user", "pass") is api
+    thread_apis = []
+    thread = threading.Thread(target=lambda: thread_apis.append(pyeo.get_sentinel_api("user", "pass")))
+    thread.start()
+    thread.join()
+    assert thread_apis[0] is not api
+
+
+def test_batch_s2_query():
+    # A fake OpenSearch endpoint that returns the same product for every search
+    requests_seen = []
+
+    class FakeOpenSearchHandler(http.server.BaseHTTPRequestHandler):
+        def respond(self):
+            requests_seen.append(self.path)
+            feed = {"feed": {"opensearch:totalResults": "1", "entry": [{
+                "id": "test-uuid",
+                "title": "S2A_MSIL1C_20180514T073611_N0206_R092_T37NCA_20180514T095515",
+                "str": [{"name": "identifier",
+                         "content": "S2A_MSIL1C_20180514T073611_N0206_R092_T37NCA_20180514T095515"}]}]}}
+            body = json.dumps(feed).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        do_GET = respond
+        do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("localhost", 0), FakeOpenSearchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = "http://localhost:{}/".format(server.server_port)
+    try:
+        with TemporaryDirectory() as td:
+            aoi_paths = []
+            for name, x in (("aoi_1.geojson", 10), ("aoi_2.geojson", 20)):
+                aoi_paths.append(os.path.join(td, name))
+                with open(aoi_paths[-1], 'w') as f:
+                    json.dump({"type": "Polygon",
+                               "coordinates": [[[x, 0], [x + 1, 0], [x + 1, 1], [x, 1], [x, 0]]]}, f)
+            store_path = os.path.join(td, "queries.db")
+            out = pyeo.batch_s2_query("user", "pass", aoi_paths, dt.datetime(2018, 1, 1), dt.datetime(2018, 3, 1),
+                                      window_days=30, store_path=store_path, api_url=api_url)
+            assert list(out.keys()) == ["test-uuid"]
+            assert out["test-uuid"]["aois"] == aoi_paths
+            n_requests = len(requests_seen)
+            assert n_requests >= 4  # Two windows for each of two AOIs
+            out = pyeo.batch_s2_query("user", "pass", aoi_paths, dt.datetime(2018, 1, 1), dt.datetime(2018, 3, 1),
+                                      window_days=30, store_path=store_path, api_url=api_url)
+            assert len(requests_seen) == n_requests
+            assert out["test-uuid"]["identifier"].startswith("S2A_MSIL1C")
+    finally:
+        server.shutdown()
+
+
+def test_run_pipeline():
+    ordered_calls = []
+
+    def fail_on_six(item):
+        if item == 6:
+            raise ValueError("Bad item")
+        return item
+
+    def record(item):
+        ordered_calls.append(item)
+        return item * 10
+
+    stages = [("double", lambda item: item * 2, 2), ("check", fail_on_six, 1), ("halve", lambda item: item // 2, 3)]
+    out = pyeo.run_pipeline([4, 1, 3, 2], stages, ordered_func=record, order_key=lambda item: item)
+    assert out == [40, 10, None, 20]
+    assert ordered_calls == [1, 2, 4]
+
+
+def test_planet_download_async():
+    # A fake Planet API with two pages of results; each asset needs polling once before it is active, and the first
+    # activation request is rate limited
+    polled = set()
+    activated = set()
+
+    class FakePlanetHandler(http.server.BaseHTTPRequestHandler):
+        def send_json(self, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/quick-search":
+                self.send_json({"features": [{"id": "item_1", "properties": {"item_type": "PSScene4Band"}}],
+                                "_links": {"_next": base_url + "page_2"}})
+            else:
+                self.send_response(202 if activated else 429)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                activated.add(self.path)
+
+        def do_GET(self):
+            if self.path == "/page_2":
+                self.send_json({"features": [{"id": "item_2", "properties": {"item_type": "PSScene4Band"}}],
+                                "_links": {"_next": base_url + "page_3"}})
+            elif self.path == "/page_3":
+                self.send_json({"features": [], "_links": {}})
+            elif self.path.startswith("/item-types/"):
+                item_id = self.path.split("/")[4]
+                status = "active" if item_id in polled else "inactive"
+                polled.add(item_id)
+                self.send_json({"analytic": {"status": status,
+                                             "location": base_url + "download/" + item_id,
+                                             "_links": {"activate": base_url + "activate/" + item_id}}})
+            elif self.path.startswith("/download/"):
+                body = self.path.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = _Server(("localhost", 0), FakePlanetHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://localhost:{}/".format(server.server_port)
+    try:
+        with TemporaryDirectory() as td:
+            loop = pyeo.asyncio.new_event_loop()
+            out = loop.run_until_complete(pyeo.planet_download_async("key", {"name": "test"}, "analytic", td,
+                                                                     max_downloads=1, planet_url=base_url))
+            loop.close()
+            assert out == [os.path.join(td, "item_1.tif"), os.path.join(td, "item_2.tif")]
+            with open(out[1]) as f:
+                assert f.read() == "/download/item_2"
+
+            # Items that never become active fail instead of being polled forever
+            polled.clear()
+            loop = pyeo.asyncio.new_event_loop()
+            out = loop.run_until_complete(pyeo.planet_download_async("key", {"name": "test"}, "analytic", td,
+                                                                     planet_url=base_url, max_polls=0))
+            loop.close()
+            assert out == [None, None]
+    finally:
+        server.shutdown()
+
+
+def test_stream_extract_zip():
+    class UnseekableBuffer(io.RawIOBase):
+        # zipfile writes data descriptors instead of seeking back when it cannot seek
+        def __init__(self):
+            self.data = b""
+
+        def writable(self):
+            return True
+
+        def write(self, data):
+            self.data += bytes(data)
+            return len(data)
+
+    contents = {"test.SAFE/GRANULE/B02.jp2": os.urandom(5000) + b"0" * 5000,
+                "test.SAFE/manifest.safe": b"<xml></xml>"}
+    for out_buffer in (io.BytesIO(), UnseekableBuffer()):
+        with zipfile.ZipFile(out_buffer, 'w') as test_zip:
+            test_zip.writestr("test.SAFE/", b"")
+            test_zip.writestr("test.SAFE/GRANULE/B02.jp2", contents["test.SAFE/GRANULE/B02.jp2"],
+                              compress_type=zipfile.ZIP_DEFLATED)
+            test_zip.writestr("test.SAFE/manifest.safe", contents["test.SAFE/manifest.safe"],
+                              compress_type=zipfile.ZIP_STORED if isinstance(out_buffer, io.BytesIO)
+                              else zipfile.ZIP_DEFLATED)
+        zip_bytes = out_buffer.getvalue() if isinstance(out_buffer, io.BytesIO) else out_buffer.data
+        chunks = [zip_bytes[i: i + 7] for i in range(0, len(zip_bytes), 7)]
+        with TemporaryDirectory() as td:
+            pyeo.stream_extract_zip(chunks, td)
+            for name, content in contents.items():
+                with open(os.path.join(td, name), 'rb') as f:
+                    assert f.read() == content
+
+
+def test_stream_extract_zip_zip64_compressed_size_only():
+    # A stored member whose local header only puts its compressed size in the zip64 extra field
+    content = b"manifest"
+    name = b"test.SAFE/manifest.safe"
+    zip64_extra = struct.pack("<HHQ", 0x0001, 8, len(content))
+    zip_bytes = (b"PK\x03\x04" +
+                 struct.pack("<HHHHHIIIHH", 45, 0, 0, 0, 0, zipfile.crc32(content), 0xFFFFFFFF, len(content),
+                             len(name), len(zip64_extra)) +
+                 name + zip64_extra + content + b"PK\x05\x06" + b"\x00"*18)
+    with TemporaryDirectory() as td:
+        assert pyeo.stream_extract_zip([zip_bytes], td) == [os.path.join(td, "test.SAFE", "manifest.safe")]
+        with open(os.path.join(td, "test.SAFE", "manifest.safe"), 'rb') as f:
+            assert f.read() == content
+
+
+def test_stream_from_scihub_checksum():
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("test.SAFE/manifest.safe", b"manifest"*100)
+    zip_bytes = zip_buffer.getvalue()
+
+    class FakeResponse:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            return (zip_bytes[i: i + chunk_size] for i in range(0, len(zip_bytes), chunk_size))
+
+    class FakeSession:
+        auth = None
+
+        def get(self, url, stream, auth):
+            return FakeResponse()
+
+    class FakeApi:
+        session = FakeSession()
+
+        def __init__(self, md5):
+            self.md5 = md5
+
+        def get_product_odata(self, product_uuid):
+            return {"title": "test", "url": "http://example.com/test.zip", "md5": self.md5}
+
+    with TemporaryDirectory() as td:
+        with pytest.raises(pyeo.BadS2Exception):
+            pyeo.stream_from_scihub(FakeApi("0"*32), "uuid", td, chunk_size=100)
+        assert os.listdir(td) == []
+        safe_path = pyeo.stream_from_scihub(FakeApi(hashlib.md5(zip_bytes).hexdigest()), "uuid", td,
+                                            chunk_size=100)
+        assert safe_path == os.path.join(td, "test.SAFE")
+        assert os.listdir(td) == ["test.SAFE"]
+        assert os.path.exists(os.path.join(safe_path, "manifest.safe"))
+
+
+def test_open_dataset_from_safe_zip_and_url():
+    class RangeHandler(http.server.SimpleHTTPRequestHandler):
+        # gdal's /vsicurl/ reads zips with range requests, which SimpleHTTPRequestHandler ignores
+        root = None
+
+        def translate_path(self, path):
+            # Serves files from root rather than the working directory
+            return os.path.join(self.root, path.split("?")[0].lstrip("/"))
+
+        def send_head(self):
+            if "Range" not in self.headers:
+                return super().send_head()
+            path = self.translate_path(self.path)
+            size = os.path.getsize(path)
+            start, end = self.headers["Range"].replace("bytes=", "").split("-")
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+            with open(path, 'rb') as f:
+                f.seek(start)
+                body = f.read(end - start + 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return io.BytesIO(body)
+
+        def log_message(self, *args):
+            pass
+
+    with TemporaryDirectory() as td:
+        safe_dir = os.path.join(td, "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE")
+        band_dir = os.path.join(safe_dir, "GRANULE", "L2A_T13QFB", "IMG_DATA", "R10m")
+        os.makedirs(band_dir)
+        for band_index, band in enumerate(["B02", "B03", "B04", "B08"]):
+            band_path = os.path.join(band_dir, "T13QFB_20180329T171921_{}_10m.jp2".format(band))
+            band_image = gdal.GetDriverByName("GTiff").Create(band_path, 10, 10, 1, gdal.GDT_UInt16)
+            band_image.GetRasterBand(1).WriteArray(np.full((10, 10), band_index, dtype=np.uint16))
+            band_image = None
+        zip_path = safe_dir.replace(".SAFE", ".zip")
+        with zipfile.ZipFile(zip_path, 'w') as safe_zip:
+            for dirpath, _, filenames in os.walk(safe_dir):
+                for filename in filenames:
+                    file_path = os.path.join(dirpath, filename)
+                    safe_zip.write(file_path, os.path.relpath(file_path, td))
+
+        RangeHandler.root = td
+        server = http.server.HTTPServer(("127.0.0.1", 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            zip_url = "http://127.0.0.1:{}/{}".format(server.server_port, os.path.basename(zip_path))
+            for safe_path in [safe_dir, zip_path, zip_url]:
+                assert len(pyeo.glob_safe(safe_path, "GRANULE/*/IMG_DATA/R10m/*_B0[8,4,3,2]_10m.jp2")) == 4
+                band_image = pyeo.open_dataset_from_safe(safe_path, "B04")
+                assert band_image.GetRasterBand(1).ReadAsArray()[0, 0] == 2
+                band_image = None
+            assert pyeo.get_safe_root(zip_url).startswith("/vsizip//vsicurl/http://")
+        finally:
+            server.shutdown()
+
+
+def test_filter_by_aoi_coverage():
+    products = {
+        "covers": {"identifier": "covers", "footprint": "POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))",
+                   "cloudcoverpercentage": "5"},
+        "sliver": {"identifier": "sliver", "footprint": "POLYGON((3.5 0, 10 0, 10 10, 3.5 10, 3.5 0))",
+                   "cloudcoverpercentage": "5"}
+    }
+    with TemporaryDirectory() as td:
+        aoi_path = os.path.join(td, "aoi.geojson")
+        with open(aoi_path, 'w') as aoi_file:
+            json.dump({"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, "geometry": {
+                "type": "Polygon", "coordinates": [[[2, 6], [4, 6], [4, 8], [2, 8], [2, 6]]]}}]}, aoi_file)
+        out = pyeo.filter_by_aoi_coverage(products, aoi_path, min_overlap=0.5)
+        assert list(out.keys()) == ["covers"]
+        assert out["covers"]["aoi_overlap"] == 1
+
+        # No quicklook is fetched for a product that misses the aoi; the whole-tile cloud cover is used
+        elsewhere = {"elsewhere": {"identifier": "elsewhere", "cloudcoverpercentage": "5",
+                                   "footprint": "POLYGON((20 20, 30 20, 30 30, 20 30, 20 20))"}}
+        out = pyeo.filter_by_aoi_coverage(elsewhere, aoi_path, max_aoi_cloud=10)
+        assert out["elsewhere"]["aoi_overlap"] == 0
+        assert out["elsewhere"]["aoi_cloud"] == 5
+
+        # A 100x100 quicklook of "covers", white (cloudy) in its top left quarter, which holds all of the aoi
+        quicklook_path = os.path.join(td, "quicklook.tif")
+        quicklook = gdal.GetDriverByName("GTiff").Create(quicklook_path, 100, 100, 3, gdal.GDT_Byte)
+        for band_index in range(1, 4):
+            band = np.full((100, 100), 50, dtype=np.uint8)
+            band[:50, :50] = 255
+            quicklook.GetRasterBand(band_index).WriteArray(band)
+        quicklook = None
+        aoi_geometry = pyeo.get_aoi_geometry(aoi_path)
+        assert pyeo.estimate_aoi_cloud_cover(quicklook_path, products["covers"]["footprint"], aoi_geometry) == 100
+        # A footprint that misses the aoi has no aoi cloud cover to estimate
+        assert pyeo.estimate_aoi_cloud_cover(quicklook_path, "POLYGON((20 20, 30 20, 30 30, 20 30, 20 20))",
+                                             aoi_geometry) is None
+
+
+def test_get_aoi_window():
+    with TemporaryDirectory() as td:
+        raster_path = os.path.join(td, "tile.tif")
+        raster = gdal.GetDriverByName("GTiff").Create(raster_path, 600, 600, 1, gdal.GDT_Byte)
+        raster.SetGeoTransform((600000, 10, 0, 5000020, 0, -10))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32630)
+        raster.SetProjection(srs.ExportToWkt())
+        aoi_path = os.path.join(td, "aoi.geojson")
+        with open(aoi_path, 'w') as aoi_file:
+            json.dump({"type": "FeatureCollection",
+                       "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::32630"}},
+                       "features": [{"type": "Feature", "properties": {}, "geometry": {
+                           "type": "Polygon", "coordinates": [[[600125, 4999000], [600300, 4999000],
+                                                               [600300, 4999500], [600125, 4999500],
+                                                               [600125, 4999000]]]}}]}, aoi_file)
+        window = pyeo.get_aoi_window(raster, aoi_path)
+        assert window == (600120, 4999540, 600300, 4999000)
+        raster = None
+        window_raster = gdal.Open(pyeo.clip_to_window(raster_path, os.path.join(td, "window.tif"), window))
+        assert (window_raster.RasterXSize, window_raster.RasterYSize) == (18, 54)
+
+
+def test_clip_raster_to_window():
+    with TemporaryDirectory() as td:
+        raster_path = os.path.join(td, "raster.tif")
+        raster = gdal.GetDriverByName("GTiff").Create(raster_path, 10, 10, 2, gdal.GDT_Byte)
+        raster.SetGeoTransform((0, 10, 0, 100, 0, -10))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        raster.SetProjection(srs.ExportToWkt())
+        for band_index in (1, 2):
+            raster.GetRasterBand(band_index).WriteArray(np.ones((10, 10), dtype=np.uint8))
+        raster = None
+        aoi_path = os.path.join(td, "aoi.geojson")
+        with open(aoi_path, 'w') as aoi_file:
+            json.dump({"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, "geometry": {
+                "type": "Polygon", "coordinates": [[[20, 20], [80, 20], [20, 80], [20, 20]]]}}]}, aoi_file)
+        out_path = os.path.join(td, "out.tif")
+        pyeo.clip_raster(raster_path, aoi_path, out_path, use_window=True)
+        result = gdal.Open(out_path)
+        assert result.GetGeoTransform() == (20, 10, 0, 80, 0, -10)
+        result_array = result.ReadAsArray()
+        assert result_array.shape == (2, 6, 6)
+        assert np.all(result_array[:, -1, 0] == 1)   # Inside the triangle
+        assert np.all(result_array[:, 0, -1] == 0)   # Outside the triangle, but inside its envelope
+
+
+def test_get_training_data_sampling():
+    with TemporaryDirectory() as td:
+        image_path = os.path.join(td, "image.tif")
+        image = gdal.GetDriverByName("GTiff").Create(image_path, 10, 10, 2, gdal.GDT_Int16)
+        image.SetGeoTransform((0, 10, 0, 100, 0, -10))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        image.SetProjection(srs.ExportToWkt())
+        rows, cols = np.mgrid[0:10, 0:10]
+        image.GetRasterBand(1).WriteArray(rows*10 + cols)
+        image.GetRasterBand(2).WriteArray(-(rows*10 + cols))
+        image = None
+        shape_path = os.path.join(td, "training.geojson")
+        with open(shape_path, 'w') as shape_file:
+            json.dump({"type": "FeatureCollection", "features": [
+                {"type": "Feature", "properties": {"CODE": 1}, "geometry": {
+                    "type": "Polygon", "coordinates": [[[10, 10], [30, 10], [30, 30], [10, 30], [10, 10]]]}},
+                {"type": "Feature", "properties": {"CODE": 2}, "geometry": {
+                    "type": "Polygon", "coordinates": [[[50, 50], [90, 50], [90, 90], [50, 90], [50, 50]]]}}
+            ]}, shape_file)
+        training_data, classes = pyeo.get_training_data(image_path, shape_path)
+        assert sorted(training_data[classes == 1, 0]) == [71, 72, 81, 82]
+        assert np.count_nonzero(classes == 2) == 16
+        assert np.all(training_data[:, 1] == -training_data[:, 0])
+
+        training_data, classes = pyeo.get_training_data(image_path, shape_path, max_samples_per_class=3,
+                                                        random_state=0)
+        assert training_data.shape == (6, 2)
+        assert np.count_nonzero(classes == 1) == np.count_nonzero(classes == 2) == 3
+
+
+def test_build_training_set():
+    with TemporaryDirectory() as td:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        image_paths = []
+        for image_index, pixel_value in enumerate([5, 7]):
+            image_path = os.path.join(td, "training_{}.tif".format(image_index))
+            image = gdal.GetDriverByName("GTiff").Create(image_path, 10, 10, 3, gdal.GDT_Int16)
+            image.SetGeoTransform((0, 10, 0, 100, 0, -10))
+            image.SetProjection(srs.ExportToWkt())
+            for band_index in range(1, 4):
+                image.GetRasterBand(band_index).Fill(pixel_value)
+            image = None
+            shape_path = pyeo.get_training_shape_path(image_path)
+            os.makedirs(os.path.dirname(shape_path))
+            shape_source = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(shape_path)
+            shape_layer = shape_source.CreateLayer("training", srs, ogr.wkbPolygon)
+            shape_layer.CreateField(ogr.FieldDefn("CODE", ogr.OFTInteger))
+            feature = ogr.Feature(shape_layer.GetLayerDefn())
+            feature.SetField("CODE", image_index + 1)
+            # 2x2 pixels for the first image, 3x3 for the second
+            feature.SetGeometry(ogr.CreateGeometryFromWkt("POLYGON((10 10, {0} 10, {0} {0}, 10 {0}, 10 10))".format(
+                30 + 10*image_index)))
+            shape_layer.CreateFeature(feature)
+            shape_source = None
+            image_paths.append(image_path)
+        out_path = os.path.join(td, "training_set.npy")
+        learning_data, classes = pyeo.build_training_set(image_paths, threads=2, out_path=out_path)
+        assert learning_data.shape == (13, 3)
+        assert np.all(learning_data[classes == 1] == 5)
+        assert np.all(learning_data[classes == 2] == 7)
+        assert np.array_equal(np.load(out_path), learning_data)
+        assert np.array_equal(np.load(os.path.join(td, "training_set_classes.npy")), classes)
+
+
+def test_train_model():
+    random_generator = np.random.RandomState(0)
+    classes = np.repeat([1, 2], 100)
+    learning_data = random_generator.normal(size=(200, 3)) + classes[:, np.newaxis]*3
+    model, scores = pyeo.train_model(learning_data, classes, cv=3, n_jobs=2, cv_jobs=2, reuse_fold_models=True)
+    assert len(scores) == 3
+    # The fold models' trees are subsampled back down to the configured forest size
+    assert model.n_estimators == len(model.estimators_) == 100
+    assert np.mean(model.predict(learning_data) == classes) > 0.9
+
+    # 3 chunks; the 100 trees do not divide evenly between them
+    model, scores = pyeo.train_model(learning_data, classes, chunk_rows=70, random_state=0)
+    assert scores is None
+    assert model.n_estimators == len(model.estimators_) == 100
+    assert np.mean(model.predict(learning_data) == classes) > 0.9
+
+
+def test_color_class_map():
+    class_color_key = [["1", "12", "193", "76", "255", "Stable Forest"],
+                       ["3", "249", "31", "45", "255", "Forest -> Non-Forest"]]
+    with TemporaryDirectory() as td:
+        class_path = os.path.join(td, "classes.tif")
+        class_raster = gdal.GetDriverByName("GTiff").Create(class_path, 4, 5, 1, gdal.GDT_Int32)
+        class_array = np.array([[1, 3, 1, 3]]*5, dtype=np.int32)
+        class_array[4, 3] = 300   # Out of range; coloured as class 0
+        class_raster.GetRasterBand(1).WriteArray(class_array)
+        class_raster = None
+
+        rgb_path = pyeo.color_class_map(class_path, os.path.join(td, "rgb.tif"), class_color_key, block_rows=2)
+        rgb_array = gdal.Open(rgb_path).ReadAsArray()
+        assert list(rgb_array[:, 0, 0]) == [12, 193, 76]
+        assert list(rgb_array[:, 3, 1]) == [249, 31, 45]
+        assert list(rgb_array[:, 4, 3]) == [0, 0, 0]
+
+        paletted_path = pyeo.color_class_map(class_path, os.path.join(td, "paletted.tif"), class_color_key,
+                                             use_color_table=True)
+        paletted_band = gdal.Open(paletted_path).GetRasterBand(1)
+        assert paletted_band.ReadAsArray()[0, 1] == 3
+        assert paletted_band.GetColorTable().GetColorEntry(3) == (249, 31, 45, 255)
+
+
+def test_create_certainty_images():
+    # The last pixel is nodata
+    prob_array = np.array([[[0.7, 0.5, 1.0, 0.0]],
+                           [[0.2, 0.5, 0.0, 0.0]],
+                           [[0.1, 0.0, 0.0, 0.0]]], dtype=np.float32)
+    with TemporaryDirectory() as td:
+        prob_path = os.path.join(td, "prob.tif")
+        prob_raster = gdal.GetDriverByName("GTiff").Create(prob_path, 4, 1, 3, gdal.GDT_Float32)
+        for band_index in range(3):
+            prob_raster.GetRasterBand(band_index + 1).WriteArray(prob_array[band_index])
+        prob_raster = None
+        max_path, margin_path, entropy_path = pyeo.create_certainty_images(
+            prob_path, os.path.join(td, "max.tif"), os.path.join(td, "margin.tif"), os.path.join(td, "entropy.tif"))
+        assert np.allclose(gdal.Open(max_path).ReadAsArray(), [[0.7, 0.5, 1.0, 0]])
+        assert np.allclose(gdal.Open(margin_path).ReadAsArray(), [[0.5, 0, 1.0, 0]])
+        expected_entropy = -(0.7*np.log(0.7) + 0.2*np.log(0.2) + 0.1*np.log(0.1))/np.log(3)
+        entropy_band = gdal.Open(entropy_path).GetRasterBand(1)
+        assert np.allclose(entropy_band.ReadAsArray(), [[expected_entropy, np.log(2)/np.log(3), 0, -1]])
+        assert entropy_band.GetNoDataValue() == -1
+
+        quantised_path = pyeo.flatten_probability_image(prob_path, os.path.join(td, "quantised.tif"), quantise=True)
+        quantised = gdal.Open(quantised_path).ReadAsArray()
+        assert quantised.dtype == np.uint8
+        assert list(quantised[0]) == [178, 128, 255, 0]
+
+
+
+def test_quantised_probability_image():
+    image_array = np.stack([np.tile(np.arange(1, 11, dtype=np.int32), (6, 1)),
+                            np.tile(np.arange(1, 7, dtype=np.int32), (10, 1)).T])
+    classes = (image_array[0] > 5).astype(int) + (image_array[1] > 3).astype(int) + 1
+    model = ens.ExtraTreesClassifier(n_estimators=10, random_state=0)
+    model.fit(image_array.reshape(2, -1).T, classes.ravel())
+    with TemporaryDirectory() as td:
+        image_path = os.path.join(td, "image.tif")
+        image = gdal.GetDriverByName("GTiff").Create(image_path, 10, 6, 2, gdal.GDT_Int32)
+        for band_index in range(2):
+            image.GetRasterBand(band_index + 1).WriteArray(image_array[band_index])
+        image = None
+        model_path = os.path.join(td, "model.pkl")
+        pyeo.save_model(model, model_path)
+        float_prob_path = os.path.join(td, "prob_float.tif")
+        pyeo.classify_image(image_path, model_path, os.path.join(td, "class_float.tif"), float_prob_path,
+                            num_chunks=2)
+        for datatype, dtype in ((gdal.GDT_Byte, np.uint8), (gdal.GDT_UInt16, np.uint16)):
+            prob_path = os.path.join(td, "prob_{}.tif".format(dtype.__name__))
+            pyeo.classify_image(image_path, model_path, os.path.join(td, "class.tif"), prob_path,
+                                num_chunks=2, prob_datatype=datatype)
+            prob_raster = gdal.Open(prob_path)
+            assert prob_raster.ReadAsArray().dtype == dtype
+            scale = prob_raster.GetRasterBand(1).GetScale()
+            assert np.allclose(pyeo.read_scaled_block(prob_raster, 0, 6),
+                               gdal.Open(float_prob_path).ReadAsArray(), atol=scale/2 + 1e-6)
+            prob_raster = None
+            flat_path = pyeo.flatten_probability_image(prob_path, os.path.join(td, "flat.tif"))
+            float_flat_path = pyeo.flatten_probability_image(float_prob_path, os.path.join(td, "flat_float.tif"))
+            assert np.allclose(gdal.Open(flat_path).ReadAsArray(), gdal.Open(float_flat_path).ReadAsArray(),
+                               atol=scale/2 + 1e-6)
+
+
+def test_classify_image_masked_blocks():
+    random_generator = np.random.RandomState(0)
+    image_array = random_generator.randint(1, 100, size=(3, 20, 7)).astype(np.int32)
+    image_array[1, 2, 3] = 0
+    mask_array = np.ones((20, 7), dtype=np.uint8)
+    mask_array[5:12] = 0
+    mask_array[15, 1] = 0
+    features = image_array.reshape(3, -1).T
+    model = ens.ExtraTreesClassifier(n_estimators=10, random_state=0)
+    model.fit(features, (features[:, 0] > 50) + 1)
+    with TemporaryDirectory() as td:
+        image_path = os.path.join(td, "image.tif")
+        image = gdal.GetDriverByName("GTiff").Create(image_path, 7, 20, 3, gdal.GDT_Int32)
+        for band_index in range(3):
+            image.GetRasterBand(band_index + 1).WriteArray(image_array[band_index])
+        image = None
+        mask = gdal.GetDriverByName("GTiff").Create(pyeo.get_mask_path(image_path), 7, 20, 1, gdal.GDT_Byte)
+        mask.GetRasterBand(1).WriteArray(mask_array)
+        mask = None
+        model_path = os.path.join(td, "model.pkl")
+        pyeo.save_model(model, model_path)
+        class_path, prob_path = pyeo.classify_image(image_path, model_path, os.path.join(td, "class.tif"),
+                                                    os.path.join(td, "prob.tif"), apply_mask=True, block_rows=3)
+        good_pixels = (mask_array == 1) & np.all(image_array != 0, axis=0)
+        expected_classes = np.where(good_pixels, model.predict(features).reshape(20, 7), 0)
+        assert np.array_equal(gdal.Open(class_path).ReadAsArray(), expected_classes)
+        expected_probs = np.where(good_pixels, model.predict_proba(features).T.reshape(2, 20, 7), 0)
+        assert np.allclose(gdal.Open(prob_path).ReadAsArray(), expected_probs)
+
+        # Strips from num_chunks, classes only; the mask must stay readable for every strip
+        class_path = pyeo.classify_image(image_path, model_path, os.path.join(td, "class_chunks.tif"),
+                                         apply_mask=True, num_chunks=4)
+        assert np.array_equal(gdal.Open(class_path).ReadAsArray(), expected_classes)
+
+
+def test_aggregate_rasters():
+    with TemporaryDirectory() as td:
+        raster_paths = []
+        for raster_index in range(300):
+            raster_path = os.path.join(td, "change_{}.tif".format(raster_index))
+            raster = gdal.GetDriverByName("GTiff").Create(raster_path, 3, 5, 1, gdal.GDT_Byte)
+            raster.GetRasterBand(1).WriteArray(np.full((5, 3), raster_index % 2, dtype=np.uint8))
+            raster = None
+            raster_paths.append(raster_path)
+        raster_paths[-1] = raster_paths[-1].replace("299", "299_binary")
+        raster = gdal.GetDriverByName("GTiff").Create(raster_paths[-1], 3, 5, 1, gdal.GDT_Byte)
+        raster.GetRasterBand(1).WriteArray(np.full((5, 3), 255, dtype=np.uint8))
+        raster = None
+        # 149 ones and a 255: more than a byte can hold
+        sum_path = pyeo.aggregate_rasters(raster_paths, os.path.join(td, "sum.tif"), block_rows=2)
+        assert np.all(gdal.Open(sum_path).ReadAsArray() == 149 + 255)
+        count_path = pyeo.aggregate_rasters(raster_paths, os.path.join(td, "count.tif"), "count")
+        assert np.all(gdal.Open(count_path).ReadAsArray() == 150)
+        mean_path = pyeo.aggregate_rasters(raster_paths, os.path.join(td, "mean.tif"), "mean")
+        assert np.allclose(gdal.Open(mean_path).ReadAsArray(), (149 + 255)/300)
+        max_path = pyeo.aggregate_rasters(raster_paths, os.path.join(td, "max.tif"), "max", block_rows=3)
+        assert np.all(gdal.Open(max_path).ReadAsArray() == 255)
+        min_path = pyeo.aggregate_rasters(raster_paths, os.path.join(td, "min.tif"), "min")
+        assert np.all(gdal.Open(min_path).ReadAsArray() == 0)
+
+        # Floating point inputs are summed into a 64 bit float
+        float_paths = []
+        for raster_index in range(2):
+            float_paths.append(os.path.join(td, "float_{}.tif".format(raster_index)))
+            raster = gdal.GetDriverByName("GTiff").Create(float_paths[-1], 3, 5, 1, gdal.GDT_Float32)
+            raster.GetRasterBand(1).WriteArray(np.full((5, 3), 1e8 + 1, dtype=np.float32))
+            raster = None
+        float_sum_path = pyeo.aggregate_rasters(float_paths, os.path.join(td, "float_sum.tif"))
+        assert gdal.Open(float_sum_path).GetRasterBand(1).DataType == gdal.GDT_Float64
+
+
+def test_reclassify_directory():
+    with TemporaryDirectory() as td:
+        in_dir = os.path.join(td, "classes")
+        os.mkdir(in_dir)
+        for raster_index in range(3):
+            raster = gdal.GetDriverByName("GTiff").Create(os.path.join(in_dir, "class_{}.tif".format(raster_index)),
+                                                          4, 3, 1, gdal.GDT_Int16)
+            raster.GetRasterBand(1).WriteArray(np.array([[1, 2, 3, 10]]*3, dtype=np.int16) + raster_index)
+            raster = None
+        out_paths = pyeo.reclassify_directory(in_dir, os.path.join(td, "forest"), {1: 1, 2: 1, 4: 1}, processes=2)
+        assert [os.path.basename(out_path) for out_path in out_paths] == \
+               ["class_0_rcl.tif", "class_1_rcl.tif", "class_2_rcl.tif"]
+        assert gdal.Open(out_paths[0]).ReadAsArray().tolist() == [[1, 1, 0, 0]]*3
+        assert gdal.Open(out_paths[2]).ReadAsArray().tolist() == [[0, 1, 0, 0]]*3
+        assert gdal.Open(out_paths[2]).GetRasterBand(1).DataType == gdal.GDT_Byte
+
+
+def test_reclassify_array():
+    mapping = {1: 5, 3: 7}
+    int_array = np.array([[-1, 1, 2, 3, 300]], dtype=np.int16)
+    assert pyeo.reclassify_array(int_array, mapping, default=9).tolist() == [[9, 5, 9, 7, 9]]
+    float_array = np.array([[0.5, 1.0, 2.5, 3.0]], dtype=np.float32)
+    assert pyeo.reclassify_array(float_array, mapping).tolist() == [[0, 5, 0, 7]]
+    assert pyeo.reclassify_array(float_array, {0.5: 2, 2.5: 4}).tolist() == [[2, 0, 4, 0]]
+    with pytest.raises(ValueError):
+        pyeo.reclassify_array(int_array, {})
+    with pytest.raises(ValueError):
+        pyeo.build_reclass_lut({0.5: 2})
+
+
+def test_reclassify_raster_float():
+    with TemporaryDirectory() as td:
+        in_path = os.path.join(td, "probability.tif")
+        raster = gdal.GetDriverByName("GTiff").Create(in_path, 4, 3, 1, gdal.GDT_Float32)
+        raster.GetRasterBand(1).WriteArray(np.array([[0.5, 1, 2.5, 3]]*3, dtype=np.float32))
+        raster = None
+        out_path = pyeo.reclassify_raster(in_path, os.path.join(td, "rcl.tif"), {0.5: 1, 3: 2}, block_rows=2)
+        assert gdal.Open(out_path).ReadAsArray().tolist() == [[1, 0, 0, 2]]*3
+        with pytest.raises(ValueError):
+            pyeo.reclassify_raster(in_path, os.path.join(td, "empty.tif"), {})
+
+
+def test_overview_stage():
+    with TemporaryDirectory() as td:
+        class_path = os.path.join(td, "class.tif")
+        raster = gdal.GetDriverByName("GTiff").Create(class_path, 64, 64, 1, gdal.GDT_Byte)
+        raster.GetRasterBand(1).WriteArray(np.indices((64, 64)).sum(axis=0).astype(np.uint8) % 2 * 9 + 1)
+        raster = None
+        with pyeo.OverviewStage(workers=2, overview_levels=(2, 4)) as overview_stage:
+            future = overview_stage.submit(class_path, "class")
+        assert future.result() == class_path
+        assert os.path.exists(class_path + ".ovr")
+        band = gdal.Open(class_path).GetRasterBand(1)
+        assert band.GetOverviewCount() == 2
+        # Nearest neighbour keeps the classes; averaging a checkerboard of 1 and 10 would not
+        assert set(np.unique(band.GetOverview(0).ReadAsArray())) <= {1, 10}
+        assert float(band.GetMetadataItem("STATISTICS_MAXIMUM")) == 10
+
+        # Overriding the resampling for a single raster
+        average_path = os.path.join(td, "average.tif")
+        gdal.GetDriverByName("GTiff").CreateCopy(average_path, gdal.Open(class_path))
+        with pyeo.OverviewStage(workers=1, overview_levels=(2,), resampling={"class": "nearest"}) as overview_stage:
+            overview_stage.submit(average_path, "class", resampling="average")
+        band = gdal.Open(average_path).GetRasterBand(1)
+        assert not set(np.unique(band.GetOverview(0).ReadAsArray())) <= {1, 10}
+
+
+def test_get_overview_resampling():
+    assert pyeo.get_overview_resampling("class") == "nearest"
+    assert pyeo.get_overview_resampling("probability") == "average"
+    assert pyeo.get_overview_resampling("probability", {"probability": "bilinear"}) == "bilinear"
+    assert pyeo.get_overview_resampling("class", {"probability": "bilinear"}) == "nearest"
+    assert pyeo.get_overview_resampling("class", "mode") == "mode"
+
+
+def test_signature_store():
+    with TemporaryDirectory() as td:
+        store_path = os.path.join(td, "signatures")
+        pyeo.append_signatures(store_path, np.array([[1, 2, 3], [4, 5, 6]]), np.array([1, 2]), "first.tif",
+                               ["B02", "B03", "B04"])
+        pyeo.append_signatures(store_path, np.array([[7, 8, 9]]), np.array([3]), "second.tif")
+        features, classes = pyeo.load_signatures(store_path)
+        assert isinstance(features, np.memmap)
+        assert features.tolist() == [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+        assert classes.tolist() == [1, 2, 3]
+        index = pyeo.read_signature_index(store_path)
+        assert [(source["image"], source["start"], source["rows"]) for source in index["sources"]] == \
+               [("first.tif", 0, 2), ("second.tif", 2, 1)]
+        assert index["sources"][0]["bands"] == ["B02", "B03", "B04"]
+        features = None
+
+
+def test_get_model():
+    random_generator = np.random.RandomState(0)
+    learning_data = random_generator.normal(size=(50, 3))
+    classes = (learning_data[:, 0] > 0).astype(int)
+    model = ens.ExtraTreesClassifier(n_estimators=5).fit(learning_data, classes)
+    with TemporaryDirectory() as td:
+        model_path = pyeo.save_model(model, os.path.join(td, "model.pkl"))
+        loaded_model = pyeo.get_model(model_path)
+        assert pyeo.get_model(model_path) is loaded_model
+        assert np.array_equal(loaded_model.predict_proba(learning_data), model.predict_proba(learning_data))
+
+        # Rewriting the model file invalidates the cache
+        mtime = os.stat(model_path).st_mtime
+        pyeo.save_model(model, model_path)
+        os.utime(model_path, (mtime + 10, mtime + 10))
+        assert pyeo.get_model(model_path) is not loaded_model